@@ -1,24 +1,47 @@
 #! /usr/bin/env python3
 
 import os
-import math
+import functools
 import argparse
 import textwrap
 import sys
 import yaml
-import json
 import datetime
 import re
 import requests
 import shutil
-import urllib
 import glob
 import subprocess
 import configparser
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging as log
 from pathlib import Path
-import pandas as pd
 from utils.arup_archive import main as arup_main  # noqa: F401
+from utils import sheet_cache
+from utils import http_client
+from utils import ena_filereports
+from utils import logsheets
+from utils.crate_graph import CrateGraph
+from utils.crate_template import CrateTemplate
+from utils import payload_manifest
+from utils.payload_manifest import PayloadManifest
+from utils.file_classifier import FileClassifier
+from utils.extraction_policy import ExtractionPolicy
+from utils.payload_codecs import DEFAULT_CODEC, payload_format
+from utils import crate_json
+from utils.dvc_hash import DvcRepo, stub_index
+from utils.hash_cache import HashCache
+from utils import s3_upload
+from utils.async_fetch import AsyncFetcher, DEFAULT_MAX_CONCURRENCY
+from utils.sample_registry import get_registry
+from utils.sample_db import get_db
+from utils import metadata_sources
+from utils.metadata_sources import (
+    ENA_ACCESSION_INFO_PATHS,
+    TEMPLATE_URL,
+)
 
 desc = """
 Build a MetaGOflow Data Products ro-crate.
@@ -32,7 +55,12 @@ where:
     yaml_configuration is a YAML file of metadata specific to this ro-crate
         a template is here: ro-crate-config.yaml
 
-The script acts on one MGF analysis results archive at a time.
+The script acts on one MGF analysis results archive at a time, or with the -b
+flag on every archive in a prepared_archives directory in a single process:
+
+$ create-ro-crate.py -b prepared_archives <yaml_configuration> [-r RUN_ID ...]
+
+and with -j several of those archives are built at the same time.
 
 This script builds an RDF Turtle file for the functional analyses results, and each
 of the taxonomic analyses (i.e. LSU and SSU), uploads all payload files to an S3
@@ -49,49 +77,9 @@ To debug use the -d flag.
 """
 
 #########################################################################################
-# run-information files for each batch set to sequencing facility
-BATCH1_RUN_INFO_PATH = (
-    "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/main/"
-    "shipment/batch-001/run-information-batch-001.csv"
-)
-BATCH2_RUN_INFO_PATH = (
-    "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/main/"
-    "shipment/batch-002/run-information-batch-002.csv"
-)
-BATCH3_RUN_INFO_PATH = (
-    "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/main/"
-    "shipment/batch-003-0/run-information-batch-003.csv"
-)
-# ENA ACCESSSION INFO for each batch
-BATCH1_ENA_ACCESSION_INFO_PATH = (
-    "https://raw.githubusercontent.com/emo-bon/sequencing-data/refs/heads/main/"
-    "shipment/batch-001/ena-accession-numbers-batch-001.csv"
-)
-BATCH2_ENA_ACCESSION_INFO_PATH = (
-    "https://raw.githubusercontent.com/emo-bon/sequencing-data/refs/heads/main/"
-    "shipment/batch-002/ena-accession-numbers-batch-002.csv"
-)
-
-# Currently missing
-#BATCH3_ENA_ACCESSION_INFO_PATH = (
-#    "https://raw.githubusercontent.com/emo-bon/sequencing-data/refs/heads/main/"
-#    "shipment/batch-003-0/ena-accession-numbers-batch-003.csv"
-#)
+# The run-information, ENA accession, MGF _Run_Track sheets, the logsheets and the
+# ro-crate metadata template addresses are in utils/metadata_sources.py
 
-# The ro-crate metadata template from Github
-TEMPLATE_URL = (
-    "https://raw.githubusercontent.com/emo-bon/MetaGOflow-Data-Products-RO-Crate"
-    "/main/ro-crate-metadata.json-template"
-)
-# The MGF _Run_Track Google Sheets
-FILTERS_MGF_PATH = (
-    "https://docs.google.com/spreadsheets/d/"
-    "1j9tRRsRCcyViDMTB1X7lx8POY1P5bV7UijxKKSebZAM/gviz/tq?tqx=out:csv&sheet=FILTERS"
-)
-SEDIMENTS_MGF_PATH = (
-    "https://docs.google.com/spreadsheets/d/"
-    "1j9tRRsRCcyViDMTB1X7lx8POY1P5bV7UijxKKSebZAM/gviz/tq?tqx=out:csv&sheet=SEDIMENTS"
-)
 # S3 store path
 #S3_STORE_URL_TEMPLATE = "https://s3.mesocentre.uca.fr/{bucket_name}/files/md5"
 
@@ -109,10 +97,11 @@ CONFIG_YAML_PARAMETERS = [
 #RO_CRATE_REPO_PATH = "analysis-results-cluster-01-crate" # Batch 1 and 2
 #RO_CRATE_REPO_PATH = "analysis-results-cluster-02-crate" # Batch 3
 
-MANDATORY_FILES = [
+# Each build starts its PayloadManifest from these, and extends it as it goes
+MANDATORY_FILES = (
     "./fastp.html",
     "./RNA-counts",
-    "./final.contigs.fa.bz2",
+    "./final.contigs.fa{payload_suffix}",
     "./config.yml",
     "./functional-annotation/stats/go.stats",
     "./functional-annotation/stats/interproscan.stats",
@@ -139,7 +128,105 @@ MANDATORY_FILES = [
     "./taxonomy-summary/LSU/{prefix}.merged_LSU.fasta.mseq_json.biom",
     "./taxonomy-summary/LSU/{prefix}.merged_LSU.fasta.mseq.tsv",
     "./taxonomy-summary/LSU/{prefix}.merged_LSU.fasta.mseq.txt",
-]
+)
+
+# The sequence data files in the results, by kind: the regular expression of the
+# file name for a run {prefix} and payload codec {suffix}, and the @type, name,
+# description, encodingFormat (None for that of the payload codec) and
+# dct:format of its stanza
+SEQUENCE_DATA_FILES = {
+    "trimmed_forward_reads": (
+        r"{prefix}_[A-Za-z0-9]+_[0-9]_1_[A-Za-z0-9]+\.[A-Za-z0-9]+_clean\.fastq\.trimmed\.fasta{suffix}",
+        ["File", "edam:data_2977"],  # @type
+        "Trimmed forward reads",
+        "All forward reads after trimming in fasta format",
+        None,  # the codec's
+        "edam:format_1929",  # dct:format
+    ),
+    "trimmed_forward_reads_qc_summary": (
+        r"{prefix}_[A-Za-z0-9]+_[0-9]_1_[A-Za-z0-9]+\.[A-Za-z0-9]+_clean\.fastq\.trimmed\.qc_summary",
+        "File",  # @type
+        "Trimmed forward reads QC summary",
+        "Quality control summary of trimmed forward reads",
+        "text/plain",
+        None,
+    ),
+    "trimmed_reverse_reads": (
+        r"{prefix}_[A-Za-z0-9]+_[0-9]_2_[A-Za-z0-9]+\.[A-Za-z0-9]+_clean\.fastq\.trimmed\.fasta{suffix}",
+        ["File", "edam:data_2977"],
+        "Trimmed reverse reads",
+        "All reverse reads after trimming in fasta format",
+        None,  # the codec's
+        "edam:format_1929",  # dct:format
+    ),
+    "trimmed_reverse_reads_qc_summary": (
+        r"{prefix}_[A-Za-z0-9]+_[0-9]_2_[A-Za-z0-9]+\.[A-Za-z0-9]+_clean\.fastq\.trimmed\.qc_summary",
+        "File",  # @type
+        "Trimmed reverse reads QC summary",
+        "Quality control summary of trimmed reverse reads",
+        "text/plain",
+        None,
+    ),
+    "protein_coding_amino_acid_sequences": (
+        r"{prefix}\.merged_CDS\.faa{suffix}",
+        ["File", "edam:data_2976"],
+        "Protein coding amino acid sequences",
+        "Coding sequences of merged reads in amino acid format",
+        None,  # the codec's
+        "edam:format_1929",
+    ),
+    "protein_coding_nucleotide_sequences": (
+        r"{prefix}\.merged_CDS\.ffn{suffix}",
+        ["File", "edam:data_2977"],
+        "Protein coding nucleotide sequences",
+        "Coding sequences of merged reads in nucleotide format",
+        None,  # the codec's
+        "edam:format_1929",
+    ),
+    "overlapped_coding_sequences": (
+        r"{prefix}\.merged\.cmsearch\.all\.tblout\.deoverlapped{suffix}",
+        "File",
+        "Overlapped coding sequences",
+        "Overlapped coding sequences (intermediate file)",
+        None,  # the codec's
+        None,
+    ),
+    "merged_reads": (
+        r"{prefix}\.merged\.fasta{suffix}",
+        ["File", "edam:data_2977"],
+        "Merged reads",
+        "Merged forward and reverse reads in fasta format",
+        None,  # the codec's
+        "edam:format_1929",
+    ),
+    "motus": (
+        r"{prefix}\.merged\.motus\.tsv{suffix}",
+        "File",
+        "MOTUs",
+        "Metagenomic Operational Taxonomic Units (MOTUs) in tab-separated format",
+        None,  # the codec's
+        None,
+    ),
+    "merged_reads_qc_summary": (
+        r"{prefix}\.merged\.qc_summary",
+        "File",
+        "QC summary of merged reads",
+        "Quality control analysis summary of merged reads",
+        "text/plain",
+        None,
+    ),
+    "unfiltered_merged_reads": (
+        r"{prefix}\.merged\.unfiltered_fasta{suffix}",
+        ["File", "edam:data_2977"],
+        "Unfiltered merged reads",
+        "All merged reads before fileting in fasta format",
+        None,  # the codec's
+        "edam:format_1929",
+    ),
+}
+
+# Files at the top of the results that go to the root of the crate
+RESULTS_ROOT_FILES = ["fastp.html", "RNA-counts"]
 
 YAML_ERROR = """
 Cannot find the run YAML file. Bailing...
@@ -196,25 +283,18 @@ def get_ref_code_and_prefix(conf):
     run_id is the last part of the reads_name in the run information file.
     e.g. 'DBH_AAAAOSDA_1_HWLTKDRXY.UDI235' and is the name used to label the target_directory.
     """
-    for i, batch in enumerate([BATCH1_RUN_INFO_PATH, BATCH2_RUN_INFO_PATH, BATCH3_RUN_INFO_PATH]):
-        df = pd.read_csv(batch, encoding='iso-8859-1')
-        for row in df[["reads_name", "ref_code", "source_mat_id"]].values.tolist():
-            if isinstance(row[0], str):
-                # print(row)
-                if row[0].split("_")[-1] == conf["run_id"]:
-                    conf["ref_code"] = row[1]
-                    conf["prefix"] = row[0].split("_")[0]
-                    conf["batch_number"] = i + 1
-                    conf["source_mat_id"] = row[2]
-                    log.info(f"EMO BON ref_code: {conf['ref_code']}")
-                    log.info(f"Source mat ID: {conf['source_mat_id']}")
-                    log.info(f"Prefix: {conf['prefix']}")
-                    return conf
-            elif math.isnan(row[0]):
-                # Not all samples with an EMO BON code were sent to sequencing
-                continue
-    log.error("Cannot find the ref_code for run_id %s" % conf["run_id"])
-    sys.exit()
+    sample = get_registry().by_run_id(conf["run_id"])
+    if sample is None:
+        log.error("Cannot find the ref_code for run_id %s" % conf["run_id"])
+        sys.exit()
+    conf["ref_code"] = sample.ref_code
+    conf["prefix"] = sample.prefix
+    conf["batch_number"] = sample.batch_number
+    conf["source_mat_id"] = sample.source_mat_id
+    log.info(f"EMO BON ref_code: {conf['ref_code']}")
+    log.info(f"Source mat ID: {conf['source_mat_id']}")
+    log.info(f"Prefix: {conf['prefix']}")
+    return conf
 
 
 # No longer used
@@ -245,9 +325,9 @@ def writeHTMLpreview(roc_path):
             log.info("Written HTML preview file")
 
 
-def sequence_categorisation_stanzas(target_directory, template, conf):
+def sequence_categorisation_stanzas(target_directory, template, conf, manifest):
     """Glob the sequence_categorisation directory and build a stanza for each
-    zipped data file; add to MANDATORY_FILES list
+    zipped data file; add to the payload manifest
 
     Return updated template, and list of sequence category filenames
     """
@@ -258,25 +338,33 @@ def sequence_categorisation_stanzas(target_directory, template, conf):
     seq_cat_files = [sq.name for sq in seq_cat_paths]
     log.debug(f"Seq_cat_files: {seq_cat_files}")
     log.info(f"Adding {len(seq_cat_files)} sequence categorisation files to graph")
-    # Add the sequence categorisation files to the list of mandatory files
+    # Add the sequence categorisation files to the payload manifest
     # So that they can be used to build the upload script later
     qualified_paths = [
         "/".join(["./sequence-categorisation", str(sq)]) for sq in seq_cat_files
     ]
-    # global MANDATORY_FILES
-    MANDATORY_FILES.extend(qualified_paths)
-    log.debug(f"MANDATORY_FILES (after seq_categorisation)= {MANDATORY_FILES}")
+    for fn in qualified_paths:
+        manifest.add(
+            fn,
+            payload_manifest.SEQUENCE_CATEGORISATION,
+            source=Path(target_directory, "results", fn),
+        ).stanza = fn
+    log.debug(f"Payload manifest (after seq_categorisation) = {manifest}")
 
     # Sequence-categorisation stanza
-    for i, stanza in enumerate(template["@graph"]):
-        if stanza["@id"] == "./sequence-categorisation/":
-            # NB with the qualified paths
-            stanza["hasPart"] = [dict([("@id", f"{fn}")]) for fn in qualified_paths]
-            log.debug(f"Seq catagoriastaion stanza['hasPart'] == {stanza['hasPart']}")
-            sq_index = i
-            break
-
-    qualified_paths.reverse()
+    graph = template["@graph"]
+    if "./sequence-categorisation/" not in graph:
+        log.error("Cannot find the sequence-categorisation stanza")
+        sys.exit()
+    # NB with the qualified paths
+    graph.set_parts("./sequence-categorisation/", qualified_paths)
+    log.debug(
+        "Seq catagoriastaion stanza['hasPart'] == "
+        f"{graph['./sequence-categorisation/']['hasPart']}"
+    )
+
+    # The file stanzas follow the sequence-categorisation stanza, in order
+    anchor = "./sequence-categorisation/"
     for fn in qualified_paths:
         bits = Path(fn).name.split(".")
         if bits[0] == "5_8S":
@@ -296,11 +384,24 @@ def sequence_categorisation_stanzas(target_directory, template, conf):
                 ("encodingFormat", "application/zip"),
             ]
         )
-        template["@graph"].insert(sq_index + 1, d)
+        anchor = graph.insert_after(anchor, d)["@id"]
     return template
 
 
-def add_sequence_data_stanzas(target_directory, template, conf):
+@functools.lru_cache
+def sequence_data_classifier(prefix, suffix=".bz2"):
+    """The SEQUENCE_DATA_FILES patterns for a run prefix and payload codec
+    suffix, compiled once
+    """
+    return FileClassifier(
+        {
+            kind: value[0].format(prefix=re.escape(prefix), suffix=re.escape(suffix))
+            for kind, value in SEQUENCE_DATA_FILES.items()
+        }
+    )
+
+
+def add_sequence_data_stanzas(target_directory, template, conf, manifest):
     """
     Add the sequence data stanzas to the template:
 
@@ -318,85 +419,6 @@ def add_sequence_data_stanzas(target_directory, template, conf):
 
     """
     log.info("Adding 11 mandatory sequence data stanzas to graph")
-    data = {
-        r"^{prefix}_[A-Za-z0-9]+_[0-9]_1_[A-Za-z0-9]+\.[A-Za-z0-9]+_clean\.fastq\.trimmed\.fasta\.bz2$": (
-            ["File", "edam:data_2977"],  # @type
-            "Trimmed forward reads",
-            "All forward reads after trimming in fasta format",
-            "application/x-bzip2",
-            "edam:format_1929",  # dct:format
-        ),
-        r"^{prefix}_[A-Za-z0-9]+_[0-9]_1_[A-Za-z0-9]+\.[A-Za-z0-9]+_clean\.fastq\.trimmed\.qc_summary$": (
-            "File",  # @type
-            "Trimmed forward reads QC summary",
-            "Quality control summary of trimmed forward reads",
-            "text/plain",
-            None,
-        ),
-        r"^{prefix}_[A-Za-z0-9]+_[0-9]_2_[A-Za-z0-9]+\.[A-Za-z0-9]+_clean\.fastq\.trimmed\.fasta\.bz2$": (
-            ["File", "edam:data_2977"],
-            "Trimmed reverse reads",
-            "All reverse reads after trimming in fasta format",
-            "application/x-bzip2",
-            "edam:format_1929",  # dct:format
-        ),
-        r"^{prefix}_[A-Za-z0-9]+_[0-9]_2_[A-Za-z0-9]+\.[A-Za-z0-9]+_clean\.fastq\.trimmed\.qc_summary$": (
-            "File",  # @type
-            "Trimmed reverse reads QC summary",
-            "Quality control summary of trimmed reverse reads",
-            "text/plain",
-            None,
-        ),
-        "{prefix}.merged_CDS.faa.bz2": (
-            ["File", "edam:data_2976"],
-            "Protein coding amino acid sequences",
-            "Coding sequences of merged reads in amino acid format",
-            "application/x-bzip2",
-            "edam:format_1929",
-        ),
-        "{prefix}.merged_CDS.ffn.bz2": (
-            ["File", "edam:data_2977"],
-            "Protein coding nucleotide sequences",
-            "Coding sequences of merged reads in nucleotide format",
-            "application/x-bzip2",
-            "edam:format_1929",
-        ),
-        "{prefix}.merged.cmsearch.all.tblout.deoverlapped.bz2": (
-            "File",
-            "Overlapped coding sequences",
-            "Overlapped coding sequences (intermediate file)",
-            "application/x-bzip2",
-            None,
-        ),
-        "{prefix}.merged.fasta.bz2": (
-            ["File", "edam:data_2977"],
-            "Merged reads",
-            "Merged forward and reverse reads in fasta format",
-            "application/x-bzip2",
-            "edam:format_1929",
-        ),
-        "{prefix}.merged.motus.tsv.bz2": (
-            "File",
-            "MOTUs",
-            "Metagenomic Operational Taxonomic Units (MOTUs) in tab-separated format",
-            "application/x-bzip2",
-            None,
-        ),
-        "{prefix}.merged.qc_summary": (
-            "File",
-            "QC summary of merged reads",
-            "Quality control analysis summary of merged reads",
-            "text/plain",
-            None,
-        ),
-        "{prefix}.merged.unfiltered_fasta.bz2": (
-            ["File", "edam:data_2977"],
-            "Unfiltered merged reads",
-            "All merged reads before fileting in fasta format",
-            "application/x-bzip2",
-            "edam:format_1929",
-        ),
-    }
     seq_data_paths = Path(target_directory, "results").glob(f"{conf['prefix']}*")
     # Just the file names as @ids changed later
     seq_data_files = [sq.name for sq in seq_data_paths]
@@ -406,49 +428,46 @@ def add_sequence_data_stanzas(target_directory, template, conf):
         sys.exit()
     log.debug(f"Seq_data_files: {seq_data_files}")
 
-    # global MANDATORY_FILES
-    MANDATORY_FILES.extend([f"./{fn}" for fn in seq_data_files])
-    log.debug(f"MANDATORY_FILES (after seq_data_files) = {MANDATORY_FILES}")
+    for fn in seq_data_files:
+        manifest.add(
+            f"./{fn}",
+            payload_manifest.SEQUENCE_DATA,
+            source=Path(target_directory, "results", fn),
+        )
+    log.debug(f"Payload manifest (after seq_data_files) = {manifest}")
 
-    for stanza in template["@graph"]:
-        if stanza["@id"] == "./":
-            # Update the hasPart dict with the sequence data files
-            ns = [dict([("@id", f"./{fn.format(**conf)}")]) for fn in seq_data_files]
-            stanza["hasPart"].extend(ns)
-            break
+    graph = template["@graph"]
+    # Update the hasPart dict with the sequence data files
+    graph.add_parts("./", [f"./{fn.format(**conf)}" for fn in seq_data_files])
 
     # Add the sequence data stanzas after config.yml
-    # Get the config.yml index
-    for sq_index, stanza in enumerate(template["@graph"]):
-        if stanza["@id"] == "./config.yml":
-            break
-
-    for seq_file in seq_data_files:
-        log.debug(f"Looking for seq_file: {seq_file}")
-        for patt, value in data.items():
-            found = False
-            filename = patt.format(**conf)
-            if re.match(filename, seq_file):
-                d = dict(
-                    [
-                        ("@id", f"./{seq_file}"),
-                        ("@type", value[0]),
-                        ("name", value[1]),
-                        ("description", value[2]),
-                        ("downloadUrl", ""),
-                        ("encodingFormat", value[3]),
-                    ]
-                )
-                # Insert dct:format if it has one
-                if value[4]:
-                    d["dct:format"] = {"@id": value[4]}
-                template["@graph"].insert(sq_index + 1, d)
-                found = True
-                log.debug(f"Added stanza for {seq_file}")
-                break
-        if not found:
-            log.error(f"Cannot find pattern for {seq_file}")
-            sys.exit()
+    # Each one goes immediately after it, i.e. before the previous ones
+
+    classification = sequence_data_classifier(
+        conf["prefix"], conf["payload_suffix"]
+    ).classify_all(seq_data_files)
+    if not classification.ok:
+        classification.log_problems()
+        sys.exit()
+    for seq_file, kind in classification.matched.items():
+        log.debug(f"Classified seq_file {seq_file} as {kind}")
+        value = SEQUENCE_DATA_FILES[kind]
+        d = dict(
+            [
+                ("@id", f"./{seq_file}"),
+                ("@type", value[1]),
+                ("name", value[2]),
+                ("description", value[3]),
+                ("downloadUrl", ""),
+                ("encodingFormat", value[4] or conf["payload_encoding_format"]),
+            ]
+        )
+        # Insert dct:format if it has one
+        if value[5]:
+            d["dct:format"] = {"@id": value[5]}
+        graph.insert_after("./config.yml", d)
+        manifest.get(f"./{seq_file}").stanza = d["@id"]
+        log.debug(f"Added stanza for {seq_file}")
 
     return template
 
@@ -507,15 +526,28 @@ def read_yaml(yaml_config):
             if not conf[param] or not isinstance(conf[param], str):
                 log.error(f"Parameter '{param}' in YAML file must be a string.")
                 sys.exit()
+    # The codec prepare_data.py compressed the sequence data with
+    conf.setdefault("payload_codec", DEFAULT_CODEC)
+    try:
+        conf["payload_suffix"], conf["payload_encoding_format"] = payload_format(
+            conf["payload_codec"]
+        )
+    except ValueError as e:
+        log.error(f"YAML 'payload_codec' parameter: {e}")
+        sys.exit()
     log.info("YAML configuration looks good...")
     return conf
 
 
-def check_and_format_data_file_paths(target_directory, conf, check_exists=True):
-    """Check that all mandatory files are present in the target directory"""
+def check_and_format_data_file_paths(
+    target_directory, conf, manifest, check_exists=True
+):
+    """Check that all mandatory files of the manifest are present in the
+    target directory, and record their source paths
+    """
 
     workflow_yaml_path = WORKFLOW_YAML_FILENAME.format(**conf)
-    filepaths = [f.format(**conf) for f in MANDATORY_FILES]
+    filepaths = manifest.paths()
     if check_exists:
         path = Path(target_directory, workflow_yaml_path)
         log.debug("Looking for worflow YAML file at: %s" % path)
@@ -523,7 +555,7 @@ def check_and_format_data_file_paths(target_directory, conf, check_exists=True):
             log.error("Cannot find workflow YAML file at %s" % path)
             sys.exit()
         else:
-            MANDATORY_FILES.append(workflow_yaml_path)
+            manifest.add(workflow_yaml_path, payload_manifest.WORKFLOW_YAML, source=path)
         # The fixed file paths
         for filepath in filepaths:
             log.debug(f"File path: {filepath}")
@@ -552,9 +584,8 @@ def check_and_format_data_file_paths(target_directory, conf, check_exists=True):
                 and not path.exists()
             ):
                 log.info("Eggnog emapper summary file is missing")
-                fn = "./functional-annotation/{prefix}.merged.emapper.summary.eggnog"
-                log.debug(f"Removing '{fn} from MANDATORY_FILES")
-                MANDATORY_FILES.remove(fn)
+                log.debug(f"Removing '{filepath} from the payload manifest")
+                manifest.remove(filepath)
                 continue
 
             # And the rest
@@ -566,10 +597,8 @@ def check_and_format_data_file_paths(target_directory, conf, check_exists=True):
                             "Ignoring specified missing file: %s"
                             % os.path.split(filepath)[1]
                         )
-                        parts = list(Path(filepath).parts[:-1])
-                        fn = os.path.join("./", str(Path(*parts, filename)))
-                        log.debug(f"Removed {fn} from MANDATORY_FILES")
-                        MANDATORY_FILES.remove(fn)
+                        log.debug(f"Removed {filepath} from the payload manifest")
+                        manifest.remove(filepath)
                         break
                 else:
                     log.error(
@@ -583,6 +612,7 @@ def check_and_format_data_file_paths(target_directory, conf, check_exists=True):
                     sys.exit()
             else:
                 log.debug("Found %s" % path)
+                manifest.get(filepath).source = path
 
     # There's a single HMM file that needs to be removed
     remove_hmm_chunk_file(target_directory, conf)
@@ -590,6 +620,222 @@ def check_and_format_data_file_paths(target_directory, conf, check_exists=True):
     return conf
 
 
+def set_obs_id_and_env_package(conf):
+    """Parse the source_mat_id to get station name (obs_id) and env_package"""
+    obs_id = conf["source_mat_id"].split("_")[1]
+    conf["obs_id"] = obs_id
+    log.debug(f"obs_id = {obs_id}")
+    ep = conf["source_mat_id"].split("_")[2]
+    if ep == "Wa":
+        env_package  = "water_column"
+        env_package_short = "water"
+    elif ep == "So":
+        env_package  = "soft_sediment"
+        env_package_short = "sediment"
+    else:
+        log.error(f"Unknown env_package {ep} in {conf['source_mat_id']}")
+        sys.exit()
+    conf["env_package_id"] = env_package
+    conf["env_package_short"] = env_package_short
+    log.debug(
+            f"env_package = {env_package}; env_package_short = "
+            f"{env_package_short}"
+        )
+    return conf
+
+
+def sampling_sheet_url(conf):
+    """The transformed "water" or "sediment" sampling sheet of the observatory crate"""
+    return metadata_sources.sampling_sheet_url(conf["obs_id"], conf["env_package_short"])
+
+
+def observatory_sheet_url(conf):
+    """The transformed observatory sheet of the observatory crate"""
+    return metadata_sources.observatory_sheet_url(
+        conf["obs_id"], conf["env_package_short"]
+    )
+
+
+def mgf_run_track_sheet(conf):
+    """The MGF _Run_Track sheet of the sample, either filters or sediments"""
+    if conf["env_package_id"] == "water_column":
+        return "filters"
+    return "sediments"
+
+
+def _prefetch_ena(conf, timeout, retries):
+    """The filereport URL depends on the accession number of the sample"""
+    accession = _ena_accession_to_prefetch(conf["ref_code"], conf["batch_number"])
+    if accession is not None:
+        ena_filereports.filereport(accession, timeout=timeout, retries=retries)
+
+
+def _ena_accession_to_prefetch(ref_code, batch_number):
+    """The accession get_ena_accession_number() will read, or None"""
+    # Batch 3 accessions are UNKNOWN, see get_ena_accession_number()
+    if batch_number == 3:
+        return None
+    return get_db().ena_accession(ref_code, batch_number)
+
+
+def prefetch_ena_filereports(run_ids):
+    """Resolve the ENA filereports of all run_ids in bulk before a batch
+
+    Only the (ref_code, batch_number) accessions the builds will read are
+    prefetched, and none for batch 3.
+    """
+    registry = get_registry()
+    keys = [
+        (sample.ref_code, sample.batch_number)
+        for sample in map(registry.by_run_id, run_ids)
+        if sample is not None and sample.batch_number != 3
+    ]
+    ena_filereports.prefetch(get_db().ena_accessions(keys).values())
+
+
+def prefetch_sample_metadata(conf, timeout=60, retries=3):
+    """Warm the sheet cache with every remote sheet the sample needs
+
+    Once source_mat_id and batch_number are known the URLs are independent of
+    each other, so they are fetched concurrently and resolution takes as long
+    as the slowest request. Failures are only logged here; the parsing stage
+    reports them as before.
+    """
+    conf = set_obs_id_and_env_package(conf)
+    # The run-information, ENA accession and MGF run-track sheets are in the
+    # sample registry database
+    urls = [sampling_sheet_url(conf), observatory_sheet_url(conf)]
+    with ThreadPoolExecutor(max_workers=len(urls) + 1) as pool:
+        futures = {
+            pool.submit(sheet_cache.fetch, url, timeout=timeout, retries=retries): url
+            for url in urls
+        }
+        futures[pool.submit(_prefetch_ena, conf, timeout, retries)] = "ENA metadata"
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.warning(f"Prefetching {futures[future]} failed: {e}")
+    log.debug("Prefetched remote metadata")
+    return conf
+
+
+def resolve_metadata(conf, override_error=False):
+    """Fill conf from the logsheets, MGF run-track, and ENA in one step"""
+    conf = prefetch_sample_metadata(conf)
+    conf = get_metadata_from_station_logsheets(conf, override_error)
+    conf = get_metadata_from_observatory_logsheets(conf)
+    conf = get_ena_accession_number(conf)
+    conf = add_sequence_data_links(conf, override_error)
+    return conf
+
+
+def _sample_ids(conf):
+    """ref_code, prefix, observatory and the ENA accession of a sample"""
+    conf = get_ref_code_and_prefix(conf)
+    conf = set_obs_id_and_env_package(conf)
+    return conf, _ena_accession_to_prefetch(conf["ref_code"], conf["batch_number"])
+
+
+def _sample_metadata(conf, override_error):
+    """The logsheet, MGF run-track and ENA metadata of a sample"""
+    conf = get_metadata_from_station_logsheets(conf, override_error)
+    conf = get_metadata_from_observatory_logsheets(conf)
+    conf = get_ena_accession_number(conf)
+    return add_sequence_data_links(conf, override_error)
+
+
+def _resolve_step(errors, run_id, step, *args):
+    """Run a synchronous resolution step, return (result, None) or (None, error)
+
+    Runs in a worker thread of its own for the duration of the step, so the
+    last error logged by the thread belongs to this sample.
+    """
+    errors.message = None
+    try:
+        return step(*args), None
+    except SystemExit:
+        return None, errors.message or "exited"
+    except Exception as e:
+        log.exception(f"Unexpected error resolving the metadata of {run_id}")
+        return None, f"{type(e).__name__}: {e}"
+
+
+async def _resolve_sample_async(fetcher, run_id, shared_conf, override_error, errors):
+    """Resolve the conf of one sample, return (conf, None) or (None, error)"""
+    conf = dict(shared_conf)
+    conf["run_id"] = run_id
+    # The steps read sheets and the sample database, off the event loop
+    result, error = await asyncio.to_thread(
+        _resolve_step, errors, run_id, _sample_ids, conf
+    )
+    if error is not None:
+        return None, error
+    conf, accession = result
+
+    try:
+        urls = [sampling_sheet_url(conf), observatory_sheet_url(conf)]
+        if accession is not None:
+            urls.append(ena_filereports.filereport_url(accession))
+        for url, result in zip(urls, await fetcher.fetch_all(urls)):
+            if isinstance(result, Exception):
+                log.warning(f"Prefetching {url} for {run_id} failed: {result}")
+    except Exception as e:
+        # Only a warm-up, the sheets are read again below
+        log.warning(f"Prefetching the metadata of {run_id} failed: {e}")
+
+    return await asyncio.to_thread(
+        _resolve_step, errors, run_id, _sample_metadata, conf, override_error
+    )
+
+
+async def _resolve_samples_async(run_ids, shared_conf, override_error, max_concurrency):
+    fetcher = AsyncFetcher(max_concurrency)
+    errors = _LastErrorHandler()
+    log.getLogger().addHandler(errors)
+    try:
+        results = await asyncio.gather(
+            *(
+                _resolve_sample_async(
+                    fetcher, run_id, shared_conf, override_error, errors
+                )
+                for run_id in run_ids
+            )
+        )
+    finally:
+        log.getLogger().removeHandler(errors)
+    log.info(
+        f"Resolved metadata of {len(run_ids)} samples with {fetcher.fetched} "
+        f"distinct requests for {fetcher.requested} sheets"
+    )
+    return results
+
+
+def resolve_samples_metadata(
+    run_ids, shared_conf, override_error=False, max_concurrency=DEFAULT_MAX_CONCURRENCY
+):
+    """Resolve the confs of many samples concurrently
+
+    Covers ref_code/prefix, the station and observatory logsheet rows, the MGF
+    creator and version, the ENA accession and the read links. Sheets shared by
+    samples are requested once, and at most max_concurrency requests are in
+    flight. Returns the list of resolved confs, in run_ids order, and a
+    dictionary of the error message of each run_id that could not be resolved.
+    """
+    results = asyncio.run(
+        _resolve_samples_async(run_ids, shared_conf, override_error, max_concurrency)
+    )
+    confs = []
+    failures = {}
+    for run_id, (conf, error) in zip(run_ids, results):
+        if conf is None:
+            log.error(f"Cannot resolve the metadata of {run_id}: {error}")
+            failures[run_id] = error
+        else:
+            confs.append(conf)
+    return confs, failures
+
+
 def get_metadata_from_observatory_logsheets(conf):
     """
     Parse sample logsheet data from the Observatories logsheet
@@ -603,51 +849,36 @@ def get_metadata_from_observatory_logsheets(conf):
 
     """
 
-    # Observatory sheet:
-    # https://github.com/emo-bon/observatory-rformosa-crate/blob/main/logsheets/transformed/sediment_observatory.csv
-    transformed_observatory_sheet_url = (
-        f"https://raw.githubusercontent.com/emo-bon/"
-        f"observatory-{conf['obs_id'].lower()}-crate/"
-        f"refs/heads/main/logsheets/transformed/"
-        f"{conf['env_package_short']}_observatory.csv"
-        )
-    log.debug(f"Transformed_observatory_url = {transformed_observatory_sheet_url}")
-    # Get the observatory data
-    df_obs = pd.read_csv(transformed_observatory_sheet_url, encoding='iso-8859-1')
-
+    log.debug(f"Transformed_observatory_url = {observatory_sheet_url(conf)}")
     # Get the observatory data using the obs_id and env_package variables
     # There is only one row, but...
-    row_obs = df_obs.loc[
-        (df_obs["obs_id"] == conf["obs_id"])
-        &
-        (df_obs["env_package"] == conf["env_package_short"])
-    ].to_dict()
+    sheet = logsheets.observatory_sheet(conf["obs_id"], conf["env_package_short"])
+    row_obs = sheet.get(conf["obs_id"])
+    if row_obs is None:
+        log.error(f"Cannot find {conf['obs_id']} in the observatory sheet {sheet.url}")
+        sys.exit()
 
     log.debug("Row in observatory sheet: %s" % row_obs)
 
     # Sampling organisation
-    conf["sampling_org"] = list(row_obs["organization"].values())[0]
+    conf["sampling_org"] = row_obs["organization"]
     # Sampling organisation country
-    conf["sampling_org_country"] = list(row_obs["geo_loc_name"].values())[0]
+    conf["sampling_org_country"] = row_obs["geo_loc_name"]
     # Sampling organisation lat/long
-    lat = list(row_obs["latitude"].values())[0]
-    long = list(row_obs["longitude"].values())[0]
+    lat = row_obs["latitude"]
+    long = row_obs["longitude"]
     conf["sampling_org_latlong"] = f"{lat}:{long}"
 
     # https://github.com/emo-bon/observatory-bergen-crate/issues/13
     # Sampling person affiliation
     try:
-        conf["sampling_org_ena_number"] = list(
-            row_obs["ENA_accession_number_project"].values()
-        )[0]
+        conf["sampling_org_ena_number"] = row_obs["ENA_accession_number_project"]
     except KeyError:
-        conf["sampling_org_ena_number"] = list(
-            row_obs["ENA_accesion_number_project"].values()
-        )[0]
+        conf["sampling_org_ena_number"] = row_obs["ENA_accesion_number_project"]
 
     # Sampling person contact name
-    conf["sampling_org_contact_name"] = list(row_obs["contact_name"].values())[0]
-    conf["sampling_org_contact_orcid"] = list(row_obs["contact_orcid"].values())[0]
+    conf["sampling_org_contact_name"] = row_obs["contact_name"]
+    conf["sampling_org_contact_orcid"] = row_obs["contact_orcid"]
 
     log.debug("conf = {conf}")
 
@@ -673,43 +904,18 @@ def get_metadata_from_station_logsheets(conf, overide_error=False):
 
     """
 
-    # Parse the source_mat_id to get station name (obs_id) and env_package
-    obs_id = conf["source_mat_id"].split("_")[1]
-    conf["obs_id"] = obs_id
-    log.debug(f"obs_id = {obs_id}")
-    ep = conf["source_mat_id"].split("_")[2]
-    if ep == "Wa":
-        env_package  = "water_column"
-        env_package_short = "water"
-    elif ep == "So":
-        env_package  = "soft_sediment"
-        env_package_short = "sediment"
-    else:
-        log.error(f"Unknown env_package {ep} in {conf['source_mat_id']}")
-        sys.exit()
-    conf["env_package_id"] = env_package
-    conf["env_package_short"] = env_package_short
-    log.debug(
-            f"env_package = {env_package}; env_package_short = "
-            f"{env_package_short}"
-        )
+    conf = set_obs_id_and_env_package(conf)
 
-    # Pull the sheets from the observatory crates on github
-    # We are looking for the transformed sheets "water" or "sediment"
-    # https://raw.githubusercontent.com/emo-bon/observatory-bpns-crate/refs/heads/main/logsheets/transformed/water_sampling.csv
-    transformed_sheet_url = (
-        f"https://raw.githubusercontent.com/emo-bon/"
-        f"observatory-{obs_id.lower()}-crate/"
-        f"refs/heads/main/logsheets/transformed/{env_package_short}_sampling.csv"
-        )
+    transformed_sheet_url = sampling_sheet_url(conf)
     log.debug(f"Address of transformed sheet: {transformed_sheet_url}")
     # Read the relevant row in sample sheet
     try:
-        df_logsheets = pd.read_csv(transformed_sheet_url) #, encoding='iso-8859-1')
-    except urllib.error.HTTPError:
-        log.error(f"Cannot find the combined logsheets at {transformed_sheet_url}")
+        sheet = logsheets.sampling_sheet(conf["obs_id"], conf["env_package_short"])
+    except requests.RequestException as e:
+        log.error(f"Cannot read the combined logsheets at {transformed_sheet_url}: {e}")
+        sys.exit()
 
-    row_samp = df_logsheets.loc[df_logsheets["source_mat_id"] == conf["source_mat_id"]].to_dict()
+    row_samp = sheet.get(conf["source_mat_id"])
     log.debug("Row in sample sheet: %s" % row_samp)
 
     # Get the env_package either water_column or soft_sediments
@@ -745,56 +951,53 @@ def get_metadata_from_station_logsheets(conf, overide_error=False):
     # conf["sampling_person_station_country"] = list(row_obs["geo_loc_name"].values())[0]
 
     # Add MGF analysis creator_person
-    mgf_path = FILTERS_MGF_PATH if env_package == "water_column" else SEDIMENTS_MGF_PATH
-    data = pd.read_csv(mgf_path, encoding='iso-8859-1').to_dict(orient="records")
     log.debug(f"Looking for ref_code: {conf['ref_code']}")
-    for row in data:
-        if row["ref_code"] == conf["ref_code"]:
-            log.debug("Row in %s: %s" % (mgf_path, row))
-            if row["who"] == "CCMAR":
-                conf["creator_person_name"] = "Cymon J. Cox"
-                conf["creator_person_identifier"] = (
-                    "https://orcid.org/0000-0002-4927-979X"
-                )
-                # conf["creator_person_station_edmoid"] = "2516"
-                # conf["creator_person_station_name"] = (
-                #    "Centre of Marine Sciences (CCMAR)"
-                # )
-                # conf["creator_person_station_country"] = "Portugal"
-            elif row["who"] == "HCMR":
-                conf["creator_person_name"] = "Stelios Ninidakis"
-                conf["creator_person_identifier"] = (
-                    "https://orcid.org/0000-0003-3898-9451"
-                )
-                # conf["creator_person_station_edmoid"] = "141"
-                # conf["creator_person_station_name"] = (
-                #    "Institute of Marine Biology "
-                #    "Biotechnology and Aquaculture (IMBBC) Hellenic Centre "
-                #    "for Marine Research (HCMR)"
-                # )
-                # conf["creator_person_station_country"] = "Greece"
-            else:
-                log.error("Unrecognised creater of MGF data: %s" % row["who"])
-                sys.exit()
-
-            # Metagoflow
-            log.info("MetaGOflow run at: %s" % row["who"])
-            log.info("MetaGOflow version: %s" % row["version"])
-            conf["metagoflow_version_id"] = row["version"]
-            # Hard coding the metagoflow version URL here:
-            if row["version"] == "develop (3cf3a7d)":
-                conf["metagoflow_version"] = (
-                    "https://github.com/emo-bon/MetaGOflow/commit/3cf3a7d39fabc6e75a8cb2971a711c2d781c84d0"
-                )
-            elif row["version"] == "1.0":
-                conf["metagoflow_version"] = (
-                    "https://github.com/emo-bon/MetaGOflow/releases/tag/v1.0.0"
-                )
-            else:
-                log.error("Unrecognised MetaGOflow version: %s" % row["version"])
-                sys.exit()
+    mgf_run = get_db().mgf_run(conf["ref_code"], mgf_run_track_sheet(conf))
+    if mgf_run is not None:
+        who, version = mgf_run
+        log.debug(f"MGF run of {conf['ref_code']}: {mgf_run}")
+        if who == "CCMAR":
+            conf["creator_person_name"] = "Cymon J. Cox"
+            conf["creator_person_identifier"] = (
+                "https://orcid.org/0000-0002-4927-979X"
+            )
+            # conf["creator_person_station_edmoid"] = "2516"
+            # conf["creator_person_station_name"] = (
+            #    "Centre of Marine Sciences (CCMAR)"
+            # )
+            # conf["creator_person_station_country"] = "Portugal"
+        elif who == "HCMR":
+            conf["creator_person_name"] = "Stelios Ninidakis"
+            conf["creator_person_identifier"] = (
+                "https://orcid.org/0000-0003-3898-9451"
+            )
+            # conf["creator_person_station_edmoid"] = "141"
+            # conf["creator_person_station_name"] = (
+            #    "Institute of Marine Biology "
+            #    "Biotechnology and Aquaculture (IMBBC) Hellenic Centre "
+            #    "for Marine Research (HCMR)"
+            # )
+            # conf["creator_person_station_country"] = "Greece"
+        else:
+            log.error("Unrecognised creater of MGF data: %s" % who)
+            sys.exit()
 
-            break
+        # Metagoflow
+        log.info("MetaGOflow run at: %s" % who)
+        log.info("MetaGOflow version: %s" % version)
+        conf["metagoflow_version_id"] = version
+        # Hard coding the metagoflow version URL here:
+        if version == "develop (3cf3a7d)":
+            conf["metagoflow_version"] = (
+                "https://github.com/emo-bon/MetaGOflow/commit/3cf3a7d39fabc6e75a8cb2971a711c2d781c84d0"
+            )
+        elif version == "1.0":
+            conf["metagoflow_version"] = (
+                "https://github.com/emo-bon/MetaGOflow/releases/tag/v1.0.0"
+            )
+        else:
+            log.error("Unrecognised MetaGOflow version: %s" % version)
+            sys.exit()
     else:
         if not overide_error:
             log.error(
@@ -837,21 +1040,15 @@ def get_ena_accession_number(conf):
             )
         return conf
 
-    # Read the relevant row in sample sheet
-    if conf["batch_number"] == 1:
-        df_ena = pd.read_csv(BATCH1_ENA_ACCESSION_INFO_PATH, encoding='iso-8859-1')
-    elif conf["batch_number"] == 2:
-        df_ena = pd.read_csv(BATCH2_ENA_ACCESSION_INFO_PATH, encoding='iso-8859-1')    
-    else:
+    # Look up the sample in the ENA accession sheet of its batch
+    if conf["batch_number"] not in ENA_ACCESSION_INFO_PATHS:
         log.error(f"Batch number not recognised {conf['batch_number']}")
         sys.exit()
-    row_ena = df_ena.loc[df_ena["ref_code"] == conf["ref_code"]].to_dict()
-    # Get the ENA accession data
-    conf["ena_accession_number"] = list(
-        row_ena["ena_accession_number_sample"].values()
-    )[0]
-    # If the ENA accession number is a NaN, exit
-    if pd.isna(conf["ena_accession_number"]):
+    conf["ena_accession_number"] = get_db().ena_accession(
+        conf["ref_code"], conf["batch_number"]
+    )
+    # If the ENA accession number is missing, exit
+    if conf["ena_accession_number"] is None:
         log.error(
             f"Cannot find the ENA accession number for ref_code {conf['ref_code']}\n"
             "This should mean that the sample was not part of Batch 1 or 2\n"
@@ -876,30 +1073,31 @@ def add_sequence_data_links(conf, override_error=False):
         log.debug(f"forward and reverse_reads_links = UNKNOWN")
         return conf
 
-    # ENA ACCESSION filereport for sample
-    filereport_url = (
-        "https://www.ebi.ac.uk/ena/portal/api/filereport?accession={ena_accession_number}"
-        "&result=read_run&fields=submitted_ftp&format=json&download=true&limit=-1"
+    # ENA ACCESSION filereport for sample, resolved in bulk in batch mode
+    log.debug(
+        f"ENA filereport URL: {ena_filereports.filereport_url(conf['ena_accession_number'])}"
     )
-    log.debug(f"ENA filereport URL: {filereport_url.format(**conf)}")
-    filereport = requests.get(filereport_url.format(**conf))
-    filereport_json = filereport.json()
-    if filereport.status_code == requests.codes.ok and filereport_json:
+    try:
+        filereport_json = ena_filereports.filereport(conf["ena_accession_number"])
+        filereport_error = None
+    except (requests.RequestException, ValueError) as e:
+        filereport_json = None
+        filereport_error = e
+    if filereport_json:
         log.debug(f"ENA filereport: {filereport_json}")
         # Get the FTP links to the raw sequence data
-        links = filereport_json[0]["submitted_ftp"].split(";")
-        if len(links) != 2:
-            log.error("Cannot find the 2 raw sequence data links in the ENA filereport")
+        try:
+            forward, reverse = ena_filereports.sequence_links(filereport_json)
+        except ValueError as e:
+            log.error(str(e))
             sys.exit()
         # Add the links to the conf dictionary
-        conf["forward_reads_link"] = f"https://{links[0]}"
-        conf["reverse_reads_link"] = f"https://{links[1]}"
+        conf["forward_reads_link"] = forward
+        conf["reverse_reads_link"] = reverse
         log.info("ENA raw sequence data links added to conf")
     else:
         if not override_error:
-            log.error(
-                "Cannot get the ENA filereport: exit code %s" % filereport.status_code
-            )
+            log.error("Cannot get the ENA filereport: %s" % filereport_error)
             log.error("Filereport: %s" % filereport_json)
             log.error("Raw sequence data are not available from ENA")
             log.error("Use override_error flag to bypass this error")
@@ -912,90 +1110,79 @@ def add_sequence_data_links(conf, override_error=False):
     return conf
 
 
-def write_metadata_json(
-    target_directory, conf, without_sequence_data=False, override_error=False
-):
+@functools.cache
+def _read_template():
     metadata_json_template = "ro-crate-metadata.json-template"
     if os.path.exists(metadata_json_template):
         log.debug("Using local metadata.json template")
-        with open(metadata_json_template, "r") as f:
-            template = json.load(f)
+        with open(metadata_json_template, "rb") as f:
+            source = f.read()
     else:
         # Grab the template from Github
         log.debug("Downloading metadata.json template from Github")
-        req = requests.get(TEMPLATE_URL)
-        if req.status_code == requests.codes.ok:
-            template = req.json()
-        else:
+        try:
+            source = sheet_cache.fetch(TEMPLATE_URL)
+        except requests.RequestException:
             log.error("Unable to download the metadata.json file from Github")
             log.error(f"Check {TEMPLATE_URL}")
             log.error("Exiting...")
             sys.exit()
+    try:
+        return CrateTemplate.compile(source)
+    except ValueError as e:
+        log.error(f"Cannot parse the metadata.json template: {e}")
+        sys.exit()
 
-    log.info("Writing ro-crate-metadata.json...")
 
-    # Add strings first
-    # Add "ref_code"'s to "name", "title", and "description" fields
-    template["@graph"][1]["name"] = template["@graph"][1]["name"].format(**conf)
-    template["@graph"][1]["description"] = template["@graph"][1]["description"].format(
-        **conf
-    )
+def load_template():
+    """Return the compiled metadata.json template, compiled once per process"""
+    return _read_template()
 
-    # Add date to "datePublished"
-    if "date_published" in conf:
-        template["@graph"][1]["datePublished"] = template["@graph"][1][
-            "date_published"
-        ].format(**conf)
-    else:
-        template["@graph"][1]["datePublished"] = datetime.datetime.now().strftime(
-            "%Y-%m-%d"
-        )
 
-    # Deal with the hasMember stanzas
-    for section in template["@graph"]:
-        if section["@id"] == "./":
-            for member in section["pcdm:hasMember"]:
-                if member["@id"] == "{ena_accession_number_url}":
-                    member["@id"] = member["@id"].format(**conf)
-                elif member["@id"] == "{metagoflow_version}":
-                    member["@id"] = member["@id"].format(**conf)
-                else:
-                    log.error("Cannot find the hasMember stanzas")
-                    sys.exit()
-    # Add metadGOflow version id
-    for section in template["@graph"]:
-        if section["@id"] == "{metagoflow_version}":
-            section["@id"] = section["@id"].format(**conf)
-            section["softwareVersion"] = section["softwareVersion"].format(**conf)
-            section["downloadUrl"] = section["downloadUrl"].format(**conf)
-            break
-    else:
+def write_metadata_json(
+    target_directory, conf, manifest, without_sequence_data=False, override_error=False
+):
+    log.info("Writing ro-crate-metadata.json...")
+
+    # Substitute every placeholder of the template in one pass, including
+    # "ref_code"'s in "name", "title", and "description" fields, the ENA and
+    # raw sequence data links, and the MetaGOflow version
+    values = dict(conf)
+    # Add date to "datePublished"
+    values["datePublished"] = conf.get(
+        "date_published", datetime.datetime.now().strftime("%Y-%m-%d")
+    )
+    try:
+        template = load_template().render(values)
+    except KeyError as e:
+        log.error(f"No value for the metadata.json template placeholder {e}")
+        sys.exit()
+    # Stanzas are looked up by @id and inserted next to each other from here on
+    graph = template["@graph"] = CrateGraph(template["@graph"])
+    root = graph["./"]
+
+    # Check the hasMember stanzas
+    for member in root["pcdm:hasMember"]:
+        if member["@id"] not in [
+            conf["ena_accession_number_url"],
+            conf["metagoflow_version"],
+        ]:
+            log.error("Cannot find the hasMember stanzas")
+            sys.exit()
+    # Check metadGOflow version id
+    if conf["metagoflow_version"] not in graph:
         log.error("Cannot find the MetaGOflow version stanza")
         sys.exit()
 
-    # Add ena_accession_number to the field
-    for stanza in template["@graph"]:
-        # Not yet formatted
-        if stanza["@id"] == "{ena_accession_number_url}":
-            stanza["@id"] = stanza["@id"].format(**conf)
-            stanza["name"] = stanza["name"].format(**conf)
-            stanza["downloadUrl"] = stanza["downloadUrl"].format(**conf)
-            continue
-        # Add the raw sequence data links
-        elif stanza["@id"] in ["{forward_reads_link}", "{reverse_reads_link}"]:
-            stanza["@id"] = stanza["@id"].format(**conf)
-            stanza["description"] = stanza["description"].format(**conf)
-            stanza["downloadUrl"] = stanza["downloadUrl"].format(**conf)
-            stanza["subjectOf"] = stanza["subjectOf"]["@id"].format(**conf)
-        # Format external ro-crate stanzas
-        elif stanza["@id"].startswith("https://data.emobon.embrc.eu"):
-            stanza["name"] = stanza["name"].format(**conf)
+    # The raw sequence data links are the subjectOf the ENA accession
+    for link in [conf["forward_reads_link"], conf["reverse_reads_link"]]:
+        if link in graph:
+            stanza = graph[link]
+            stanza["subjectOf"] = stanza["subjectOf"]["@id"]
 
     # creator  - the MGF data creator and institution
     # "creator": {}
-    template["@graph"][1]["creator"] = template["@graph"][1]["creator"] = dict(
-        [("@id", f"{conf['creator_person_identifier']}")]
-    )
+    root["creator"] = dict([("@id", f"{conf['creator_person_identifier']}")])
 
     # Add creater person stanza
     person_stanza = dict(
@@ -1005,13 +1192,10 @@ def write_metadata_json(
             ("name", f"{conf['creator_person_name']}"),
         ]
     )
-    template["@graph"].insert(5, person_stanza)
+    graph.insert_at(5, person_stanza)
 
     # Add eggnog summary file if present
-    if (
-        "./functional-annotation/{prefix}.merged.emapper.summary.eggnog"
-        in MANDATORY_FILES
-    ):
+    if "./functional-annotation/{prefix}.merged.emapper.summary.eggnog" in manifest:
         log.info("Adding Eggnog emapper summary stanza to graph")
         eggnog_summary = dict(
             [
@@ -1026,40 +1210,76 @@ def write_metadata_json(
                 ("encodingFormat", "text/plain"),
             ]
         )
-        for stanza in template["@graph"]:
-            if stanza["@id"] == "./functional-annotation/":
-                fn = f"./functional-annotation/{conf['prefix']}.merged.emapper.summary.eggnog"
-                stanza["hasPart"].append(dict([("@id", fn)]))
-                break
-        else:
+        if "./functional-annotation/" not in graph:
             log.error("Cannot find the functional-annotation stanza")
             sys.exit()
+        fn = f"./functional-annotation/{conf['prefix']}.merged.emapper.summary.eggnog"
+        graph.add_parts("./functional-annotation/", [fn])
         # Add the eggnog summary stanza to the graph before the sequence categorisation stanzas
-        for i, stanza in enumerate(template["@graph"]):
-            if stanza["@id"] == "./sequence-categorisation/":
-                template["@graph"].insert(i, eggnog_summary)
-                log.debug(f"Added eggnog summary stanza at index {i}")
-                break
+        if "./sequence-categorisation/" in graph:
+            graph.insert_before("./sequence-categorisation/", eggnog_summary)
+            log.debug("Added eggnog summary stanza before sequence-categorisation")
     # Add sequence_categorisation stanza separately as they can vary in number and identity
-    template = sequence_categorisation_stanzas(target_directory, template, conf)
+    template = sequence_categorisation_stanzas(
+        target_directory, template, conf, manifest
+    )
     # Add sequence data stanzas
     if not without_sequence_data:
-        template = add_sequence_data_stanzas(target_directory, template, conf)
+        template = add_sequence_data_stanzas(target_directory, template, conf, manifest)
 
     log.info("Metadata (first part) JSON written")
     return template
 
 
-def write_dvc_upload_script(conf):
+def add_payload_to_dvc(new_archive_path, conf, manifest):
+    """Hash the payload files in parallel and add them to DVC, as dvc add does
+
+    Records the md5 and size of each file in the manifest. The .dvc stubs and
+    .gitignore files are staged in git if core.autostage is set in the DVC
+    config, as dvc add would, otherwise they must be staged by hand before the
+    git commit.
+    """
+    repo = DvcRepo(conf["ro_crate_repository"])
+    paths = {Path(new_archive_path, f.crate_path): f for f in manifest}
+    log.info(f"Adding {len(paths)} payload files to DVC...")
+    try:
+        for path, md5, size in repo.add_all(paths):
+            payload_file = paths[path]
+            payload_file.digest = md5
+            payload_file.size = size
+        if repo.autostage:
+            # git locks its index, like DVC the repository
+            with _DVC_LOCK:
+                staged = repo.stage(paths)
+            log.info(f"Staged {len(staged)} .dvc and .gitignore files in git")
+        else:
+            log.info(
+                "core.autostage is not set in the DVC config: git add the .dvc"
+                " and .gitignore files of the crate before committing"
+            )
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.error(f"Cannot add the payload files to DVC: {e}")
+        sys.exit()
+    finally:
+        repo.close()
+    log.info(
+        f"Added {len(paths)} payload files to DVC"
+        f" ({repo.hash_cache.hits} unchanged since they were last hashed)"
+    )
+
+
+def write_dvc_upload_script(conf, manifest):
     """Write the DVC S3 and Github upload script
     
     s5cmd --profile eosc-fairease1 \
         --endpoint-url https://s3.mesocentre.uca.fr ls s3://mgf-data-products/
     
     Note that DVC is auto-staging files added using dvc add, so just need a dvc push
-    and later git commit
+    and later git commit. Files already added with add_payload_to_dvc() (those
+    with a digest in the manifest) are not added again: their stubs are only
+    staged if core.autostage is set in the DVC config.
     """
-    log.debug(f"MANDATORY_FILES = {MANDATORY_FILES}")
+    log.debug(f"Payload manifest = {manifest}")
     upload_script_path = Path(conf["ro_crate_repository"], f"{conf['source_mat_id']}_upload.sh")
     with open(upload_script_path, "w") as f:
         f.write("#!/bin/bash\n")
@@ -1073,16 +1293,11 @@ def write_dvc_upload_script(conf):
         f.write("\n")
 
         # Add the DVC commands
-        for fp in MANDATORY_FILES:
-            log.debug(f"fp filepath = {fp}")
-            if fp == "./RNA-counts":
-                np = Path(
-                    conf["source_mat_id"],
-                    "taxonomy-summary",
-                    fp.format(**conf),
-                )
-            else:
-                np = Path(conf["source_mat_id"], fp.format(**conf))
+        for payload_file in manifest:
+            log.debug(f"fp filepath = {payload_file.path}")
+            if payload_file.digest:
+                continue
+            np = Path(conf["source_mat_id"], payload_file.crate_path)
             f.write(f"dvc add {np}\n")
 
         f.write("\n")
@@ -1092,17 +1307,47 @@ def write_dvc_upload_script(conf):
     return upload_script_path
 
 
+def upload_payload_to_s3(s3_uploader, new_archive_path, conf, manifest):
+    """Upload the payload added to DVC straight to the DVC remote
+
+    What is uploaded is recorded in the upload journal of the crate, so a
+    build run again after a failed upload only sends what is missing.
+    """
+    files = [
+        (Path(new_archive_path, f.crate_path), f.digest) for f in manifest if f.digest
+    ]
+    journal = s3_upload.UploadJournal(
+        s3_upload.journal_path(conf["ro_crate_repository"], new_archive_path)
+    )
+    try:
+        s3_uploader.upload_all(files, journal)
+    except Exception as e:
+        log.error(f"Error whilst uploading the payload to S3: {e}")
+        log.error("Exiting...")
+        sys.exit()
+    finally:
+        journal.close()
+
+
+# DVC locks the repository and git its index, so builds running at the same
+# time take turns
+_DVC_LOCK = threading.Lock()
+
+
 def run_dvc_upload_script(upload_script_path, conf):
     """Run the DVC upload script"""
-    # First move to the ro-crate directory
-    cwd_dir = Path.cwd()
+    # Run it in the ro-crate directory
     upload_script = Path(upload_script_path).name
-    os.chdir(conf["ro_crate_repository"])
     cmd = f"bash {upload_script}"
-    child = subprocess.Popen(
-        str(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True
-    )
-    stdoutdata, stderrdata = child.communicate()
+    with _DVC_LOCK:
+        child = subprocess.Popen(
+            str(cmd),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=True,
+            cwd=conf["ro_crate_repository"],
+        )
+        stdoutdata, stderrdata = child.communicate()
     return_code = child.returncode
     if return_code != 0:
         log.error("Error whilst trying to run the upload script")
@@ -1111,54 +1356,49 @@ def run_dvc_upload_script(upload_script_path, conf):
         log.error("Return code: %s" % return_code)
         log.error("Exiting...")
         sys.exit()
-    os.chdir(cwd_dir)
 
 
-def move_files_out_of_results(new_archive_path, without_sequence_data=False):
+def move_files_out_of_results(new_archive_path, manifest, without_sequence_data=False):
     """Move files from results to the parent directory, ro-crate root
 
-    Also remove chunk lists from functional-annotation so that dirs can be copied
-    as is to the RO-Crate
+    Also remove the files the extraction policy discards (chunk lists, QC
+    subsets, temp...) so that dirs can be copied as is to the RO-Crate. Archives
+    opened by prepare_data.py have none left.
     """
     src_path = new_archive_path / "results"
-    # Check for chunk lists in functional-annotation
-    chunks_path = src_path / "functional-annotation" / "*.chunks"
-    for cl in list(chunks_path.glob("*")):
-        log.debug(f"Removing chunk list: {cl}")
-        cl.unlink()
+    ExtractionPolicy().prune(src_path).log()
 
     # grabs all files and dirs in results
     # not recursive: good! we can move the dirs as is
-    for fp in src_path.glob("*"):
+    entries = list(src_path.glob("*"))
+    files = [fp.name for fp in entries if fp.is_file()]
+
+    # The top level files go to the crate root, and so do the sequence data
+    # files of the payload unless they are left out
+    kinds = {"root": RESULTS_ROOT_FILES}
+    if not without_sequence_data:
+        kinds["payload"] = [
+            f.name
+            for f in manifest
+            if f.path == f"./{f.name}" and f.name not in RESULTS_ROOT_FILES
+        ]
+    classification = FileClassifier.from_literals(kinds).classify_all(files)
+    log.debug(f"Files in results: {classification.by_kind()}")
+    if not without_sequence_data and classification.unmatched:
+        # Report them all before moving anything
+        for name in classification.unmatched:
+            log.error("Could not deal with file: %s" % Path(src_path, name))
+        sys.exit()
+
+    trg_path = src_path.parent  # gets the parent of the folder
+    for fp in entries:
         log.debug(f"File in results glob: {fp}")
         if fp.is_dir():
-            trg_path = src_path.parent  # gets the parent of the folder
             log.debug(f"Moving dir {fp} to {trg_path.joinpath(fp.name)}")
             fp.rename(trg_path.joinpath(fp.name))  # moves to parent folder.
-
-        # Note that:
-        # Path("./RNA-counts").name not in ["./RNA-counts"]
-        elif fp.is_file():
-            # Only move the top level files
-            if fp.name in ["fastp.html", "RNA-counts"]:
-                trg_path = src_path.parent
-                log.debug(f"Moving file {fp} to {trg_path.joinpath(fp.name)}")
-                fp.rename(trg_path.joinpath(fp.name))
-                continue
-            if not without_sequence_data:
-                # Move all files to the parent directory incl sequence data files
-                nfp = os.path.join("./", str(fp.name))
-                log.debug(f"Is_file: new file path = {nfp}")
-                log.debug(
-                    f"New file path in MANDATORY_FILES = {nfp in MANDATORY_FILES  }"
-                )
-                if nfp in MANDATORY_FILES:
-                    trg_path = src_path.parent
-                    log.debug("Moving file {fp} to {trg_path.joinpath(fp.name)}")
-                    fp.rename(trg_path.joinpath(fp.name))
-                else:
-                    log.error("Could not deal with file: %s" % fp)
-                    sys.exit()
+        elif fp.name in classification.matched:
+            log.debug(f"Moving file {fp} to {trg_path.joinpath(fp.name)}")
+            fp.rename(trg_path.joinpath(fp.name))
 
     # Move RNA-counts into the taxonomy-summary directory
     old_path = new_archive_path.joinpath("RNA-counts")
@@ -1228,31 +1468,28 @@ def remove_data_files_from_ro_crate(ro_crate_name):
 
 
 def format_file_ids_and_add_download_links(
-    metadata_json, new_archive_path, conf, format_download_links=False
+    metadata_json, new_archive_path, conf, manifest, format_download_links=False
 ):
     """Format the file @ids with .dvc and add the download links
     to the metadata.json file from the DVC files
-    """
-
-    # Make a path dict from the MANDATONY_FILES
-    pd = {}
-    for f in MANDATORY_FILES:
-        pd[Path(f).name.format(**conf)] = f.format(**conf)
-    log.debug(f"pd = {pd}")
 
+    Returns the metadata, ready to serialize with crate_json
+    """
 
-    # Note that the @ids in the stanza and hasParts are qualified
-    for stanza in metadata_json["@graph"]:
-        stanza["@id"] = stanza["@id"].format(**conf)
-        log.debug(f"stanza @id = {stanza["@id"].format(**conf)}")
+    # Note that the @ids in the stanza and hasParts are qualified, and were
+    # formatted when the template was rendered
+    graph = metadata_json["@graph"]
+    # Read only if a payload file was not added to DVC in this process
+    stubs = None
+    hash_cache = None
+    for stanza in graph:
+        log.debug(f"stanza @id = {stanza["@id"]}")
 
         if "hasPart" in stanza:
             log.debug(f"in hasPart stanza @id = {stanza["@id"]}")
             log.debug(f"stanza hasPart = {stanza["hasPart"]}")
             for entry in stanza["hasPart"]:
-                formatted_entry = entry["@id"].format(**conf)
-                entry["@id"] = formatted_entry
-                log.debug(f"Formatting entry @id = {formatted_entry}")
+                log.debug(f"Formatted entry @id = {entry["@id"]}")
 
                 # # Deal with RNA-counts separately
                 # if entry["@id"] == "./taxonomy-summary/RNA-counts":
@@ -1274,23 +1511,38 @@ def format_file_ids_and_add_download_links(
                 stype == "File" or (isinstance(stype, list) and "File" in stype)
             ):
                 log.debug("In @type File stanza")
-                if stanza["@id"] == "./taxonomy-summary/RNA-counts":
-                    fn = Path(new_archive_path, "taxonomy-summary", "RNA-counts.dvc")
                 #Ignore the links to the raw seq data in ENA
-                elif "_clean.fastq.gz" in stanza["@id"]:
+                if "_clean.fastq.gz" in stanza["@id"]:
                     continue
                 # ENA Accessions numbers unknown
                 elif "URL unknown" in stanza["@id"]:
                     continue
-                else:
-                    # Remove the ./ from the @id
-                    key = Path(stanza["@id"]).name
-                    log.debug(f"Path(stanza['@id']).name = {key}")
-                    fn = Path(new_archive_path, pd[key] + ".dvc")
-                if not fn.exists():
+                # The @id is the path of the file in the crate
+                payload_file = manifest.by_crate_path(stanza["@id"])
+                if payload_file is None:
+                    log.error(f"No payload file for the stanza {stanza['@id']}")
+                    sys.exit()
+                payload_file.stanza = stanza["@id"]
+                # The md5 and size from add_payload_to_dvc(), or else from the
+                # DVC file, or the hash cache if the file has none
+                md5, fsize = payload_file.digest, payload_file.size
+                if not md5 or fsize is None:
+                    if stubs is None:
+                        stubs = stub_index(new_archive_path)
+                    stub_md5, stub_size = stubs.get(payload_file.crate_path, (None, None))
+                    md5 = md5 or stub_md5
+                    fsize = stub_size if fsize is None else fsize
+                if not md5:
+                    if hash_cache is None:
+                        hash_cache = HashCache.for_repo(conf["ro_crate_repository"])
+                    md5 = hash_cache.lookup(
+                        Path(new_archive_path, payload_file.crate_path)
+                    )
+                if not md5:
+                    fn = Path(new_archive_path, payload_file.crate_path + ".dvc")
                     log.error(f"Cannot find the file {fn}")
                     sys.exit()
-                md5 = yaml.safe_load(open(fn))["outs"][0]["md5"]
+                payload_file.digest = md5
                 link_template = "{s3_endpoint}/{bucket_name}/files/md5"
                 md5_link = os.path.join(
                     link_template.format(
@@ -1303,15 +1555,19 @@ def format_file_ids_and_add_download_links(
                 stanza["downloadUrl"] = f"{md5_link}"
 
                 # Add contentSize
-                fp = Path(new_archive_path, pd[key])
-                fsize = os.path.getsize(fp)
+                fp = Path(new_archive_path, payload_file.crate_path)
+                if fsize is None:
+                    fsize = os.path.getsize(fp)
+                payload_file.size = fsize
                 stanza["contentSize"] = f"{fsize}"
                 log.debug(f"Adding contentSize {fsize} to {fp}")
 
-    return json.dumps(metadata_json, indent=4)
+    if hash_cache is not None:
+        hash_cache.close()
+    return {**metadata_json, "@graph": graph.to_list()}
 
 
-def run_arup(target_directory, conf):
+def run_arup(target_directory, conf, manifest):
     """
     Run the ARUP and build the 3 turtle files
     """
@@ -1349,35 +1605,56 @@ def run_arup(target_directory, conf):
     }
     log.debug("ARUP config: %s" % arup_config)
     arup_main(arup_config, Path(target_directory))
-    # Add the turtle files to the MANDATORY_FILES list
-    MANDATORY_FILES.extend(
-        [
-            "./functional-annotation/functional-annotation.ttl",
-            "./taxonomy-summary/LSU/LSU-taxonomy-summary.ttl",
-            "./taxonomy-summary/SSU/SSU-taxonomy-summary.ttl",
-        ]
-    )
+    # Add the turtle files to the payload manifest
+    for fn in [
+        "./functional-annotation/functional-annotation.ttl",
+        "./taxonomy-summary/LSU/LSU-taxonomy-summary.ttl",
+        "./taxonomy-summary/SSU/SSU-taxonomy-summary.ttl",
+    ]:
+        manifest.add(
+            fn, payload_manifest.ARUP, source=Path(target_directory, "results", fn)
+        )
 
 
-def main(
+def load_shared_conf(yaml_config):
+    """Read the YAML configuration and the DVC remote of the ro-crate repository
+
+    These are the same for every sample built with the same YAML configuration
+    """
+    # Read the YAML configuration
+    log.debug("Reading YAML configuration...")
+    conf = read_yaml(yaml_config)
+
+    # Get the bucket name
+    dvc_conf = configparser.ConfigParser()
+    dvc_conf.read(Path(conf["ro_crate_repository"], ".dvc/config"))
+    conf["bucket_name"] = dvc_conf['\'remote "myremote"\'']['url'].split("//")[1]
+    conf["s3_endpoint"] = dvc_conf['\'remote "myremote"\'']['endpointurl'] 
+    log.info(f"RO-Crate repository: {conf['ro_crate_repository']}")
+    log.info(f"S3 endpoint: {conf['s3_endpoint']}")
+    log.info(f"Bucket name: {conf['bucket_name']}")
+    return conf
+
+
+def build_ro_crate(
     target_directory,
-    yaml_config,
-    debug,
+    shared_conf,
     upload_dvc=False,
     without_sequence_data=False,
     override_error=False,
+    resolved_conf=None,
+    compact=False,
+    s3_uploader=None,
 ):
-    """ """
-    # Logging
-    if debug:
-        log_level = log.DEBUG
-    else:
-        log_level = log.INFO
-    log.basicConfig(format="\t%(levelname)s: %(message)s", level=log_level)
+    """Build the ro-crate of a single MGF results archive
 
-    # Read the YAML configuration
-    log.debug("Reading YAML configuration...")
-    conf = read_yaml(yaml_config)
+    resolved_conf is the conf of the sample from resolve_samples_metadata(),
+    otherwise the metadata are resolved here. With compact the
+    ro-crate-metadata.json is written without indentation. With upload_dvc and
+    an s3_uploader the payload is uploaded with it rather than dvc push.
+    Returns the payload manifest.
+    """
+    conf = dict(resolved_conf or shared_conf)
 
     # Check the target_directory name
     if not os.path.exists(target_directory):
@@ -1391,45 +1668,40 @@ def main(
         log.error("It needs to match the format HWLTKDRXY.UDI210")
         log.error("Exiting...")
         sys.exit()
+    if resolved_conf and resolved_conf["run_id"] != run_id:
+        log.error(f"Resolved metadata of {resolved_conf['run_id']} given for {run_id}")
+        sys.exit()
     conf["run_id"] = run_id
 
     # Get the emo bon ref_code, batch number, and prefix
-    conf = get_ref_code_and_prefix(conf)
+    if not resolved_conf:
+        conf = get_ref_code_and_prefix(conf)
 
-    # Get the bucket name
-    dvc_conf = configparser.ConfigParser()
-    dvc_conf.read(Path(conf["ro_crate_repository"], ".dvc/config"))
-    conf["bucket_name"] = dvc_conf['\'remote "myremote"\'']['url'].split("//")[1]
-    conf["s3_endpoint"] = dvc_conf['\'remote "myremote"\'']['endpointurl'] 
-    log.info(f"RO-Crate repository: {conf['ro_crate_repository']}")
-    log.info(f"S3 endpoint: {conf['s3_endpoint']}")
-    log.info(f"Bucket name: {conf['bucket_name']}")
-    
     # Check that an archive with the same name does not already exist
     ro_crate_name = Path(conf["ro_crate_repository"], conf["source_mat_id"] + "-ro-crate")
     if os.path.exists(ro_crate_name):
         log.error(f"An archive with the name {ro_crate_name} already exists")
         sys.exit()
 
+    # The payload of this build, extended as the build goes on
+    manifest = PayloadManifest(conf, MANDATORY_FILES)
+
     # Check all files are present
     log.info("Checking data files...")
-    # filepaths includes the seq_cat files
-    check_and_format_data_file_paths(target_directory, conf, check_exists=True)
+    check_and_format_data_file_paths(target_directory, conf, manifest, check_exists=True)
 
     # Build the conf dictionary
-    conf = get_metadata_from_station_logsheets(conf, override_error)
-    conf = get_metadata_from_observatory_logsheets(conf)
-    conf = get_ena_accession_number(conf)
-    conf = add_sequence_data_links(conf, override_error)
+    if not resolved_conf:
+        conf = resolve_metadata(conf, override_error)
     log.debug("Conf dict: %s" % conf)
 
     # Run ARUP
     log.info("Running ARUP...")
-    run_arup(target_directory, conf)
+    run_arup(target_directory, conf, manifest)
 
     # Create the metadata.json file but dont write yet, need to add links later
     metadata_json = write_metadata_json(
-        target_directory, conf, without_sequence_data, override_error
+        target_directory, conf, manifest, without_sequence_data, override_error
     )
 
     # Note: we need to move the archive into the ro-crate repo directory before
@@ -1458,13 +1730,22 @@ def main(
     # and remove the results directory and files not in the RO-Crate
     log.info("Reconfiguring the results directory...")
     move_files_out_of_results(
-        new_archive_path, without_sequence_data=without_sequence_data
+        new_archive_path, manifest, without_sequence_data=without_sequence_data
     )
 
+    # Add the payload to DVC in process, so the upload script only pushes
+    if upload_dvc:
+        add_payload_to_dvc(new_archive_path, conf, manifest)
+
     # Write the S3 and Github upload script
-    upload_script_path = write_dvc_upload_script(conf)
+    upload_script_path = write_dvc_upload_script(conf, manifest)
     log.debug(f"Written upload script to {upload_script_path}")
-    if upload_dvc:
+    if upload_dvc and s3_uploader:
+        log.info("Uploading the payload to S3...")
+        upload_payload_to_s3(s3_uploader, new_archive_path, conf, manifest)
+        log.info("S3 upload completed without error")
+        os.remove(upload_script_path)
+    elif upload_dvc:
         log.info("Running DVC upload script...")
         run_dvc_upload_script(upload_script_path, conf)
         log.info("DVC upload script completed without error")
@@ -1475,16 +1756,16 @@ def main(
     # OK now we can write the URLs to the metadata.json file
     log.info("Adding download links to metadata.json...")
     format_download_links = True if upload_dvc else False
-    metadata_json_formatted = format_file_ids_and_add_download_links(
+    metadata = format_file_ids_and_add_download_links(
         metadata_json,
         new_archive_path,
         conf,
+        manifest,
         format_download_links=format_download_links,
     )
     metadata_path = Path(new_archive_path, "ro-crate-metadata.json")
     log.info(f"Writing {metadata_path}")
-    with open(metadata_path, "w") as outfile:
-        outfile.write(metadata_json_formatted)
+    crate_json.write(metadata, metadata_path, compact=compact)
 
     # Rename new ro-crate
     Path(conf["ro_crate_repository"], conf["source_mat_id"]).rename(ro_crate_name)
@@ -1495,7 +1776,219 @@ def main(
     if upload_dvc:
         remove_data_files_from_ro_crate(ro_crate_name)
     log.info(f"{ro_crate_name} written without error")
+    return manifest
+
+
+class _LastErrorHandler(log.Handler):
+    """Remember the last error logged by each thread, to explain a failed sample"""
+
+    def __init__(self):
+        super().__init__(level=log.ERROR)
+        self._local = threading.local()
+
+    @property
+    def message(self):
+        return getattr(self._local, "message", None)
+
+    @message.setter
+    def message(self, value):
+        self._local.message = value
+
+    def emit(self, record):
+        self.message = record.getMessage()
+
+
+def _set_up(debug, cache_ttl, metadata_snapshot=None, jobs=1):
+    # Logging
+    if debug:
+        log_level = log.DEBUG
+    else:
+        log_level = log.INFO
+    if jobs > 1:
+        # Builds running at the same time log under their run_id
+        log_format = "\t%(levelname)s: [%(threadName)s] %(message)s"
+    else:
+        log_format = "\t%(levelname)s: %(message)s"
+    log.basicConfig(format=log_format, level=log_level)
+
+    # Remote sheets are served from the on-disk cache within the TTL
+    sheet_cache.configure(ttl=cache_ttl)
+    # ...or all of them from a snapshot bundle, without network access
+    if metadata_snapshot:
+        if not os.path.exists(metadata_snapshot):
+            log.error(f"Cannot find the metadata snapshot {metadata_snapshot}")
+            sys.exit()
+        try:
+            sheet_cache.use_snapshot(metadata_snapshot)
+        except ValueError as e:
+            log.error(e)
+            sys.exit()
+
+
+def _s3_uploader(shared_conf, part_size, concurrency):
+    """The native S3 uploader for the DVC remote of the ro-crate repository"""
+    try:
+        remote = s3_upload.read_dvc_remote(shared_conf["ro_crate_repository"])
+        return s3_upload.S3Uploader(remote, part_size, concurrency)
+    except (ValueError, RuntimeError) as e:
+        log.error(e)
+        sys.exit()
+
+
+def main(
+    target_directory,
+    yaml_config,
+    debug,
+    upload_dvc=False,
+    without_sequence_data=False,
+    override_error=False,
+    cache_ttl=None,
+    metadata_snapshot=None,
+    compact=False,
+    s3_upload_options=None,
+):
+    """Build the ro-crate of one MGF results archive
+
+    s3_upload_options, the (part_size, concurrency) of the native S3 upload,
+    replaces dvc push with it.
+    """
+    _set_up(debug, cache_ttl, metadata_snapshot)
+    shared_conf = load_shared_conf(yaml_config)
+    s3_uploader = None
+    if upload_dvc and s3_upload_options:
+        s3_uploader = _s3_uploader(shared_conf, *s3_upload_options)
+    build_ro_crate(
+        target_directory,
+        shared_conf,
+        upload_dvc,
+        without_sequence_data,
+        override_error,
+        compact=compact,
+        s3_uploader=s3_uploader,
+    )
+    if s3_uploader:
+        s3_uploader.close()
+    sheet_cache.log_stats()
+    http_client.log_stats()
+    log.info("Done.\n\n")
+
+
+def batch_main(
+    prepared_archives,
+    yaml_config,
+    debug,
+    upload_dvc=False,
+    without_sequence_data=False,
+    override_error=False,
+    cache_ttl=None,
+    run_ids=None,
+    metadata_snapshot=None,
+    max_concurrency=DEFAULT_MAX_CONCURRENCY,
+    jobs=1,
+    compact=False,
+    s3_upload_options=None,
+):
+    """Build the ro-crates of all archives in a prepared_archives directory
+
+    If run_ids is given only those archives are built. The YAML configuration,
+    DVC remote, run-information sheets and crate template are loaded once, the
+    metadata of all samples are resolved concurrently before building, and a
+    failing sample does not stop the batch. Up to jobs crates are built at the
+    same time, each with its own payload manifest. With s3_upload_options all
+    of them upload through one native S3 uploader.
+    """
+    _set_up(debug, cache_ttl, metadata_snapshot, jobs)
+    shared_conf = load_shared_conf(yaml_config)
+    s3_uploader = None
+    if upload_dvc and s3_upload_options:
+        s3_uploader = _s3_uploader(shared_conf, *s3_upload_options)
+
+    if not os.path.isdir(prepared_archives):
+        log.error(f"Cannot find the prepared archives directory {prepared_archives}")
+        sys.exit()
+    available = sorted(
+        p.name
+        for p in Path(prepared_archives).iterdir()
+        if p.is_dir() and "UDI" in p.name.split(".")[-1]
+    )
+    if run_ids:
+        missing = [r for r in run_ids if r not in available]
+        for run_id in missing:
+            log.error(f"No prepared archive for run_id {run_id} in {prepared_archives}")
+        if missing:
+            sys.exit()
+        available = [r for r in available if r in run_ids]
+    log.info(f"Building {len(available)} ro-crates from {prepared_archives}")
+
+    # Shared state, loaded once for the whole batch
+    get_registry()
+    load_template()
+    prefetch_ena_filereports(available)
+    confs, failures = resolve_samples_metadata(
+        available, shared_conf, override_error, max_concurrency
+    )
+    confs = {conf["run_id"]: conf for conf in confs}
+
+    errors = _LastErrorHandler()
+    log.getLogger().addHandler(errors)
+
+    def build(n, run_id):
+        if jobs > 1:
+            threading.current_thread().name = run_id
+        log.info(f"[{n}/{len(available)}] Building {run_id}")
+        errors.message = None
+        try:
+            build_ro_crate(
+                str(Path(prepared_archives, run_id)),
+                shared_conf,
+                upload_dvc,
+                without_sequence_data,
+                override_error,
+                resolved_conf=confs[run_id],
+                compact=compact,
+                s3_uploader=s3_uploader,
+            )
+            return (run_id, True, "")
+        except SystemExit:
+            return (run_id, False, errors.message or "exited")
+        except Exception as e:
+            log.exception(f"Unexpected error building {run_id}")
+            return (run_id, False, f"{type(e).__name__}: {e}")
+
+    outcomes = {run_id: (run_id, False, failures[run_id]) for run_id in failures}
+    to_build = [
+        (n, run_id)
+        for n, run_id in enumerate(available, start=1)
+        if run_id not in failures
+    ]
+    if jobs > 1:
+        log.info(f"Building up to {jobs} ro-crates at the same time")
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(build, n, run_id) for n, run_id in to_build]
+            for future in as_completed(futures):
+                outcome = future.result()
+                outcomes[outcome[0]] = outcome
+    else:
+        for n, run_id in to_build:
+            outcomes[run_id] = build(n, run_id)
+    log.getLogger().removeHandler(errors)
+    results = [outcomes[run_id] for run_id in available]
+
+    failed = [r for r in results if not r[1]]
+    log.info("Batch summary:")
+    for run_id, ok, message in results:
+        if ok:
+            log.info(f"  {run_id}: OK")
+        else:
+            log.info(f"  {run_id}: FAILED - {message}")
+    log.info(f"{len(results) - len(failed)} built, {len(failed)} failed")
+    if s3_uploader:
+        s3_uploader.log_stats()
+        s3_uploader.close()
+    sheet_cache.log_stats()
+    http_client.log_stats()
     log.info("Done.\n\n")
+    return results
 
 
 if __name__ == "__main__":
@@ -1505,7 +1998,10 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "target_directory",
-        help="Name of target directory containing MetaGOflow output",
+        help=(
+            "Name of target directory containing MetaGOflow output, or with -b"
+            " a prepared_archives directory of them"
+        ),
     )
     parser.add_argument(
         "yaml_config", help="Name of YAML config file for building RO-Crate"
@@ -1532,7 +2028,123 @@ if __name__ == "__main__":
         default=False,
         help="Override creator person missing error (default: False)",
     )
+    parser.add_argument(
+        "-t",
+        "--cache_ttl",
+        type=float,
+        default=None,
+        help=(
+            "Seconds to serve remote metadata sheets from the local cache before"
+            " revalidating (default: MGF_SHEET_CACHE_TTL or 86400)"
+        ),
+    )
+    parser.add_argument(
+        "--metadata-snapshot",
+        default=None,
+        help=(
+            "Resolve all remote metadata from this snapshot bundle, without"
+            " network access (see utils/metadata_snapshot.py)"
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        default=False,
+        help=(
+            "Build every archive in target_directory (a prepared_archives"
+            " directory) in one process (default: False)"
+        ),
+    )
+    parser.add_argument(
+        "-r",
+        "--run_ids",
+        nargs="+",
+        default=None,
+        help="With -b, only build the archives of these run_ids",
+    )
+    parser.add_argument(
+        "-m",
+        "--max_requests",
+        type=int,
+        default=DEFAULT_MAX_CONCURRENCY,
+        help=(
+            "With -b, the maximum remote metadata requests in flight while"
+            f" resolving the samples (default: {DEFAULT_MAX_CONCURRENCY})"
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="With -b, the number of ro-crates to build at the same time (default: 1)",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        default=False,
+        help=(
+            "Write ro-crate-metadata.json without indentation, for copies read"
+            " by programs (default: False)"
+        ),
+    )
+    parser.add_argument(
+        "-s",
+        "--s3_upload",
+        action="store_true",
+        default=False,
+        help=(
+            "With -u, upload the payload straight to the DVC S3 remote with"
+            " boto3 multipart uploads instead of dvc push (default: False)"
+        ),
+    )
+    parser.add_argument(
+        "--part_size",
+        type=int,
+        default=s3_upload.DEFAULT_PART_SIZE // s3_upload.MiB,
+        help=(
+            "With -s, the multipart part size in MiB"
+            f" (default: {s3_upload.DEFAULT_PART_SIZE // s3_upload.MiB})"
+        ),
+    )
+    parser.add_argument(
+        "--upload_concurrency",
+        type=int,
+        default=s3_upload.DEFAULT_CONCURRENCY,
+        help=(
+            "With -s, the S3 requests in flight"
+            f" (default: {s3_upload.DEFAULT_CONCURRENCY})"
+        ),
+    )
     args = parser.parse_args()
+    if args.run_ids and not args.batch:
+        parser.error("-r/--run_ids requires -b/--batch")
+    if args.jobs < 1:
+        parser.error("-j/--jobs must be at least 1")
+    if args.s3_upload and not args.upload_dvc:
+        parser.error("-s/--s3_upload requires -u/--upload_dvc")
+    s3_upload_options = None
+    if args.s3_upload:
+        s3_upload_options = (args.part_size * s3_upload.MiB, args.upload_concurrency)
+    if args.batch:
+        results = batch_main(
+            args.target_directory,
+            args.yaml_config,
+            args.debug,
+            args.upload_dvc,
+            args.without_sequence_data,
+            args.override_error,
+            args.cache_ttl,
+            args.run_ids,
+            args.metadata_snapshot,
+            args.max_requests,
+            args.jobs,
+            args.compact,
+            s3_upload_options,
+        )
+        # Non-zero if any sample failed, for schedulers and CI
+        sys.exit(0 if all(ok for _, ok, _ in results) else 1)
     main(
         args.target_directory,
         args.yaml_config,
@@ -1540,4 +2152,8 @@ if __name__ == "__main__":
         args.upload_dvc,
         args.without_sequence_data,
         args.override_error,
+        args.cache_ttl,
+        args.metadata_snapshot,
+        args.compact,
+        s3_upload_options,
     )
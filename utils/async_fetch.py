@@ -0,0 +1,61 @@
+"""
+asyncio front end to the sheet cache for resolving many samples at once
+
+AsyncFetcher.fetch() awaits sheet_cache.fetch() in a worker thread, so the
+on-disk cache, snapshot and pooled HTTP client behave as for synchronous reads.
+Requests for the same URL are deduplicated: while one is in flight the others
+await the same task, so 30 samples from one observatory download its sheets
+once. A semaphore caps the requests in flight across all hosts.
+"""
+
+import asyncio
+import logging
+
+try:
+    import sheet_cache
+except ModuleNotFoundError:
+    # Imported from the top directory as part of the utils package
+    from utils import sheet_cache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENCY = 16
+
+
+class AsyncFetcher:
+    """Deduplicating, concurrency-capped fetches within one event loop"""
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, timeout=60, retries=3):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self._tasks = {}
+        self.requested = 0
+
+    async def _fetch(self, url):
+        async with self.semaphore:
+            log.debug(f"Fetching {url}")
+            return await asyncio.to_thread(
+                sheet_cache.fetch, url, self.timeout, self.retries
+            )
+
+    async def fetch(self, url):
+        """Return the body of url, sharing the request with concurrent callers
+
+        Raises what sheet_cache.fetch() raises, to every caller.
+        """
+        self.requested += 1
+        if url not in self._tasks:
+            self._tasks[url] = asyncio.ensure_future(self._fetch(url))
+        return await self._tasks[url]
+
+    async def fetch_all(self, urls):
+        """Fetch urls concurrently, returning the body or the exception of each"""
+        return await asyncio.gather(
+            *(self.fetch(url) for url in urls), return_exceptions=True
+        )
+
+    @property
+    def fetched(self):
+        """Number of distinct URLs fetched"""
+        return len(self._tasks)
@@ -0,0 +1,601 @@
+#! /usr/bin/env python3
+
+from pathlib import Path
+import os
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import filecmp
+import logging as log
+import argparse
+import datetime
+import platform
+import tempfile
+import textwrap
+import subprocess
+import importlib.util
+
+from cpu_budget import available_cpus
+from payload_codecs import CODECS
+from prepare_data import FILE_PATTERNS, FILE_CLASSIFIER
+
+desc = """
+Benchmark the compressors of the sequence data payload
+
+Each file is compressed and decompressed with bzip2, lbzip2, Python's bz2,
+gzip, pigz, zstd and the codecs of payload_codecs.py (seekable zstd and BGZF),
+at several levels and thread counts. The throughput (MiB/s of uncompressed
+data), compression ratio, CPU time and peak RSS of every run are written to
+<output>.json and <output>.csv. Every run is a separate process, whose peak
+RSS is read from /proc while it runs (VmHWM) and whose CPU time comes from
+os.wait4(). Every decompressed file is checked against the original. Tools
+that are not installed are skipped.
+
+The files are one per prepare_data.py FILE_PATTERNS kind: with -i, the first
+file of each kind in the uncompressed results directory of an MGF run, otherwise
+synthetic FASTA, TSV and tblout files of -s MiB each, so that the benchmark
+runs on a laptop without the real data. The files are read once before they
+are timed, so the timings are of warm page cache reads.
+
+$ ./utils/benchmark_compression.py -s 32 -t 1,4,8 -o benchmark
+"""
+
+MiB = 1024 * 1024
+DEFAULT_SIZE = 16
+DEFAULT_OUTPUT = "compression-benchmark"
+UTILS_DIR = Path(__file__).resolve().parent
+# Seconds between two reads of the peak RSS of a running compressor
+RSS_INTERVAL = 0.005
+
+# The result of each run, in the order of the CSV columns
+FIELDS = [
+    "kind",
+    "file",
+    "size",
+    "tool",
+    "level",
+    "threads",
+    "compressed_size",
+    "ratio",
+    "compress_seconds",
+    "compress_mib_s",
+    "compress_cpu_seconds",
+    "compress_max_rss_mib",
+    "decompress_seconds",
+    "decompress_mib_s",
+    "decompress_cpu_seconds",
+    "decompress_max_rss_mib",
+    "verified",
+]
+
+# Python's bz2 and the payload codecs, in a process of their own
+PY_BZ2_COMPRESS = (
+    "import bz2, shutil, sys;"
+    " out = bz2.BZ2File(sys.stdout.buffer, 'wb', compresslevel={level});"
+    " shutil.copyfileobj(sys.stdin.buffer, out, 1 << 20); out.close()"
+)
+PY_BZ2_DECOMPRESS = (
+    "import bz2, shutil, sys;"
+    " shutil.copyfileobj(bz2.BZ2File(sys.stdin.buffer), sys.stdout.buffer, 1 << 20)"
+)
+PAYLOAD_CODEC_COMPRESS = (
+    "import sys; sys.path.insert(0, {utils_dir!r});"
+    " from payload_codecs import CODECS;"
+    " CODECS[{name!r}]({level}).compress_stream("
+    "sys.stdin.buffer, sys.stdout.buffer, {threads})"
+)
+
+
+class Tool:
+    """A compressor: its compress and decompress commands, and the levels and
+    thread counts it is run with
+    """
+
+    def __init__(
+        self,
+        name,
+        compress,
+        decompress,
+        levels,
+        threaded=False,
+        programs=(),
+        modules=(),
+        suffix="",
+    ):
+        self.name = name
+        # Formatted with level and threads
+        self.compress = compress
+        self.decompress = decompress
+        self.levels = levels
+        self.threaded = threaded
+        # The programs and Python modules it needs
+        self.programs = programs
+        self.modules = modules
+        self.suffix = suffix
+
+    def missing(self):
+        """What the tool needs that is not installed, or None"""
+        for program in self.programs:
+            if shutil.which(program) is None:
+                return program
+        for module in self.modules:
+            if importlib.util.find_spec(module) is None:
+                return f"the {module} module"
+        return None
+
+    def commands(self, level, threads):
+        """The compress and decompress commands"""
+        values = dict(level=level, threads=threads)
+        return (
+            [arg.format(**values) for arg in self.compress],
+            [arg.format(**values) for arg in self.decompress],
+        )
+
+
+def payload_codec_tool(name, levels, decompress, programs, modules=()):
+    """A codec of payload_codecs.py, decompressed by a standard tool"""
+    # Leaves {level} and {threads} to Tool.commands()
+    command = PAYLOAD_CODEC_COMPRESS.format(
+        utils_dir=str(UTILS_DIR), name=name, level="{level}", threads="{threads}"
+    )
+    return Tool(
+        f"payload-{name}",
+        [sys.executable, "-c", command],
+        decompress,
+        levels,
+        threaded=True,
+        programs=programs,
+        modules=modules,
+        suffix=CODECS[name].suffix,
+    )
+
+
+TOOLS = (
+    Tool(
+        "bzip2",
+        ["bzip2", "-{level}", "-c"],
+        ["bzip2", "-d", "-c"],
+        [1, 9],
+        programs=["bzip2"],
+        suffix=".bz2",
+    ),
+    Tool(
+        "lbzip2",
+        ["lbzip2", "-{level}", "-n", "{threads}", "-c"],
+        ["lbzip2", "-d", "-n", "{threads}", "-c"],
+        [9],
+        threaded=True,
+        programs=["lbzip2"],
+        suffix=".bz2",
+    ),
+    Tool(
+        "python-bz2",
+        [sys.executable, "-c", PY_BZ2_COMPRESS],
+        [sys.executable, "-c", PY_BZ2_DECOMPRESS],
+        [9],
+        suffix=".bz2",
+    ),
+    Tool(
+        "gzip",
+        ["gzip", "-{level}", "-c"],
+        ["gzip", "-d", "-c"],
+        [1, 6, 9],
+        programs=["gzip"],
+        suffix=".gz",
+    ),
+    Tool(
+        "pigz",
+        ["pigz", "-{level}", "-p", "{threads}", "-c"],
+        ["pigz", "-d", "-p", "{threads}", "-c"],
+        [6, 9],
+        threaded=True,
+        programs=["pigz"],
+        suffix=".gz",
+    ),
+    Tool(
+        "zstd",
+        ["zstd", "-{level}", "-T{threads}", "-q", "-c"],
+        ["zstd", "-d", "-q", "-c"],
+        [3, 12, 19],
+        threaded=True,
+        programs=["zstd"],
+        suffix=".zst",
+    ),
+    payload_codec_tool(
+        "zstd", [3, 12], ["zstd", "-d", "-q", "-c"], ["zstd"], ["zstandard"]
+    ),
+    payload_codec_tool("bgzf", [6], ["gzip", "-d", "-c"], ["gzip"]),
+)
+TOOLS = {tool.name: tool for tool in TOOLS}
+
+
+def _sequence(rng, length, alphabet):
+    """A random sequence of the letters of alphabet"""
+    table = bytes(alphabet[i % len(alphabet)] for i in range(256))
+    return rng.randbytes(length).translate(table)
+
+
+def _wrap(sequence, width):
+    return b"\n".join(
+        sequence[i : i + width] for i in range(0, len(sequence), width)
+    )
+
+
+def _reads(rng, n):
+    """A read of the trimmed or merged reads"""
+    sequence = _sequence(rng, rng.randint(100, 250), b"ACGT")
+    return b">SYN.%d %d/1\n%s\n" % (n, n, sequence)
+
+
+def _contig(rng, n):
+    """A contig of MEGAHIT's final.contigs.fa"""
+    length = rng.randint(200, 5000)
+    sequence = _sequence(rng, length, b"ACGT")
+    multi = rng.uniform(1, 10)
+    return b">k141_%d flag=1 multi=%.4f len=%d\n%s\n" % (n, multi, length, sequence)
+
+
+def _cds(rng, n, protein=False):
+    """A coding sequence of the ffn, or its translation for the faa"""
+    codons = rng.randint(50, 600)
+    start = rng.randint(1, 5000)
+    end = start + 3 * codons - 1
+    strand = rng.choice((b"+", b"-"))
+    if protein:
+        sequence = b"M" + _sequence(rng, codons - 1, b"ACDEFGHIKLMNPQRSTVWY")
+    else:
+        sequence = _sequence(rng, 3 * codons, b"ACGT")
+    header = b">SYN.%d_%d_%d_%s" % (n, start, end, strand)
+    return b"%s\n%s\n" % (header, _wrap(sequence, 60))
+
+
+def _tblout(rng, n):
+    """A hit of the deoverlapped cmsearch tblout"""
+    family = rng.choice(
+        (
+            (b"SSU_rRNA_bacteria", b"RF00177"),
+            (b"LSU_rRNA_bacteria", b"RF02541"),
+            (b"tRNA", b"RF00005"),
+            (b"5S_rRNA", b"RF00001"),
+        )
+    )
+    start = rng.randint(1, 250)
+    end = start + rng.randint(20, 200)
+    line = b"SYN.%d-%d %-9s %-20s %s cm 1 %d %d %d + no 1 0.%02d 0.0 %.1f %.1e ! -\n"
+    return line % (
+        n,
+        rng.randint(1, 2),
+        b"-",
+        family[0],
+        family[1],
+        end - start,
+        start,
+        end,
+        rng.randint(30, 70),
+        rng.uniform(20, 200),
+        rng.uniform(1e-60, 1e-5),
+    )
+
+
+MOTUS_TAXA = [
+    b"k__Bacteria|p__Proteobacteria|c__Alphaproteobacteria",
+    b"k__Bacteria|p__Bacteroidetes|c__Flavobacteriia",
+    b"k__Bacteria|p__Cyanobacteria|c__Cyanophyceae",
+    b"k__Bacteria|p__Proteobacteria|c__Gammaproteobacteria",
+    b"k__Archaea|p__Thaumarchaeota|c__Nitrososphaeria",
+    b"unassigned",
+]
+
+
+def _motus(rng, n):
+    """A line of the mOTUs profile"""
+    return b"%s|s__%d\t%d\n" % (
+        rng.choice(MOTUS_TAXA),
+        n,
+        rng.choice((0, 0, 0, 1, 2, rng.randint(3, 5000))),
+    )
+
+
+# Record generators of the synthetic files, by FILE_PATTERNS kind
+SYNTHETIC_RECORDS = {
+    "*.fastq.trimmed.fasta": _reads,
+    "*.merged_CDS.faa": lambda rng, n: _cds(rng, n, protein=True),
+    "*.merged_CDS.ffn": _cds,
+    "*.merged.cmsearch.all.tblout.deoverlapped": _tblout,
+    "*.merged.fasta": _reads,
+    "*.merged.motus.tsv": _motus,
+    "*.merged.unfiltered_fasta": _reads,
+    "final.contigs.fa": _contig,
+}
+
+
+def write_synthetic_file(kind, directory, size, seed=0):
+    """Write a synthetic file of about size bytes of a FILE_PATTERNS kind"""
+    path = Path(directory, kind.replace("*", "SYN"))
+    rng = random.Random(f"{seed}-{kind}")
+    records = SYNTHETIC_RECORDS[kind]
+    written = 0
+    n = 0
+    with open(path, "wb") as f:
+        if kind == "*.merged.motus.tsv":
+            written += f.write(b"#consensus_taxonomy\tSYN\n")
+        while written < size:
+            n += 1
+            written += f.write(records(rng, n))
+    return path
+
+
+def find_payload_files(results_dir):
+    """The first file of each FILE_PATTERNS kind in a results directory"""
+    found = {}
+    for path in sorted(Path(results_dir).iterdir()):
+        kind = FILE_CLASSIFIER.classify(path.name)
+        if kind is not None and path.is_file():
+            found.setdefault(kind, path)
+    return found
+
+
+def _hwm(pid):
+    """The peak RSS of a running process in KiB (VmHWM), or None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _run(command, src, dest):
+    """Run command from src to dest: wall seconds, CPU seconds, peak RSS
+
+    The peak RSS is None for a process that ended before it was read. The
+    ru_maxrss of os.wait4() is not used, as it counts the memory this process
+    had when it forked the command.
+    """
+    peak = None
+    with open(src, "rb") as stdin, open(dest, "wb") as stdout:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdin=stdin, stdout=stdout)
+        while True:
+            time.sleep(RSS_INTERVAL)
+            # The rusage of the process itself, which Popen.wait() does not give
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            hwm = _hwm(process.pid)
+            if hwm is not None:
+                peak = max(hwm, peak or 0)
+        seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    cpu_seconds = rusage.ru_utime + rusage.ru_stime
+    return seconds, cpu_seconds, None if peak is None else round(peak / 1024, 1)
+
+
+def benchmark(tool, level, threads, kind, path, work_dir, repeat=1):
+    """Compress and decompress a file with a tool, the best of repeat runs"""
+    compress, decompress = tool.commands(level, threads)
+    compressed = Path(work_dir, f"{path.name}{tool.suffix}")
+    decompressed = Path(work_dir, f"{path.name}.out")
+    size = path.stat().st_size
+    # (seconds, cpu_seconds, max_rss_mib) of the fastest run
+    compress_run = min(
+        (_run(compress, path, compressed) for _ in range(repeat)),
+        key=lambda run: run[0],
+    )
+    decompress_run = min(
+        (_run(decompress, compressed, decompressed) for _ in range(repeat)),
+        key=lambda run: run[0],
+    )
+    compressed_size = compressed.stat().st_size
+    verified = filecmp.cmp(path, decompressed, shallow=False)
+    if not verified:
+        log.error(f"{tool.name} -{level} did not decompress {path.name} as it was")
+    compressed.unlink()
+    decompressed.unlink()
+    return {
+        "kind": kind,
+        "file": path.name,
+        "size": size,
+        "tool": tool.name,
+        "level": level,
+        "threads": threads,
+        "compressed_size": compressed_size,
+        "ratio": round(size / max(1, compressed_size), 3),
+        "compress_seconds": round(compress_run[0], 3),
+        "compress_mib_s": round(size / MiB / compress_run[0], 2),
+        "compress_cpu_seconds": round(compress_run[1], 3),
+        "compress_max_rss_mib": compress_run[2],
+        "decompress_seconds": round(decompress_run[0], 3),
+        "decompress_mib_s": round(size / MiB / decompress_run[0], 2),
+        "decompress_cpu_seconds": round(decompress_run[1], 3),
+        "decompress_max_rss_mib": decompress_run[2],
+        "verified": verified,
+    }
+
+
+def write_report(output, source, results):
+    """Write output.json and output.csv"""
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "available_cpus": available_cpus(),
+        },
+        "source": source,
+        "results": results,
+    }
+    json_path = Path(f"{output}.json")
+    with open(json_path, "w") as f:
+        json.dump(report, f, indent=2)
+    csv_path = Path(f"{output}.csv")
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    log.info(f"Wrote {json_path} and {csv_path}")
+
+
+def main(
+    input_dir=None,
+    size=DEFAULT_SIZE,
+    tools=None,
+    threads=None,
+    kinds=None,
+    repeat=1,
+    output=DEFAULT_OUTPUT,
+    debug=False,
+):
+    log.basicConfig(
+        format="\t%(levelname)s: %(message)s", level=log.DEBUG if debug else log.INFO
+    )
+    threads = threads or sorted({1, available_cpus()})
+    kinds = kinds or FILE_PATTERNS
+
+    selected = []
+    for name in tools or TOOLS:
+        missing = TOOLS[name].missing()
+        if missing:
+            log.warning(f"Skipping {name}: {missing} is not installed")
+        else:
+            selected.append(TOOLS[name])
+    if not selected:
+        log.error("None of the compressors is installed")
+        sys.exit()
+
+    with tempfile.TemporaryDirectory(prefix="compression-benchmark-") as work_dir:
+        if input_dir:
+            input_dir = Path(input_dir)
+            if not input_dir.is_dir():
+                log.error(f"Cannot find the results directory {input_dir}")
+                sys.exit()
+            found = find_payload_files(input_dir)
+            files = {kind: found[kind] for kind in kinds if kind in found}
+            for kind in kinds:
+                if kind not in found:
+                    log.warning(f"No {kind} file in {input_dir}")
+        else:
+            log.info(f"Writing synthetic files of {size} MiB")
+            files = {
+                kind: write_synthetic_file(kind, work_dir, size * MiB)
+                for kind in kinds
+            }
+        if not files:
+            log.error("No files to benchmark")
+            sys.exit()
+        runs_dir = Path(work_dir, "runs")
+        runs_dir.mkdir()
+
+        results = []
+        for kind, path in files.items():
+            # Into the page cache, so the first tool is not timed reading it
+            with open(path, "rb") as f:
+                while f.read(MiB):
+                    pass
+            log.info(f"{kind}: {path.name}, {path.stat().st_size / MiB:.1f} MiB")
+            for tool in selected:
+                for level in tool.levels:
+                    for n in threads if tool.threaded else [1]:
+                        result = benchmark(
+                            tool, level, n, kind, path, runs_dir, repeat
+                        )
+                        rss = result["compress_max_rss_mib"]
+                        log.info(
+                            f"  {tool.name:>14} -{level:<2} {n:>3} threads:"
+                            f" ratio {result['ratio']:6.2f},"
+                            f" {result['compress_mib_s']:8.1f} MiB/s compress,"
+                            f" {result['decompress_mib_s']:8.1f} MiB/s decompress,"
+                            f" {'?' if rss is None else rss} MiB RSS"
+                        )
+                        results.append(result)
+
+        source = str(input_dir) if input_dir else f"synthetic, {size} MiB per file"
+        write_report(output, source, results)
+    if not all(result["verified"] for result in results):
+        log.error("Some files did not decompress as they were")
+        sys.exit(1)
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent(desc),
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        default=None,
+        help=(
+            "Uncompressed results directory of an MGF run"
+            " (default: synthetic files)"
+        ),
+    )
+    parser.add_argument(
+        "-s",
+        "--size",
+        default=DEFAULT_SIZE,
+        type=int,
+        help=f"Size of each synthetic file in MiB (default: {DEFAULT_SIZE})",
+    )
+    parser.add_argument(
+        "--tools",
+        nargs="+",
+        choices=list(TOOLS),
+        default=None,
+        help="Compressors to benchmark (default: all those installed)",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=_int_list,
+        default=None,
+        help=(
+            "Comma separated thread counts of the multithreaded compressors"
+            f" (default: 1,{available_cpus()})"
+        ),
+    )
+    parser.add_argument(
+        "-k",
+        "--kinds",
+        nargs="+",
+        choices=FILE_PATTERNS,
+        default=None,
+        help="FILE_PATTERNS kinds to benchmark (default: all)",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        default=1,
+        type=int,
+        help="Runs of each benchmark, of which the fastest is kept (default: 1)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=DEFAULT_OUTPUT,
+        help=f"Report path without .json/.csv (default: {DEFAULT_OUTPUT})",
+    )
+    parser.add_argument("-d", "--debug", action="store_true", help="DEBUG logging")
+    args = parser.parse_args()
+    main(
+        args.input,
+        args.size,
+        args.tools,
+        args.threads,
+        args.kinds,
+        args.repeat,
+        args.output,
+        args.debug,
+    )
@@ -0,0 +1,107 @@
+"""
+A budget of CPU cores shared by the jobs of a process
+
+available_cpus() is the number of cores this process may really use: the CPUs
+it is allowed to run on (sched_getaffinity), capped by the CPU quota of its
+cgroup (cpu.max with cgroup v2, cpu.cfs_quota_us with cgroup v1), as in a
+container or a Slurm job. os.cpu_count() is the number of cores of the machine,
+whatever the limits.
+
+A CpuBudget hands out cores to the jobs running at the same time, e.g. the
+extractions and recompressions of several archives, so that together they use
+every core of the budget and no more.
+"""
+
+import os
+import math
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+
+def _cgroup_quota():
+    """The CPU quota of the cgroup in cores, or None if there is none"""
+    try:
+        # cgroup v2: "max 100000" or "<quota> <period>"
+        quota, period = (CGROUP_ROOT / "cpu.max").read_text().split()[:2]
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1, where -1 is no quota
+        quota = int((CGROUP_ROOT / "cpu" / "cpu.cfs_quota_us").read_text())
+        period = int((CGROUP_ROOT / "cpu" / "cpu.cfs_period_us").read_text())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus():
+    """The number of cores this process may use, at least 1"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not on Linux
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_quota()
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+class CpuBudget:
+    """A number of cores shared by the jobs of a process"""
+
+    def __init__(self, total=None):
+        self.total = total or available_cpus()
+        self.free = self.total
+        # Jobs sharing the budget, to work out a fair share
+        self.jobs = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def job(self):
+        """Count a job as sharing the budget while in the block"""
+        with self._condition:
+            self.jobs += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.jobs -= 1
+                self._condition.notify_all()
+
+    def fair_share(self):
+        """The cores of the budget divided between the jobs"""
+        with self._condition:
+            return max(1, self.total // max(1, self.jobs))
+
+    @contextmanager
+    def cores(self, wanted=None):
+        """Hold up to wanted cores (the fair share by default) in the block
+
+        Waits for at least one free core and yields the number held.
+        """
+        if wanted is None:
+            wanted = self.fair_share()
+        wanted = max(1, min(wanted, self.total))
+        with self._condition:
+            self._condition.wait_for(lambda: self.free > 0)
+            held = min(wanted, self.free)
+            self.free -= held
+        log.debug(f"Holding {held} of {self.total} cores")
+        try:
+            yield held
+        finally:
+            with self._condition:
+                self.free += held
+                self._condition.notify_all()
@@ -0,0 +1,122 @@
+"""
+Ordered, @id-indexed model of an RO-Crate JSON-LD @graph
+
+The crate metadata is built by finding stanzas by @id and inserting new ones
+next to them. On the plain @graph list each of those is a scan, and each
+list.insert() shifts the rest of the graph, so building a crate with many data
+files is quadratic. CrateGraph keeps the stanzas in a doubly linked list with a
+dictionary index from @id to list node: lookup, insertion next to a stanza and
+renaming are O(1), and to_list() returns the stanzas in exactly the order the
+same sequence of list operations would have produced.
+
+The stanzas are the template dictionaries themselves, so they can be edited in
+place, except for their @id which must be changed with rename() to keep the
+index in step.
+"""
+
+
+class _Node:
+    __slots__ = ("stanza", "prev", "next")
+
+    def __init__(self, stanza):
+        self.stanza = stanza
+        self.prev = None
+        self.next = None
+
+
+class CrateGraph:
+    """The stanzas of a @graph in order, indexed by @id"""
+
+    def __init__(self, stanzas=()):
+        # Sentinel: head.next is the first node and head.prev the last
+        self._head = _Node(None)
+        self._head.prev = self._head.next = self._head
+        self._index = {}
+        for stanza in stanzas:
+            self.append(stanza)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, stanza_id):
+        return stanza_id in self._index
+
+    def __iter__(self):
+        node = self._head.next
+        while node is not self._head:
+            # Fetch the next node first so the stanza can be removed
+            following = node.next
+            yield node.stanza
+            node = following
+
+    def to_list(self):
+        return list(self)
+
+    def get(self, stanza_id, default=None):
+        node = self._index.get(stanza_id)
+        return default if node is None else node.stanza
+
+    def __getitem__(self, stanza_id):
+        return self._index[stanza_id].stanza
+
+    def at(self, position):
+        """The stanza at position, walking from the start of the graph"""
+        for i, stanza in enumerate(self):
+            if i == position:
+                return stanza
+        raise IndexError(position)
+
+    def _link(self, node, prev):
+        stanza_id = node.stanza["@id"]
+        if stanza_id in self._index:
+            raise ValueError(f"Duplicate @id in crate graph: {stanza_id}")
+        node.prev = prev
+        node.next = prev.next
+        prev.next.prev = node
+        prev.next = node
+        self._index[stanza_id] = node
+        return node.stanza
+
+    def append(self, stanza):
+        return self._link(_Node(stanza), self._head.prev)
+
+    def insert_after(self, anchor_id, stanza):
+        """Insert stanza immediately after the stanza with @id anchor_id"""
+        return self._link(_Node(stanza), self._index[anchor_id])
+
+    def insert_before(self, anchor_id, stanza):
+        """Insert stanza immediately before the stanza with @id anchor_id"""
+        return self._link(_Node(stanza), self._index[anchor_id].prev)
+
+    def insert_at(self, position, stanza):
+        """Insert stanza at position, as list.insert(position, stanza) would"""
+        if position >= len(self):
+            return self.append(stanza)
+        return self.insert_before(self.at(position)["@id"], stanza)
+
+    def remove(self, stanza_id):
+        node = self._index.pop(stanza_id)
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        return node.stanza
+
+    def rename(self, old_id, new_id):
+        """Change the @id of a stanza, keeping its position"""
+        if new_id == old_id:
+            return self[old_id]
+        if new_id in self._index:
+            raise ValueError(f"Duplicate @id in crate graph: {new_id}")
+        node = self._index.pop(old_id)
+        node.stanza["@id"] = new_id
+        self._index[new_id] = node
+        return node.stanza
+
+    def add_parts(self, stanza_id, part_ids):
+        """Append {"@id": part_id} entries to the hasPart of a stanza"""
+        self[stanza_id].setdefault("hasPart", []).extend(
+            {"@id": part_id} for part_id in part_ids
+        )
+
+    def set_parts(self, stanza_id, part_ids):
+        """Replace the hasPart of a stanza with {"@id": part_id} entries"""
+        self[stanza_id]["hasPart"] = [{"@id": part_id} for part_id in part_ids]
@@ -0,0 +1,138 @@
+"""
+Serializer for ro-crate-metadata.json
+
+The pretty output is byte for byte what json.dumps(metadata, indent=4) gives,
+so regenerating the metadata of a crate only shows the real changes in git.
+The compact output (no indentation or spaces, non-ASCII characters as UTF-8)
+is for copies read by programs.
+
+When orjson is installed it serializes the metadata, and its output is turned
+into the same bytes the json module gives: orjson only indents by 2 spaces and
+writes non-ASCII characters as UTF-8. Metadata with floats (whose text orjson
+may write differently), non-string keys or integers beyond 64 bits go through
+the json module. Without orjson the json encoder streams the pretty output to
+the file chunk by chunk.
+"""
+
+import os
+import re
+import json
+import logging
+from pathlib import Path
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+INDENT = 4
+COMPACT_SEPARATORS = (",", ":")
+
+# json.dumps(ensure_ascii=True) escapes DEL and everything beyond ASCII
+_NON_ASCII = re.compile(r"[^\x00-\x7e]")
+
+
+def _ascii_escape(match):
+    # As json.dumps(ensure_ascii=True), with surrogate pairs beyond the BMP
+    code = ord(match.group())
+    if code < 0x10000:
+        return f"\\u{code:04x}"
+    code -= 0x10000
+    return f"\\u{0xD800 | (code >> 10):04x}\\u{0xDC00 | (code & 0x3FF):04x}"
+
+
+def _orjson_depth(obj):
+    """The nesting depth of obj, or None unless orjson writes it exactly as
+    the json module does
+    """
+    depth = -1
+    level = [obj]
+    while level:
+        depth += 1
+        below = []
+        for node in level:
+            kind = type(node)
+            if kind is str or node is None or kind is bool:
+                continue
+            elif kind is dict:
+                if not all(type(key) is str for key in node):
+                    return None
+                below.extend(node.values())
+            elif kind is list:
+                below.extend(node)
+            elif kind is int:
+                if not -(2**63) <= node < 2**64:
+                    return None
+            else:
+                # Floats, tuples, subclasses and anything else
+                return None
+        level = below
+    return depth
+
+
+def _orjson_dumps(obj, depth, compact):
+    if compact:
+        return orjson.dumps(obj).decode("utf-8")
+    pretty = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    # Double the indentation, deepest lines first. Strings cannot hold a raw
+    # newline or control character, so each line starts with its indentation
+    # only, and \x00 marks the levels already done.
+    for level in range(depth, 0, -1):
+        pretty = pretty.replace(b"\n" + b"  " * level, b"\n" + b"\x00" * level)
+    text = pretty.replace(b"\x00", b" " * INDENT).decode("utf-8")
+    if text.isascii() and "\x7f" not in text:
+        return text
+    return _NON_ASCII.sub(_ascii_escape, text)
+
+
+def _try_orjson(obj, compact):
+    """obj serialized with orjson, or None to use the json module"""
+    if orjson is None:
+        return None
+    depth = _orjson_depth(obj)
+    if depth is None:
+        return None
+    try:
+        return _orjson_dumps(obj, depth, compact)
+    except orjson.JSONEncodeError as e:
+        # e.g. strings with lone surrogates
+        log.debug(f"orjson cannot serialize the metadata: {e}")
+        return None
+
+
+def _encoder(compact):
+    if compact:
+        return json.JSONEncoder(separators=COMPACT_SEPARATORS, ensure_ascii=False)
+    return json.JSONEncoder(indent=INDENT)
+
+
+def dumps(obj, compact=False):
+    """Serialize obj, pretty as json.dumps(obj, indent=4) or compact"""
+    text = _try_orjson(obj, compact)
+    if text is None:
+        text = _encoder(compact).encode(obj)
+    return text
+
+
+def write(obj, path, compact=False):
+    """Serialize obj to path, replacing it only once it is complete"""
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    text = _try_orjson(obj, compact)
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            if text is not None:
+                f.write(text)
+            else:
+                for chunk in _encoder(compact).iterencode(obj):
+                    f.write(chunk)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    log.debug(
+        f"Wrote {path} with {'json' if text is None else 'orjson'}"
+        f" ({'compact' if compact else 'pretty'})"
+    )
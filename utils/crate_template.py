@@ -0,0 +1,101 @@
+"""
+Compiled ro-crate-metadata.json template
+
+The template holds {placeholder} fields (ref_code, prefix, source_mat_id, the
+ENA and MetaGOflow links...) scattered over the @graph. Compiling it walks the
+JSON once and records a render plan: the path of every string that holds a
+placeholder, with the placeholders it needs. Rendering a crate is then a single
+pass over the plan, substituting only those strings, instead of walking and
+formatting the whole graph.
+
+The plan depends only on the template, so it is cached on disk in
+~/.cache/metagoflow-ro-crate/templates (or MGF_TEMPLATE_CACHE_DIR) under the
+sha256 of the template, and recompiled whenever the template changes.
+"""
+
+import os
+import copy
+import json
+import string
+import hashlib
+import logging
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PLAN_DIR = Path.home() / ".cache" / "metagoflow-ro-crate" / "templates"
+
+# Increment when the plan format changes
+PLAN_FORMAT_VERSION = 1
+
+
+def _compile_plan(node, path=()):
+    """Yield [path, string, fields] for every string holding placeholders"""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            yield from _compile_plan(value, path + (key,))
+    elif isinstance(node, list):
+        for i, value in enumerate(node):
+            yield from _compile_plan(value, path + (i,))
+    elif isinstance(node, str):
+        fields = [f for _, f, _, _ in string.Formatter().parse(node) if f is not None]
+        if fields:
+            yield [list(path), node, fields]
+
+
+class CrateTemplate:
+    """A parsed template and its render plan"""
+
+    def __init__(self, template, plan, digest):
+        self.template = template
+        self.plan = plan
+        self.digest = digest
+
+    @classmethod
+    def compile(cls, source, plan_dir=None):
+        """Compile the template JSON in source (bytes), using the cached plan"""
+        digest = hashlib.sha256(source).hexdigest()
+        template = json.loads(source)
+        plan_dir = Path(
+            plan_dir or os.environ.get("MGF_TEMPLATE_CACHE_DIR") or DEFAULT_PLAN_DIR
+        )
+        plan_path = plan_dir / f"{digest}.json"
+        try:
+            with open(plan_path, "r") as f:
+                cached = json.load(f)
+            if cached.get("format_version") == PLAN_FORMAT_VERSION:
+                log.debug(f"Using compiled template plan {plan_path}")
+                return cls(template, cached["plan"], digest)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        plan = list(_compile_plan(template))
+        log.debug(f"Compiled template: {len(plan)} fields with placeholders")
+        try:
+            plan_dir.mkdir(parents=True, exist_ok=True)
+            tmp = plan_path.with_name(f"{plan_path.name}.{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump({"format_version": PLAN_FORMAT_VERSION, "plan": plan}, f)
+            os.replace(tmp, plan_path)
+        except OSError as e:
+            # Only a missed optimisation
+            log.warning(f"Cannot cache the compiled template plan: {e}")
+        return cls(template, plan, digest)
+
+    @property
+    def placeholders(self):
+        """Every placeholder the template needs"""
+        return {field for _, _, fields in self.plan for field in fields}
+
+    def render(self, values):
+        """Return a new copy of the template with every placeholder substituted
+
+        Raises KeyError if values lacks a placeholder.
+        """
+        rendered = copy.deepcopy(self.template)
+        for path, template_string, _ in self.plan:
+            parent = rendered
+            for key in path[:-1]:
+                parent = parent[key]
+            parent[path[-1]] = template_string.format_map(values)
+        return rendered
@@ -0,0 +1,275 @@
+"""
+In-process, parallel equivalent of `dvc add` for the payload files of a crate
+
+Running `dvc add` once per file starts a DVC process per file, and each one
+reads the repository state again and hashes its file alone. Here the files are
+hashed in a thread pool (hashlib and file reads release the GIL), each read
+once in BUFFER_SIZE chunks: the chunks update the md5 and are written to the
+DVC cache at the same time. For each file this leaves what DVC 3 `dvc add`
+does:
+
+- the file in the cache, <cache>/files/md5/xx/yyyy..., read-only
+- the <file>.dvc stub next to it, with its md5, size and path
+- a /<file> entry in the .gitignore of its directory
+
+so a `dvc push` afterwards uploads the files. As with DVC, the stubs and
+.gitignore files are only staged in git (stage()) when core.autostage is set
+in the DVC config. stub_index() reads back the
+stubs of a whole crate in one pass. DVC 3 hashes the plain bytes of
+a file (hash: md5), without the dos2unix normalisation of DVC 2.
+
+The md5 of each file is recorded in the hash cache of the repository (see
+hash_cache.py). A file found there unchanged, whose object is already in the
+DVC cache, is not read again: only its stub and .gitignore entry are written.
+"""
+
+import os
+import stat
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+import configparser
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    from hash_cache import HashCache
+except ModuleNotFoundError:
+    # Imported from the top directory as part of the utils package
+    from utils.hash_cache import HashCache
+
+log = logging.getLogger(__name__)
+
+BUFFER_SIZE = 8 * 1024 * 1024
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def file_md5(path, out=None):
+    """Return the md5 and size of the file at path, copying it to out if given"""
+    md5 = hashlib.md5()
+    size = 0
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            md5.update(view[:n])
+            if out is not None:
+                out.write(view[:n])
+            size += n
+    return md5.hexdigest(), size
+
+
+def _parse_stub(text):
+    """The md5, size and path of the single out of a .dvc stub, or None
+
+    Reads the stubs DVC writes (and _write_stub() below) without YAML:
+    "outs:" followed by one "- key: value" item.
+    """
+    lines = text.splitlines()
+    if not lines or lines[0] != "outs:":
+        return None
+    out = {}
+    for n, line in enumerate(lines[1:]):
+        if n == 0 and line.startswith("- "):
+            line = line[2:]
+        elif line.startswith("  "):
+            line = line[2:]
+        else:
+            return None
+        key, sep, value = line.partition(": ")
+        if not sep or key in out or not value or value[0] in "'\"{[&*!|>":
+            return None
+        out[key] = value
+    try:
+        return out["md5"], int(out["size"]), out["path"]
+    except (KeyError, ValueError):
+        return None
+
+
+def read_stub(path):
+    """The md5, size and path of the out of the .dvc stub at path"""
+    with open(path) as f:
+        text = f.read()
+    parsed = _parse_stub(text)
+    if parsed is None:
+        # Anything else DVC may write, e.g. quoted paths or several fields
+        out = yaml.load(text, Loader=SafeLoader)["outs"][0]
+        parsed = out["md5"], out.get("size"), out["path"]
+    return parsed
+
+
+def stub_index(crate_path):
+    """{path: (md5, size)} of every DVC tracked file under crate_path
+
+    The paths are relative to crate_path, as the @ids of the crate, e.g.
+    "./taxonomy-summary/RNA-counts". The crate is scanned once.
+    """
+    index = {}
+    pending = [(Path(crate_path), ".")]
+    while pending:
+        directory, relative = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append((entry.path, f"{relative}/{entry.name}"))
+                elif entry.name.endswith(".dvc") and entry.is_file():
+                    md5, size, name = read_stub(entry.path)
+                    index[f"{relative}/{name}"] = (md5, size)
+    return index
+
+
+class DvcRepo:
+    """The DVC cache and workspace of a repository"""
+
+    def __init__(self, root, hash_cache=None):
+        self.root = Path(root)
+        self.cache_dir = self._cache_dir()
+        self.objects_dir = self.cache_dir / "files" / "md5"
+        self.hash_cache = hash_cache or HashCache.for_repo(self.root)
+        self.autostage = self._config().getboolean("core", "autostage", fallback=False)
+        # .gitignore files shared by files of the same directory
+        self._gitignore_lock = threading.Lock()
+
+    def _config(self):
+        config = configparser.ConfigParser()
+        dvc_dir = self.root / ".dvc"
+        config.read([dvc_dir / "config", dvc_dir / "config.local"])
+        return config
+
+    def _cache_dir(self):
+        # cache.dir may be set, relative to .dvc/, in config or config.local
+        dvc_dir = self.root / ".dvc"
+        config = self._config()
+        if config.has_option("cache", "dir"):
+            return (dvc_dir / config.get("cache", "dir")).resolve()
+        return dvc_dir / "cache"
+
+    def cache_path(self, md5):
+        return self.objects_dir / md5[:2] / md5[2:]
+
+    def _add_to_cache(self, path):
+        """Hash the file at path while copying it into the cache"""
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.objects_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                md5, size = file_md5(path, out)
+            cached = self.cache_path(md5)
+            if cached.exists():
+                os.unlink(tmp)
+            else:
+                cached.parent.mkdir(exist_ok=True)
+                # DVC keeps the cache read-only
+                os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.replace(tmp, cached)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return md5, size
+
+    def _write_stub(self, path, md5, size):
+        stub = {"outs": [{"md5": md5, "size": size, "hash": "md5", "path": path.name}]}
+        with open(f"{path}.dvc", "w") as f:
+            yaml.safe_dump(stub, f, sort_keys=False)
+
+    def _ignore(self, path):
+        """Add /<name> to the .gitignore of the directory of path"""
+        gitignore = path.parent / ".gitignore"
+        entry = f"/{path.name}"
+        with self._gitignore_lock:
+            text = gitignore.read_text() if gitignore.exists() else ""
+            if entry in text.splitlines():
+                return
+            with open(gitignore, "a") as f:
+                if text and not text.endswith("\n"):
+                    f.write("\n")
+                f.write(f"{entry}\n")
+
+    def _cached_md5(self, st):
+        """The md5 of an unchanged file whose object is in the DVC cache"""
+        md5 = self.hash_cache.get(st)
+        if md5 is None:
+            return None
+        try:
+            if self.cache_path(md5).stat().st_size == st.st_size:
+                return md5
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _add(self, path):
+        st = os.stat(path)
+        md5 = self._cached_md5(st)
+        if md5 is not None:
+            size = st.st_size
+            log.debug(f"{path} is unchanged, md5 from the hash cache")
+        else:
+            md5, size = self._add_to_cache(path)
+            self.hash_cache.put(path, st, md5)
+        self._write_stub(path, md5, size)
+        log.debug(f"Added {path} to DVC: {md5} ({size} bytes)")
+        return md5, size
+
+    def add(self, path):
+        """dvc add the file at path, returning its md5 and size"""
+        path = Path(path)
+        md5, size = self._add(path)
+        self._ignore(path)
+        return md5, size
+
+    def add_all(self, paths, workers=DEFAULT_WORKERS):
+        """dvc add the files at paths in parallel
+
+        Yields (path, md5, size) as each file is done. Raises what reading a
+        file raises, e.g. FileNotFoundError. The .gitignore entries are added
+        once all the files are done, in the order of paths, so they do not
+        depend on which file was hashed first.
+        """
+        paths = list(paths)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self._add, Path(path)): path for path in paths}
+            try:
+                for future in as_completed(futures):
+                    md5, size = future.result()
+                    yield futures[future], md5, size
+            finally:
+                # Do not start the others after an error
+                for future in futures:
+                    future.cancel()
+        for path in paths:
+            self._ignore(Path(path))
+
+    def stage(self, paths):
+        """git add the stubs and .gitignore files of the files at paths, as
+        dvc add does with core.autostage
+
+        Raises CalledProcessError if git fails.
+        """
+        staged = []
+        for path in map(Path, paths):
+            for name in (f"{path}.dvc", path.parent / ".gitignore"):
+                name = os.path.relpath(name, self.root)
+                if name not in staged:
+                    staged.append(name)
+        # Keep below the argument length limit
+        for i in range(0, len(staged), 500):
+            subprocess.check_call(
+                ["git", "-C", str(self.root), "add", "--"] + staged[i : i + 500]
+            )
+        return staged
+
+    def close(self):
+        self.hash_cache.close()
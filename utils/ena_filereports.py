@@ -0,0 +1,113 @@
+"""
+Bulk resolution of the ENA filereports of the EMO BON samples
+
+The ENA filereport endpoint answers for one accession at a time, so building a
+batch of crates costs one round trip to EBI per sample. The portal search
+endpoint instead accepts a query over many sample accessions and returns the
+same read_run records for all of them. prefetch() resolves a whole batch in
+chunks of CHUNK_SIZE accessions and stores each sample's records in the sheet
+cache under its own filereport URL, i.e. keyed by accession. filereport() and
+sequence_links() then read from there, falling back to the filereport endpoint
+for anything the bulk query did not resolve.
+"""
+
+import json
+import logging
+import requests
+
+try:
+    import sheet_cache
+    from metadata_sources import ENA_FILEREPORT_URL, ENA_SEARCH_URL
+except ModuleNotFoundError:
+    # Imported from the top directory as part of the utils package
+    from utils import sheet_cache
+    from utils.metadata_sources import ENA_FILEREPORT_URL, ENA_SEARCH_URL
+
+log = logging.getLogger(__name__)
+
+# Accessions per search request, each is two clauses of the query
+CHUNK_SIZE = 50
+# The fields of the read_run records kept for each sample, as in the filereport
+FILEREPORT_FIELDS = ["run_accession", "submitted_ftp"]
+
+
+def filereport_url(accession):
+    return ENA_FILEREPORT_URL.format(ena_accession_number=accession)
+
+
+def _search(accessions, timeout, retries):
+    """Return the read_run records of the samples with these accessions"""
+    # The accession sheets may hold either the BioSamples or the ENA accession
+    query = " OR ".join(
+        f'sample_accession="{a}" OR secondary_sample_accession="{a}"'
+        for a in accessions
+    )
+    data = {
+        "result": "read_run",
+        "query": query,
+        "fields": ",".join(
+            ["sample_accession", "secondary_sample_accession"] + FILEREPORT_FIELDS
+        ),
+        "format": "json",
+        "limit": 0,
+    }
+    content = sheet_cache.post(ENA_SEARCH_URL, data, timeout=timeout, retries=retries)
+    return json.loads(content) if content.strip() else []
+
+
+def prefetch(accessions, timeout=60, retries=3):
+    """Resolve the filereports of all accessions with as few requests as possible
+
+    Accessions already in the cache are skipped. Returns a dictionary of the
+    records of each accession resolved by the bulk query; the others are left
+    for filereport() to request one by one.
+    """
+    accessions = [a for a in dict.fromkeys(accessions) if a]
+    wanted = [a for a in accessions if not sheet_cache.is_fresh(filereport_url(a))]
+    log.info(
+        f"ENA filereports: {len(accessions) - len(wanted)} of {len(accessions)} cached"
+    )
+    resolved = {}
+    for i in range(0, len(wanted), CHUNK_SIZE):
+        chunk = wanted[i : i + CHUNK_SIZE]
+        log.debug(f"Searching ENA for the read runs of {len(chunk)} samples")
+        try:
+            records = _search(chunk, timeout, retries)
+        except (requests.RequestException, ValueError) as e:
+            log.warning(f"Bulk ENA search failed ({e}): falling back to filereports")
+            continue
+        chunk = set(chunk)
+        for record in records:
+            report = {k: record.get(k, "") for k in FILEREPORT_FIELDS}
+            for key in ("sample_accession", "secondary_sample_accession"):
+                accession = record.get(key)
+                if accession in chunk:
+                    resolved.setdefault(accession, []).append(report)
+                    break
+    for accession, records in resolved.items():
+        sheet_cache.store(filereport_url(accession), json.dumps(records))
+    log.info(f"ENA filereports: {len(resolved)} resolved in bulk")
+    return resolved
+
+
+def filereport(accession, timeout=60, retries=3):
+    """Return the filereport records of accession, from the cache if possible
+
+    Raises requests.RequestException or ValueError if it cannot be read.
+    """
+    return sheet_cache.read_json(filereport_url(accession), timeout, retries)
+
+
+def sequence_links(records):
+    """Return the (forward, reverse) read URLs in the filereport records
+
+    Raises ValueError unless the submitted files are exactly one pair.
+    """
+    if not records:
+        raise ValueError("Empty ENA filereport")
+    links = records[0]["submitted_ftp"].split(";")
+    if len(links) != 2:
+        raise ValueError(
+            "Cannot find the 2 raw sequence data links in the ENA filereport"
+        )
+    return tuple(f"https://{link}" for link in links)
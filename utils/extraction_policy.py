@@ -0,0 +1,156 @@
+"""
+Which files of the MGF results are kept when an archive is opened
+
+The results archive holds intermediate files that never go into an ro-crate
+(the "discard" files of the README). The policy lists them as globs of their
+path in the results directory: a glob matching a directory discards all of it,
+and a file matching an include glob is kept whatever the excludes say.
+
+prepare_data.py applies the policy while the archive is extracted (as tar
+--exclude options, or while streaming), so the discarded files are never written
+to disk, and create-ro-crate.py prunes them from archives opened without it.
+Both report the bytes saved.
+"""
+
+import fnmatch
+import logging
+from pathlib import Path, PurePosixPath
+
+try:
+    from file_classifier import FileClassifier
+except ModuleNotFoundError:
+    # Imported from the top directory as part of the utils package
+    from utils.file_classifier import FileClassifier
+
+log = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+# Paths relative to the results directory, where * also matches "/"
+DEFAULT_EXCLUDE = (
+    "*/GC-distribution.out.sub-set*",
+    "*/nucleotide-distribution.out.sub-set*",
+    "*/seq-length.out.sub-set*",
+    "*.fastq.gz.sha1",
+    "*.chunks",
+    "qc_summary*",
+    "functional-annotation/temp",
+)
+# The QC summaries and unfiltered reads are sequence data of the crates
+DEFAULT_INCLUDE = (
+    "*.qc_summary",
+    "*.unfiltered_fasta*",
+)
+
+
+class ExtractionReport:
+    """The files discarded from one archive, by exclude glob"""
+
+    def __init__(self, name):
+        self.name = name
+        # glob -> [files, bytes]
+        self.discarded = {}
+
+    def add(self, glob, size):
+        counts = self.discarded.setdefault(glob, [0, 0])
+        counts[0] += 1
+        counts[1] += size
+
+    @property
+    def bytes_saved(self):
+        return sum(size for _, size in self.discarded.values())
+
+    def log(self):
+        if not self.discarded:
+            log.info(f"{self.name}: no files discarded")
+            return
+        files = sum(n for n, _ in self.discarded.values())
+        log.info(
+            f"{self.name}: {files} files discarded,"
+            f" {self.bytes_saved / MiB:.1f} MiB saved"
+        )
+        for glob, (n, size) in self.discarded.items():
+            log.debug(f"  {glob}: {n} files, {size / MiB:.1f} MiB")
+
+
+class ExtractionPolicy:
+    """Include and exclude globs of paths in the results directory"""
+
+    def __init__(self, exclude=DEFAULT_EXCLUDE, include=DEFAULT_INCLUDE):
+        self.exclude = list(exclude)
+        self.include = list(include)
+        patterns = {glob: fnmatch.translate(glob) for glob in self.exclude}
+        # One kind for all the includes, matched along with the excludes
+        patterns[None] = "|".join(
+            f"(?:{fnmatch.translate(glob)})" for glob in self.include
+        ) or "(?!)"
+        self.classifier = FileClassifier(patterns)
+
+    @staticmethod
+    def results_path(name):
+        """The path of an archive member in the results directory, or None
+
+        e.g. HMNJKDSX3.UDI198/results/final.contigs.fa -> final.contigs.fa
+        """
+        parts = PurePosixPath(name).parts
+        if "results" not in parts:
+            return None
+        return "/".join(parts[parts.index("results") + 1 :]) or None
+
+    def discards(self, path, includes=True):
+        """The exclude glob discarding a path of the results, or None
+
+        The path is discarded if it, or a directory it is in, is excluded,
+        unless it is included (and includes is true).
+        """
+        parts = path.split("/")
+        for n in range(len(parts), 0, -1):
+            kinds = self.classifier.kinds_of("/".join(parts[:n]))
+            if includes and None in kinds:
+                return None
+            globs = [kind for kind in kinds if kind is not None]
+            if globs:
+                return globs[0]
+        return None
+
+    def discards_member(self, name, includes=True):
+        """The exclude glob discarding an archive member, or None"""
+        path = self.results_path(name)
+        return self.discards(path, includes) if path else None
+
+    def tar_options(self):
+        """The exclude globs as GNU tar options
+
+        tar cannot keep an included file that an exclude glob matches: the
+        default globs do not overlap.
+        """
+        # As fnmatch: * also matches "/", and a glob matches the path in the
+        # results directory, whatever comes before results/
+        options = ["--wildcards", "--wildcards-match-slash", "--no-anchored"]
+        return options + [f"--exclude=results/{glob}" for glob in self.exclude]
+
+    def prune(self, results_dir, report=None):
+        """Remove the discarded files of an opened results directory, and
+        the discarded directories left empty
+
+        Returns the ExtractionReport.
+        """
+        results_dir = Path(results_dir)
+        report = report or ExtractionReport(results_dir.parent.name)
+        directories = []
+        for entry in sorted(results_dir.rglob("*")):
+            path = entry.relative_to(results_dir).as_posix()
+            glob = self.discards(path)
+            if glob is None:
+                continue
+            if entry.is_dir() and not entry.is_symlink():
+                directories.append(entry)
+            else:
+                log.debug(f"Removing discarded file {entry}")
+                report.add(glob, entry.lstat().st_size)
+                entry.unlink()
+        # Deepest first
+        for directory in reversed(directories):
+            if not any(directory.iterdir()):
+                directory.rmdir()
+        return report
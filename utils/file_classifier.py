@@ -0,0 +1,102 @@
+"""
+Classify file names against a set of patterns with one compiled regex
+
+Each kind of file is described by a regular expression of the whole file name
+(or a glob, or a literal name). All of them are compiled into a single regex
+with one named group per kind. Each group sits in a lookahead, so one match of
+a file name captures every kind it matches. A name matching no kind is
+unmatched, and a name matching several kinds is ambiguous. Both are reported
+for all the files at once by classify_all().
+"""
+
+import re
+import fnmatch
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Classification:
+    """The outcome of classifying a list of file names"""
+
+    def __init__(self):
+        # file name -> kind, in the order given
+        self.matched = {}
+        self.unmatched = []
+        # file name -> [kinds]
+        self.ambiguous = {}
+
+    @property
+    def ok(self):
+        return not self.unmatched and not self.ambiguous
+
+    def by_kind(self):
+        """kind -> [file names]"""
+        kinds = {}
+        for name, kind in self.matched.items():
+            kinds.setdefault(kind, []).append(name)
+        return kinds
+
+    def log_problems(self):
+        """Log an error for every unmatched and ambiguous file"""
+        for name in self.unmatched:
+            log.error(f"Cannot find pattern for {name}")
+        for name, kinds in self.ambiguous.items():
+            log.error(f"{name} matches several patterns: {', '.join(map(str, kinds))}")
+
+
+class FileClassifier:
+    """A compiled set of file name patterns, by kind"""
+
+    def __init__(self, patterns):
+        """patterns is a dict of kind to the regular expression of a file name"""
+        self.kinds = list(patterns)
+        self.patterns = dict(patterns)
+        # Kinds need not be identifiers, so the groups are numbered
+        self.regex = re.compile(
+            "".join(
+                f"(?:(?=(?P<k{i}>{pattern})\\Z)|)"
+                for i, pattern in enumerate(patterns.values())
+            )
+        )
+
+    @classmethod
+    def from_globs(cls, globs):
+        """Classify by glob patterns, each its own kind"""
+        return cls({glob: fnmatch.translate(glob) for glob in globs})
+
+    @classmethod
+    def from_literals(cls, names):
+        """Classify by literal file names, given as a dict of kind to names"""
+        return cls(
+            {
+                # A kind with no names matches nothing
+                kind: "|".join(re.escape(name) for name in kind_names) or "(?!)"
+                for kind, kind_names in names.items()
+            }
+        )
+
+    def kinds_of(self, name):
+        """Every kind the file name matches"""
+        groups = self.regex.match(name).groupdict()
+        return [
+            kind for i, kind in enumerate(self.kinds) if groups[f"k{i}"] is not None
+        ]
+
+    def classify(self, name):
+        """The kind of the file name, or None if it matches none or several"""
+        kinds = self.kinds_of(name)
+        return kinds[0] if len(kinds) == 1 else None
+
+    def classify_all(self, names):
+        """Classify every file name, returning a Classification"""
+        result = Classification()
+        for name in names:
+            kinds = self.kinds_of(name)
+            if len(kinds) == 1:
+                result.matched[name] = kinds[0]
+            elif kinds:
+                result.ambiguous[name] = kinds
+            else:
+                result.unmatched.append(name)
+        return result
@@ -0,0 +1,107 @@
+"""
+Persistent cache of the md5 digests of the payload files
+
+Hashing a multi-GB sequence file means reading all of it, so the md5 of each
+file hashed is kept in a SQLite database, keyed by what identifies an unchanged
+file: (device, inode, size, mtime_ns). A file moved within the file system keeps
+its device, inode and mtime, so it is found again, whereas a file rewritten in
+place gets a new mtime and is hashed again.
+
+The database is kept beside the crate repository, in .dvc/tmp/ (which DVC keeps
+out of git), unless MGF_HASH_CACHE is set. It is shared by the builds and
+threads of a process, and by processes running at the same time.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DB_NAME = "mgf-hashes.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    path TEXT,
+    hashed_at REAL NOT NULL,
+    PRIMARY KEY (device, inode, size, mtime_ns)
+);
+"""
+
+
+def file_key(st):
+    """The cache key of a file, from its os.stat() result"""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class HashCache:
+    """md5 digests of files, by (device, inode, size, mtime_ns)"""
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.db_path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_repo(cls, repo_root):
+        """The hash cache of a crate repository"""
+        db_path = os.environ.get("MGF_HASH_CACHE")
+        if not db_path:
+            db_path = Path(repo_root, ".dvc", "tmp", DB_NAME)
+        return cls(db_path)
+
+    def get(self, st):
+        """The md5 of the file with this os.stat() result, or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT md5 FROM hashes"
+                " WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+                file_key(st),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def lookup(self, path):
+        """The md5 of the file at path if it has not changed, or None"""
+        try:
+            return self.get(os.stat(path))
+        except FileNotFoundError:
+            return None
+
+    def put(self, path, st, md5):
+        """Record the md5 of the file at path, whose os.stat() before hashing
+        was st. Nothing is recorded if the file changed while it was hashed.
+        """
+        try:
+            if file_key(os.stat(path)) != file_key(st):
+                log.debug(f"{path} changed while it was hashed, not caching its md5")
+                return
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*file_key(st), md5, str(path), time.time()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,146 @@
+"""
+Pooled HTTP client for all the remote metadata reads
+
+Every remote read (Github raw files, the MGF Google Sheets, the ENA portal)
+goes through request(), usually via sheet_cache. Each host gets its own
+requests.Session with a keep-alive connection pool, so repeated reads reuse
+the TLS connection, and a semaphore capping the concurrent requests to it.
+Connection errors, timeouts and 5xx answers are retried with jittered
+exponential backoff. The bytes, latency and retries of every request are
+recorded and summarised per host by log_stats().
+"""
+
+import time
+import random
+import logging
+import threading
+from collections import namedtuple
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+# Concurrent requests allowed to each host
+HOST_LIMITS = {
+    "raw.githubusercontent.com": 8,
+    "docs.google.com": 4,
+    "www.ebi.ac.uk": 4,
+}
+DEFAULT_HOST_LIMIT = 4
+
+RequestRecord = namedtuple(
+    "RequestRecord", ["method", "url", "host", "status", "bytes", "latency", "retries"]
+)
+
+_hosts = {}
+_records = []
+_lock = threading.Lock()
+
+
+class _Host:
+    """The connection pool and concurrency limit of one host"""
+
+    def __init__(self, host):
+        limit = HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT)
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=limit, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+
+def _host(host):
+    with _lock:
+        if host not in _hosts:
+            _hosts[host] = _Host(host)
+        return _hosts[host]
+
+
+def _record(record):
+    with _lock:
+        _records.append(record)
+
+
+def request(
+    method, url, headers=None, data=None, timeout=60, retries=3, backoff=1.0
+):
+    """Send a request, retrying connection errors, timeouts and 5xx
+
+    Retries sleep a random time up to backoff * 2**attempt seconds, without
+    holding a slot of the host. Returns the last response, whatever its
+    status, and raises the requests exception of the last attempt if none
+    was received.
+    """
+    host = urlsplit(url).hostname
+    pool = _host(host)
+    for attempt in range(retries + 1):
+        start = time.monotonic()
+        try:
+            with pool.semaphore:
+                response = pool.session.request(
+                    method, url, headers=headers, data=data, timeout=timeout
+                )
+                # Read the body inside the slot so the latency covers it
+                size = len(response.content)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _record(
+                RequestRecord(
+                    method, url, host, None, 0, time.monotonic() - start, attempt
+                )
+            )
+            if attempt == retries:
+                raise
+            log.warning(f"Request to {url} failed ({e}); retrying")
+        else:
+            _record(
+                RequestRecord(
+                    method,
+                    url,
+                    host,
+                    response.status_code,
+                    size,
+                    time.monotonic() - start,
+                    attempt,
+                )
+            )
+            if response.status_code < 500 or attempt == retries:
+                return response
+            log.warning(f"{url} answered {response.status_code}; retrying")
+        time.sleep(random.uniform(0, backoff * 2**attempt))
+
+
+def records():
+    """Return a copy of the record of every request sent"""
+    with _lock:
+        return list(_records)
+
+
+def reset_stats():
+    with _lock:
+        _records.clear()
+
+
+def stats():
+    """Return the requests, bytes, latency, retries and errors of each host"""
+    per_host = {}
+    for r in records():
+        s = per_host.setdefault(
+            r.host,
+            {"requests": 0, "bytes": 0, "latency": 0.0, "retries": 0, "errors": 0},
+        )
+        s["requests"] += 1
+        s["bytes"] += r.bytes
+        s["latency"] += r.latency
+        s["retries"] += 1 if r.retries else 0
+        s["errors"] += 1 if r.status is None or r.status >= 400 else 0
+    return per_host
+
+
+def log_stats():
+    for host, s in sorted(stats().items()):
+        mean = s["latency"] / s["requests"]
+        log.info(
+            f"HTTP {host}: {s['requests']} requests, {s['bytes']} bytes, "
+            f"{mean:.2f}s mean latency, {s['retries']} retries, {s['errors']} errors"
+        )
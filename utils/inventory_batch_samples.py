@@ -1,8 +1,10 @@
 #! /usr/bin/env python3
 
+import argparse
 import logging as log
 from pathlib import Path
-import pandas as pd
+import sheet_cache
+from sample_db import get_db
 from utils import get_refcode_and_source_mat_id_from_run_id
 
 """
@@ -10,16 +12,6 @@ Check the MGF analyses in the run tracking sheet against the RO-Crates in the
 analysis-results-cluster-0[1,2]-crate repositories
 """
 
-# These are in create-ro-crate.py
-# The MGF _Run_Track Google Sheets
-FILTERS_MGF_PATH = (
-    "https://docs.google.com/spreadsheets/d/"
-    "1j9tRRsRCcyViDMTB1X7lx8POY1P5bV7UijxKKSebZAM/gviz/tq?tqx=out:csv&sheet=FILTERS"
-)
-SEDIMENTS_MGF_PATH = (
-    "https://docs.google.com/spreadsheets/d/"
-    "1j9tRRsRCcyViDMTB1X7lx8POY1P5bV7UijxKKSebZAM/gviz/tq?tqx=out:csv&sheet=SEDIMENTS"
-)
 # Ouch needed for relative imports in other scripts
 ROCRATE_REPO_NAME = "analysis-results-cluster-01-crate"
 abs_path_of_current_script = Path(__file__).resolve().parent.parent
@@ -54,12 +46,10 @@ def parse_sheet(sheet, repo_path=ROCRATE_REPO, debug=False):
     """
 
     if sheet == "filters":
-        sheet_path = FILTERS_MGF_PATH
         # DBB_AAAOOSDA_4_1_HMGW5DSX3.UDI226
         name_index = -1
         abbrev = "Wa"
     if sheet == "sediments":
-        sheet_path = SEDIMENTS_MGF_PATH
         # DBH_AAAAOSDA_1_1_HWLTKDRXY.UDI235_clean.fastq.gz
         name_index = -2
         abbrev = "So"
@@ -77,13 +67,12 @@ def parse_sheet(sheet, repo_path=ROCRATE_REPO, debug=False):
         log.debug(d)
 
     log.info(f"Doing {sheet}")
-    data = pd.read_csv(sheet_path, encoding="iso-8859-1")
+    # (Batch Number, ref_code, Forward Read Filename) of the MGF run-track sheet
+    data = get_db().mgf_runs(sheet)
 
     # Check batch numbers
     count = 0
-    for row in data[
-        ["Batch Number", "ref_code", "Forward Read Filename"]
-    ].values.tolist():
+    for row in data:
         if str(row[0]) in ["1", "2", "3", "3.0"]:
             log.debug(f"{row[0]} : {row[1]} = {row[2]}")
             count += 1
@@ -92,9 +81,7 @@ def parse_sheet(sheet, repo_path=ROCRATE_REPO, debug=False):
     # Check source_mat_id
     missing = []
     found = []
-    for row in data[
-        ["Batch Number", "ref_code", "Forward Read Filename"]
-    ].values.tolist():
+    for row in data:
         if str(row[0]) in ["1", "2", "3", "3.0"]:
             run_id = row[2].split("_")[name_index]
             ref_code, source_mat_id = get_refcode_and_source_mat_id_from_run_id(run_id)
@@ -145,7 +132,7 @@ def parse_sheet(sheet, repo_path=ROCRATE_REPO, debug=False):
     )
 
 
-def main(debug=False):
+def main(debug=False, metadata_snapshot=None):
     """
     There are 151 FILTER samples in Batch 1 and 2 combined
     There are 30 SEDIMENT samples in Batch 1 and 2 combined
@@ -156,10 +143,21 @@ def main(debug=False):
     else:
         log_level = log.INFO
     log.basicConfig(format="\t%(levelname)s: %(message)s", level=log_level)
+    sheet_cache.use_snapshot(metadata_snapshot)
 
     for sheet in ["filters", "sediments"]:
         parse_sheet(sheet)
 
 
 if __name__ == "__main__":
-    main(debug=False)
+    parser = argparse.ArgumentParser(
+        description="Check the MGF run tracking sheets against the RO-Crates"
+    )
+    parser.add_argument("-d", "--debug", action="store_true", help="DEBUG logging")
+    parser.add_argument(
+        "--metadata-snapshot",
+        default=None,
+        help="Resolve all remote metadata from this snapshot bundle",
+    )
+    args = parser.parse_args()
+    main(debug=args.debug, metadata_snapshot=args.metadata_snapshot)
@@ -0,0 +1,80 @@
+"""
+Memoized, indexed access to the transformed logsheets of the observatory crates
+
+Each sample needs one row of the "water" or "sediment" sampling sheet of its
+observatory, looked up by source_mat_id, and one row of the observatory sheet,
+looked up by obs_id. Samples of the same observatory share those sheets, so
+each one is parsed once into plain row records with a dictionary index, and
+kept in an LRU cache of MAX_SHEETS sheets so memory stays bounded however many
+observatories a batch covers.
+
+Rows are dictionaries of column name to value, with NaN for empty cells as
+pandas reads them.
+"""
+
+import functools
+import logging
+
+try:
+    import sheet_cache
+    from metadata_sources import sampling_sheet_url, observatory_sheet_url
+except ModuleNotFoundError:
+    # Imported from the top directory as part of the utils package
+    from utils import sheet_cache
+    from utils.metadata_sources import sampling_sheet_url, observatory_sheet_url
+
+log = logging.getLogger(__name__)
+
+# Parsed sheets kept in memory, per loader
+MAX_SHEETS = 32
+
+
+class Logsheet:
+    """The rows of one sheet indexed by one column"""
+
+    def __init__(self, url, records, key):
+        self.url = url
+        self.records = records
+        self.key = key
+        self._index = {}
+        # The first row wins, as with the original .loc[...][0] lookups
+        for record in records:
+            self._index.setdefault(record.get(key), record)
+
+    def get(self, value):
+        """Return the row whose key column equals value, or None"""
+        return self._index.get(value)
+
+    def __len__(self):
+        return len(self.records)
+
+
+@functools.lru_cache(maxsize=MAX_SHEETS)
+def sampling_sheet(obs_id, env_package_short):
+    """The sampling sheet of an observatory, indexed by source_mat_id
+
+    Raises requests.HTTPError if the observatory has no such sheet.
+    """
+    url = sampling_sheet_url(obs_id, env_package_short)
+    log.debug(f"Loading sampling sheet {url}")
+    records = sheet_cache.read_csv(url).to_dict(orient="records")
+    return Logsheet(url, records, "source_mat_id")
+
+
+@functools.lru_cache(maxsize=MAX_SHEETS)
+def observatory_sheet(obs_id, env_package_short):
+    """The observatory sheet rows of env_package_short, indexed by obs_id
+
+    Raises requests.HTTPError if the observatory has no such sheet.
+    """
+    url = observatory_sheet_url(obs_id, env_package_short)
+    log.debug(f"Loading observatory sheet {url}")
+    df = sheet_cache.read_csv(url, encoding="iso-8859-1")
+    records = df.loc[df["env_package"] == env_package_short].to_dict(orient="records")
+    return Logsheet(url, records, "obs_id")
+
+
+def clear():
+    """Drop all the parsed sheets"""
+    sampling_sheet.cache_clear()
+    observatory_sheet.cache_clear()
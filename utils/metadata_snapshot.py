@@ -0,0 +1,211 @@
+#! /usr/bin/env python3
+
+import io
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import textwrap
+import datetime
+import logging as log
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import pandas as pd
+import sheet_cache
+import http_client
+import ena_filereports
+from metadata_sources import (
+    RUN_INFO_PATHS,
+    ENA_ACCESSION_INFO_PATHS,
+    TEMPLATE_URL,
+    FILTERS_MGF_PATH,
+    SEDIMENTS_MGF_PATH,
+    OBSERVATORIES_LOGSHEET,
+    OBSERVATORY_LOGSHEETS_PATH,
+    COMBINED_LOGSHEETS_PATH,
+    ENV_PACKAGES_SHORT,
+    sampling_sheet_url,
+    observatory_sheet_url,
+)
+
+desc = """
+Snapshot all the remote metadata used to build the ro-crates into one local
+bundle, so that create-ro-crate.py and the utils scripts can run on nodes
+without outbound connectivity.
+
+The bundle is a single SQLite file holding the run-information, observatory and
+sampling logsheets of every observatory, the MGF run-track sheets, the ENA
+accession sheets, the ENA filereports of every accession and the crate template.
+Sheets that do not exist upstream (e.g. an observatory without sediment
+samples) are recorded as such, so that offline builds behave as online ones.
+
+$ ./utils/metadata_snapshot.py -o metadata-snapshot.sqlite
+$ ./create-ro-crate.py --metadata-snapshot metadata-snapshot.sqlite ...
+"""
+
+# Checked by sheet_cache.use_snapshot(), increment there when the schema changes
+SNAPSHOT_FORMAT_VERSION = sheet_cache.SNAPSHOT_FORMAT_VERSION
+
+SCHEMA = """
+CREATE TABLE snapshot_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE resources (
+    url TEXT PRIMARY KEY,
+    status INTEGER NOT NULL,
+    content BLOB,
+    fetched_at REAL NOT NULL
+);
+"""
+
+# Concurrent requests while snapshotting
+MAX_WORKERS = 8
+
+
+def _fetch(url):
+    """Return (url, status, content) recording HTTP errors rather than raising"""
+    try:
+        return url, requests.codes.ok, sheet_cache.fetch(url)
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else 0
+        log.info(f"Not available upstream ({status}): {url}")
+        return url, status, None
+
+
+def _fetch_all(urls, resources):
+    urls = [u for u in dict.fromkeys(urls) if u not in resources]
+    log.info(f"Fetching {len(urls)} resources...")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for url, status, content in pool.map(_fetch, urls):
+            resources[url] = (status, content)
+
+
+def _read_csv(resources, url, **kwargs):
+    status, content = resources[url]
+    if status != requests.codes.ok:
+        return None
+    return pd.read_csv(io.BytesIO(content), **kwargs)
+
+
+def _observatory_ids(resources):
+    """Observatories in the governance sheet and in the sequenced samples"""
+    obs_ids = set()
+    df = _read_csv(resources, OBSERVATORIES_LOGSHEET, encoding="iso-8859-1")
+    if df is not None:
+        obs_ids.update(df["EMOBON_observatory_id"].dropna())
+    for url in RUN_INFO_PATHS:
+        df = _read_csv(resources, url, encoding="iso-8859-1")
+        if df is not None:
+            for source_mat_id in df["source_mat_id"].dropna():
+                parts = source_mat_id.split("_")
+                if len(parts) > 2:
+                    obs_ids.add(parts[1])
+    return sorted(obs_ids)
+
+
+def _ena_accessions(resources):
+    accessions = set()
+    for url in ENA_ACCESSION_INFO_PATHS.values():
+        df = _read_csv(resources, url, encoding="iso-8859-1")
+        if df is not None:
+            accessions.update(df["ena_accession_number_sample"].dropna())
+    return sorted(accessions)
+
+
+def write_snapshot(outfile, resources):
+    outfile = Path(outfile)
+    tmp = outfile.with_name(outfile.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    conn = sqlite3.connect(tmp)
+    with conn:
+        conn.executescript(SCHEMA)
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO resources (url, status, content, fetched_at) VALUES (?, ?, ?, ?)",
+            [(url, status, content, now) for url, (status, content) in resources.items()],
+        )
+        conn.executemany(
+            "INSERT INTO snapshot_info (key, value) VALUES (?, ?)",
+            [
+                ("format_version", str(SNAPSHOT_FORMAT_VERSION)),
+                ("created", datetime.datetime.now().isoformat(timespec="seconds")),
+                ("resources", str(len(resources))),
+            ],
+        )
+    conn.close()
+    tmp.replace(outfile)
+
+
+def main(outfile=None, debug=False):
+    log.basicConfig(
+        format="\t%(levelname)s: %(message)s", level=log.DEBUG if debug else log.INFO
+    )
+    if outfile is None:
+        stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+        outfile = f"metadata-snapshot-{stamp}.sqlite"
+
+    # Revalidate everything, a snapshot should be current
+    sheet_cache.configure(ttl=0)
+
+    resources = {}
+    try:
+        _fetch_all(
+            RUN_INFO_PATHS
+            + list(ENA_ACCESSION_INFO_PATHS.values())
+            + [
+                FILTERS_MGF_PATH,
+                SEDIMENTS_MGF_PATH,
+                OBSERVATORIES_LOGSHEET,
+                OBSERVATORY_LOGSHEETS_PATH,
+                COMBINED_LOGSHEETS_PATH,
+                TEMPLATE_URL,
+            ],
+            resources,
+        )
+        obs_ids = _observatory_ids(resources)
+        log.info(f"Found {len(obs_ids)} observatories")
+        _fetch_all(
+            [
+                url(obs_id, env_package_short)
+                for obs_id in obs_ids
+                for env_package_short in ENV_PACKAGES_SHORT
+                for url in [sampling_sheet_url, observatory_sheet_url]
+            ],
+            resources,
+        )
+        accessions = _ena_accessions(resources)
+        log.info(f"Found {len(accessions)} ENA accessions")
+        # Bulk search first, then one filereport for each accession it missed
+        for accession, records in ena_filereports.prefetch(accessions).items():
+            resources[ena_filereports.filereport_url(accession)] = (
+                requests.codes.ok,
+                json.dumps(records).encode("utf-8"),
+            )
+        _fetch_all([ena_filereports.filereport_url(a) for a in accessions], resources)
+    except requests.RequestException as e:
+        log.error(f"Cannot build the metadata snapshot: {e}")
+        sys.exit()
+
+    write_snapshot(outfile, resources)
+    sheet_cache.log_stats()
+    http_client.log_stats()
+    log.info(f"Written metadata snapshot of {len(resources)} resources to {outfile}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent(desc),
+    )
+    parser.add_argument(
+        "-o",
+        "--outfile",
+        default=None,
+        help="Snapshot file (default: metadata-snapshot-<timestamp>.sqlite)",
+    )
+    parser.add_argument("-d", "--debug", action="store_true", help="DEBUG logging")
+    args = parser.parse_args()
+    main(args.outfile, args.debug)
@@ -0,0 +1,107 @@
+"""
+Addresses of the remote metadata used to build the ro-crates
+
+Kept in one place so that create-ro-crate.py, the utils scripts and the
+metadata snapshot all read the same sheets.
+"""
+
+# run-information files for each batch set to sequencing facility
+BATCH1_RUN_INFO_PATH = (
+    "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/main/"
+    "shipment/batch-001/run-information-batch-001.csv"
+)
+BATCH2_RUN_INFO_PATH = (
+    "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/main/"
+    "shipment/batch-002/run-information-batch-002.csv"
+)
+BATCH3_RUN_INFO_PATH = (
+    "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/main/"
+    "shipment/batch-003-0/run-information-batch-003.csv"
+)
+RUN_INFO_PATHS = [BATCH1_RUN_INFO_PATH, BATCH2_RUN_INFO_PATH, BATCH3_RUN_INFO_PATH]
+
+# ENA ACCESSSION INFO for each batch
+BATCH1_ENA_ACCESSION_INFO_PATH = (
+    "https://raw.githubusercontent.com/emo-bon/sequencing-data/refs/heads/main/"
+    "shipment/batch-001/ena-accession-numbers-batch-001.csv"
+)
+BATCH2_ENA_ACCESSION_INFO_PATH = (
+    "https://raw.githubusercontent.com/emo-bon/sequencing-data/refs/heads/main/"
+    "shipment/batch-002/ena-accession-numbers-batch-002.csv"
+)
+# Currently missing
+# BATCH3_ENA_ACCESSION_INFO_PATH = (
+#    "https://raw.githubusercontent.com/emo-bon/sequencing-data/refs/heads/main/"
+#    "shipment/batch-003-0/ena-accession-numbers-batch-003.csv"
+# )
+ENA_ACCESSION_INFO_PATHS = {
+    1: BATCH1_ENA_ACCESSION_INFO_PATH,
+    2: BATCH2_ENA_ACCESSION_INFO_PATH,
+}
+
+# ENA ACCESSION filereport for a sample
+ENA_FILEREPORT_URL = (
+    "https://www.ebi.ac.uk/ena/portal/api/filereport?accession={ena_accession_number}"
+    "&result=read_run&fields=submitted_ftp&format=json&download=true&limit=-1"
+)
+
+# ENA portal search, to resolve the filereports of many samples in one request
+ENA_SEARCH_URL = "https://www.ebi.ac.uk/ena/portal/api/search"
+
+# The ro-crate metadata template from Github
+TEMPLATE_URL = (
+    "https://raw.githubusercontent.com/emo-bon/MetaGOflow-Data-Products-RO-Crate"
+    "/main/ro-crate-metadata.json-template"
+)
+
+# The MGF _Run_Track Google Sheets
+FILTERS_MGF_PATH = (
+    "https://docs.google.com/spreadsheets/d/"
+    "1j9tRRsRCcyViDMTB1X7lx8POY1P5bV7UijxKKSebZAM/gviz/tq?tqx=out:csv&sheet=FILTERS"
+)
+SEDIMENTS_MGF_PATH = (
+    "https://docs.google.com/spreadsheets/d/"
+    "1j9tRRsRCcyViDMTB1X7lx8POY1P5bV7UijxKKSebZAM/gviz/tq?tqx=out:csv&sheet=SEDIMENTS"
+)
+
+# The list of EMO BON observatories
+OBSERVATORIES_LOGSHEET = (
+    "https://raw.githubusercontent.com/emo-bon/governance-crate/"
+    "refs/heads/main/observatories.csv"
+)
+
+# The validated logsheets used for the README sample table
+OBSERVATORY_LOGSHEETS_PATH = (
+    "https://raw.githubusercontent.com/emo-bon/emo-bon-data-validation/"
+    "refs/heads/main/validated-data/Observatory_combined_logsheets_validated.csv"
+)
+COMBINED_LOGSHEETS_PATH = (
+    "https://raw.githubusercontent.com/emo-bon/emo-bon-data-validation/"
+    "refs/heads/main/validated-data/Batch1and2_combined_logsheets_2024-11-12.csv"
+)
+
+# The transformed logsheets of each observatory crate
+# env_package_short is either "water" or "sediment"
+ENV_PACKAGES_SHORT = ["water", "sediment"]
+
+
+def sampling_sheet_url(obs_id, env_package_short):
+    """
+    https://raw.githubusercontent.com/emo-bon/observatory-bpns-crate/refs/heads/main/logsheets/transformed/water_sampling.csv
+    """
+    return (
+        f"https://raw.githubusercontent.com/emo-bon/"
+        f"observatory-{obs_id.lower()}-crate/"
+        f"refs/heads/main/logsheets/transformed/{env_package_short}_sampling.csv"
+    )
+
+
+def observatory_sheet_url(obs_id, env_package_short):
+    """
+    https://github.com/emo-bon/observatory-rformosa-crate/blob/main/logsheets/transformed/sediment_observatory.csv
+    """
+    return (
+        f"https://raw.githubusercontent.com/emo-bon/"
+        f"observatory-{obs_id.lower()}-crate/"
+        f"refs/heads/main/logsheets/transformed/{env_package_short}_observatory.csv"
+    )
@@ -0,0 +1,243 @@
+"""
+Codecs the sequence data payload of the ro-crates is compressed with
+
+prepare_data.py compresses the sequence files of the MGF results with one of
+them (--codec), and create-ro-crate.py describes them with its file suffix and
+encodingFormat (payload_codec in the YAML configuration):
+
+    bzip2   .bz2  whole-file bzip2 with lbzip2 or bzip2, as always (default)
+    zstd    .zst  seekable zstd: independent frames of ZSTD_FRAME_SIZE bytes
+                  and a seek table, in the zstd seekable format
+    bgzf    .gz   BGZF: independent gzip blocks of up to 64 KiB, as bgzip
+                  writes them (and as samtools/htslib read them)
+
+A zstd or BGZF file is read by any zstd or gzip decompressor, but its frames or
+blocks can also be decompressed in parallel, or from an offset, e.g. a byte
+range of the file on S3. Their frames and blocks are compressed in a thread
+pool, since zlib and zstandard release the GIL. zstd needs the zstandard
+module; this module is not named codecs.py so as not to hide the standard
+library codecs module from the scripts in utils/.
+"""
+
+import os
+import zlib
+import struct
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CODEC = "bzip2"
+BUFFER_SIZE = 1024 * 1024
+
+ZSTD_LEVEL = 12
+ZSTD_FRAME_SIZE = 4 * 1024 * 1024
+# The seek table is a skippable frame at the end of the file
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+
+BGZF_LEVEL = 6
+# As bgzip: the compressed block must fit in 64 KiB
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def _blocks(src, size):
+    while True:
+        block = src.read(size)
+        if not block:
+            return
+        yield block
+
+
+def _parallel_map(function, blocks, threads):
+    """function(block) for each block, in order, with threads at a time and
+    a bounded number of blocks read ahead
+    """
+    if threads <= 1:
+        yield from map(function, blocks)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = []
+        for block in blocks:
+            pending.append(pool.submit(function, block))
+            if len(pending) >= 2 * threads:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+class Codec:
+    """A payload codec: its name, file suffix and encodingFormat"""
+
+    name = None
+    suffix = None
+    encoding_format = None
+    # Whether it compresses a file with several threads
+    parallel = True
+
+    def compress_stream(self, src, out, threads=1):
+        """Compress the file object src into the file object out"""
+        raise NotImplementedError
+
+    def compress_file(self, path, threads=1):
+        """Compress the file at path into path + suffix, removing path"""
+        path = os.fspath(path)
+        dest = path + self.suffix
+        tmp = f"{dest}.tmp"
+        try:
+            with open(path, "rb") as src, open(tmp, "wb") as out:
+                self.compress_stream(src, out, threads)
+            os.replace(tmp, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        os.unlink(path)
+        return dest
+
+    def __repr__(self):
+        return f"{type(self).__name__}()"
+
+
+class Bzip2(Codec):
+    """Whole-file bzip2, with lbzip2 when it is installed"""
+
+    name = "bzip2"
+    suffix = ".bz2"
+    encoding_format = "application/x-bzip2"
+
+    def __init__(self, program="bzip2"):
+        self.program = program
+        self.parallel = program == "lbzip2"
+
+    def command(self, threads=1):
+        """The command compressing a file in place, or stdin to stdout when
+        no file is added to it
+        """
+        if self.program == "lbzip2":
+            return ["lbzip2", "-9", "-n", f"{threads or 1}"]
+        return ["bzip2", "-9"]
+
+    def compress_stream(self, src, out, threads=1):
+        writer = subprocess.Popen(
+            self.command(threads), stdin=subprocess.PIPE, stdout=out
+        )
+        try:
+            for block in _blocks(src, BUFFER_SIZE):
+                writer.stdin.write(block)
+        finally:
+            writer.stdin.close()
+            if writer.wait():
+                raise subprocess.CalledProcessError(writer.returncode, writer.args)
+
+    def compress_file(self, path, threads=1):
+        # (l)bzip2 compresses in place itself
+        subprocess.check_call(self.command(threads) + [f"{path}"])
+        return f"{path}{self.suffix}"
+
+
+class SeekableZstd(Codec):
+    """zstd in the seekable format: one frame per ZSTD_FRAME_SIZE bytes"""
+
+    name = "zstd"
+    suffix = ".zst"
+    encoding_format = "application/zstd"
+
+    def __init__(self, level=ZSTD_LEVEL, frame_size=ZSTD_FRAME_SIZE):
+        if zstandard is None:
+            raise RuntimeError("The zstd codec needs zstandard: pip install zstandard")
+        self.level = level
+        self.frame_size = frame_size
+
+    def _compress_frame(self, block):
+        compressor = zstandard.ZstdCompressor(
+            level=self.level, write_checksum=True, write_content_size=True
+        )
+        return compressor.compress(block), len(block)
+
+    def compress_stream(self, src, out, threads=1):
+        entries = []
+        for frame, size in _parallel_map(
+            self._compress_frame, _blocks(src, self.frame_size), threads
+        ):
+            out.write(frame)
+            entries.append(struct.pack("<II", len(frame), size))
+        # Seek table: entries, then the number of frames, a descriptor
+        # without checksums and the seekable magic number
+        table = b"".join(entries) + struct.pack(
+            "<IBI", len(entries), 0, ZSTD_SEEKABLE_MAGIC
+        )
+        out.write(struct.pack("<II", ZSTD_SKIPPABLE_MAGIC, len(table)))
+        out.write(table)
+
+
+class Bgzf(Codec):
+    """BGZF, the blocked gzip of htslib"""
+
+    name = "bgzf"
+    suffix = ".gz"
+    encoding_format = "application/gzip"
+
+    def __init__(self, level=BGZF_LEVEL):
+        self.level = level
+
+    def _compress_block(self, block):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        data = compressor.compress(block) + compressor.flush()
+        # gzip header with the BC extra field holding the block size - 1
+        header = struct.pack(
+            "<4BIBBHBBHH",
+            0x1F,
+            0x8B,
+            8,
+            4,
+            0,
+            0,
+            0xFF,
+            6,
+            ord("B"),
+            ord("C"),
+            2,
+            18 + len(data) + 8 - 1,
+        )
+        return header + data + struct.pack("<II", zlib.crc32(block), len(block))
+
+    def compress_stream(self, src, out, threads=1):
+        for block in _parallel_map(
+            self._compress_block, _blocks(src, BGZF_BLOCK_SIZE), threads
+        ):
+            out.write(block)
+        out.write(BGZF_EOF)
+
+
+CODECS = {codec.name: codec for codec in (Bzip2, SeekableZstd, Bgzf)}
+
+
+def payload_format(name):
+    """The file suffix and encodingFormat of the codec called name
+
+    Raises ValueError for an unknown codec.
+    """
+    if name not in CODECS:
+        raise ValueError(
+            f"Unknown payload codec {name}, use one of: {', '.join(CODECS)}"
+        )
+    return CODECS[name].suffix, CODECS[name].encoding_format
+
+
+def get_codec(name, bzip2_program="bzip2"):
+    """The codec called name, with bzip2_program for bzip2
+
+    Raises ValueError for an unknown codec, and RuntimeError when the codec
+    needs a module that is not installed.
+    """
+    payload_format(name)
+    if name == Bzip2.name:
+        return Bzip2(bzip2_program)
+    return CODECS[name]()
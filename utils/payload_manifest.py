@@ -0,0 +1,109 @@
+"""
+Per-build manifest of the payload files of an ro-crate
+
+Every stage of a build (checking the MGF results, adding the sequence
+categorisation, sequence data and ARUP turtle files, writing the DVC upload
+script, linking the stanzas to the uploaded files) reads and extends the
+manifest of that build, rather than a module-level list, so several crates can
+be built in one process, one after the other or at the same time.
+
+Each file is recorded with its role, its path in the crate, its source path in
+the MGF results archive, its size, its md5 digest once added to DVC, and the
+@id of the stanza that describes it.
+"""
+
+import logging
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# Roles of the payload files
+MANDATORY = "mandatory"
+WORKFLOW_YAML = "workflow_yaml"
+SEQUENCE_CATEGORISATION = "sequence_categorisation"
+SEQUENCE_DATA = "sequence_data"
+ARUP = "arup"
+
+# Files moved to another directory of the crate, by their path in the results
+CRATE_PATHS = {
+    "./RNA-counts": "./taxonomy-summary/RNA-counts",
+}
+
+
+class PayloadFile:
+    """A file of the ro-crate payload"""
+
+    __slots__ = ("path", "role", "crate_path", "source", "size", "digest", "stanza")
+
+    def __init__(self, path, role, source=None):
+        # As listed in the MGF results, e.g. "./RNA-counts"
+        self.path = path
+        self.role = role
+        # Where it ends up in the crate, e.g. "./taxonomy-summary/RNA-counts"
+        self.crate_path = CRATE_PATHS.get(path, path)
+        self.source = source
+        self.size = None
+        self.digest = None
+        self.stanza = None
+
+    @property
+    def name(self):
+        return Path(self.path).name
+
+    def __repr__(self):
+        return f"PayloadFile({self.path!r}, {self.role!r})"
+
+
+class PayloadManifest:
+    """The payload files of one build, in the order they were added
+
+    Paths are given with {placeholders} (e.g. "{prefix}") and stored formatted
+    with the conf of the build.
+    """
+
+    def __init__(self, conf, paths=(), role=MANDATORY):
+        self.conf = conf
+        self._files = {}
+        self._crate_paths = {}
+        self.extend(paths, role)
+
+    def _format(self, path):
+        return path.format(**self.conf)
+
+    def add(self, path, role, source=None):
+        """Add a file, or return the one already at path"""
+        path = self._format(path)
+        if path not in self._files:
+            f = self._files[path] = PayloadFile(path, role, source)
+            self._crate_paths[f.crate_path] = f
+        return self._files[path]
+
+    def extend(self, paths, role):
+        return [self.add(path, role) for path in paths]
+
+    def remove(self, path):
+        f = self._files.pop(self._format(path))
+        del self._crate_paths[f.crate_path]
+        return f
+
+    def get(self, path):
+        return self._files.get(self._format(path))
+
+    def by_crate_path(self, crate_path):
+        """The file at crate_path in the crate (a stanza @id), or None"""
+        return self._crate_paths.get(crate_path)
+
+    def __contains__(self, path):
+        return self._format(path) in self._files
+
+    def __iter__(self):
+        return iter(list(self._files.values()))
+
+    def __len__(self):
+        return len(self._files)
+
+    def paths(self, role=None):
+        return [f.path for f in self if role is None or f.role == role]
+
+    def __repr__(self):
+        return f"PayloadManifest({self.paths()!r})"
@@ -2,14 +2,23 @@
 
 from pathlib import Path
 import sys
-import os
+import shutil
 import logging as log
 import argparse
 import textwrap
 import subprocess
-import psutil
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import find_bzip2, open_archive, get_refcode_and_source_mat_id_from_run_id
+import sheet_cache
+from cpu_budget import CpuBudget, available_cpus
+from extraction_policy import ExtractionPolicy, ExtractionReport
+from file_classifier import FileClassifier
+from payload_codecs import CODECS, DEFAULT_CODEC, get_codec
+from utils import (
+    find_bzip2,
+    open_archive,
+    get_refcode_and_source_mat_id_from_run_id,
+)
 
 desc = """
 Prepare the MGF data archives for the ro-crate building. All files in the target
@@ -18,6 +27,17 @@ current working directory.
 
 This script opens the MGF results archive and compresses the individual data
 files from building the ro-crate.
+
+The intermediate files no ro-crate uses (see extraction_policy.py) are not
+extracted, unless -k is given.
+
+Several archives are prepared at the same time (-j): the cores available to
+the script (its CPU affinity and cgroup quota, or -c) are shared between the
+extractions and recompressions running at the same time.
+
+The sequence files are compressed with bzip2, or with --codec zstd or bgzf
+(see payload_codecs.py), which then must be the payload_codec of the YAML
+configuration of create-ro-crate.py.
 """
 
 FILE_PATTERNS = [
@@ -30,6 +50,12 @@ FILE_PATTERNS = [
     "*.merged.unfiltered_fasta",
     "final.contigs.fa",
 ]
+# Classifies every file of a results directory in one match per file
+FILE_CLASSIFIER = FileClassifier.from_globs(FILE_PATTERNS)
+
+# Archives prepared at the same time: reading one archive while compressing
+# the files of another keeps the cores busy
+DEFAULT_JOBS = min(4, max(1, available_cpus() // 4))
 
 # RO_CRATE_REPO_PATH = "../analysis-results-cluster-01-crate"
 RO_CRATE_REPO_PATH = "../analysis-results-cluster-02-crate"
@@ -46,16 +72,135 @@ def get_existing_rorates():
     return existing_rocrates_names
 
 
+def is_sequence_file(member_name):
+    """True for a member of a results archive compressed by prepare_data
+
+    e.g. HMNJKDSX3.UDI198/results/final.contigs.fa or ./results/final.contigs.fa
+    """
+    parts = Path(member_name).parts
+    return (
+        len(parts) in (2, 3)
+        and parts[-2] == "results"
+        and FILE_CLASSIFIER.classify(parts[-1]) is not None
+    )
+
+
+def compress_file(path, codec, budget):
+    """Compress the file at path once the budget has cores for it"""
+    # bzip2 uses a single core
+    wanted = None if codec.parallel else 1
+    with budget.cores(wanted) as threads:
+        log.debug(f"Compressing {path} with {codec.name} ({threads} threads)")
+        codec.compress_file(path, threads)
+
+
+def prepare_archive(
+    tarball_file,
+    run_id,
+    rocrate_name,
+    outpath,
+    bzip2_program,
+    budget,
+    stream=False,
+    policy=None,
+    codec=None,
+):
+    """Open an archive into outpath and compress its sequence files
+
+    With stream, the sequence files are compressed as the archive is read.
+    The files the extraction policy discards are not extracted. Returns the
+    ExtractionReport, or None if the archive could not be opened.
+    """
+    with budget.job():
+        # Open the archive
+        log.info(f"Opening archive {tarball_file}")
+        report = ExtractionReport(str(run_id))
+        codec = codec or get_codec(DEFAULT_CODEC, bzip2_program)
+        # When streaming a decompressor and a compressor run at the same time
+        wanted = None if codec.parallel else (2 if stream else 1)
+        with budget.cores(wanted) as threads:
+            open_archive(
+                tarball_file,
+                bzip2_program,
+                outpath,
+                threads,
+                recompress=is_sequence_file if stream else None,
+                policy=policy,
+                report=report,
+                codec=codec,
+            )
+        prepared = Path(outpath, str(run_id))
+        path_to_results = prepared / "results"
+        if not path_to_results.exists():
+            log.error(f"Unable to open {tarball_file}")
+            # Not left behind, so that the next run prepares it again
+            shutil.rmtree(prepared, ignore_errors=True)
+            return None
+        try:
+            if policy is not None:
+                report.log()
+
+            log.debug(f"Path to results: {path_to_results}")
+            # Compress the sequence archive files
+            log.info(f"Compressing sequence files for {run_id}")
+
+            # Deal with MOTUS - sometimes it's empty and has the name empty.motus.tsv
+            src = path_to_results / "empty.motus.tsv"
+            if src.exists():
+                # Get prefix
+                # Already compressed when streaming
+                sf = list(path_to_results.glob("*.merged.fasta*"))
+                prefix = sf[0].name.split(".")[0]
+                # Change file name
+                dest = src.with_name(f"{prefix}.merged.motus.tsv")
+                src.rename(dest)
+
+            # One listing of the results, rather than one glob per pattern. When
+            # streaming, only the renamed motus file is left to compress.
+            classification = FILE_CLASSIFIER.classify_all(
+                f.name for f in path_to_results.iterdir() if f.is_file()
+            )
+            sequence_files = classification.by_kind()
+            paths = [
+                path_to_results / f
+                for fp in FILE_PATTERNS
+                for f in sequence_files.get(fp, [])
+            ]
+            # The files wait for cores in the budget, not for each other
+            with ThreadPoolExecutor(max_workers=max(1, len(paths))) as pool:
+                for future in [
+                    pool.submit(compress_file, path, codec, budget) for path in paths
+                ]:
+                    future.result()
+        except BaseException:
+            # A half prepared archive would be skipped by the next run
+            log.error(f"Failed to prepare {run_id}, removing {prepared}")
+            shutil.rmtree(prepared, ignore_errors=True)
+            raise
+        log.info(f"Finished writing {rocrate_name}")
+        return report
+
+
 def main(
     target_directory,
     max_num,
     debug=False,
+    metadata_snapshot=None,
+    jobs=1,
+    cores=None,
+    stream=False,
+    keep_all=False,
+    codec_name=DEFAULT_CODEC,
 ):
     log.basicConfig(
-        format="\t%(levelname)s: %(message)s", level=log.DEBUG if debug else log.INFO
+        format=(
+            "\t%(levelname)s: [%(threadName)s] %(message)s"
+            if jobs > 1
+            else "\t%(levelname)s: %(message)s"
+        ),
+        level=log.DEBUG if debug else log.INFO,
     )
-
-    home_dir = Path.cwd()
+    sheet_cache.use_snapshot(metadata_snapshot)
 
     # Check the target_directory name
     target_directory = Path(target_directory)
@@ -70,7 +215,7 @@ def main(
         sys.exit()
 
     # Get list of tarball files
-    tarball_files = list(Path(target_directory).glob("*.tar.bz2"))
+    tarball_files = [p.resolve() for p in Path(target_directory).glob("*.tar.bz2")]
 
     log.debug(f"Found {len(tarball_files)} tarball files")
     for tarball in tarball_files:
@@ -80,24 +225,25 @@ def main(
         sys.exit()
 
     # Where the open archives will go
-    outpath = Path("prepared_archives")
+    outpath = Path("prepared_archives").resolve()
     if outpath.exists():
         log.debug("'prepared_archives' directory already exists")
     else:
         log.debug("Creating 'prepared_archives' directory")
         outpath.mkdir()
-    # Change to output directory
-    log.debug(f"Changing directory to {outpath}")
-
-    os.chdir(outpath)
-    working_dir = Path.cwd()
 
     existing_rocrates_names = get_existing_rorates()
 
     bzip2_program = find_bzip2()
+    try:
+        codec = get_codec(codec_name, bzip2_program)
+    except (ValueError, RuntimeError) as e:
+        log.error(e)
+        sys.exit()
 
-    # Loop through the tarball files
+    # Choose the tarball files to prepare
     count = 0
+    selected = []
     for tarball_file in tarball_files:
         log.debug(f"Preparing tarball_file: {tarball_file}")
 
@@ -119,7 +265,7 @@ def main(
         if rocrate_name in existing_rocrates_names:
             log.info(f"RO-Crate already exists: {rocrate_name}... continuing")
             continue
-        elif run_id.exists():
+        elif Path(outpath, run_id).exists():
             log.info(f"Found existing prepared archive {run_id}... continuing")
             continue
         else:
@@ -128,63 +274,61 @@ def main(
                 break
             else:
                 count += 1
+        selected.append((tarball_file, run_id, rocrate_name))
 
-        # Open the archive
-        log.info(f"Opening archive {tarball_file}")
-        open_archive(tarball_file, bzip2_program)
-        path_to_results = Path(str(run_id), "results")
-        if not path_to_results.exists():
-            log.error(f"Unable to open {tarball_file}")
-            continue
-
-        log.debug(f"Path to results: {path_to_results}")
-        os.chdir(path_to_results)
-        log.debug(f"CWD: {os.getcwd()}")
-        # Compress the sequence archive files
-        log.info(f"Compressing sequence files for {run_id}")
-
-        # Deal with MOTUS - sometimes it's empty and has the name empty.motus.tsv
-        if Path("./empty.motus.tsv").exists():
-            # Get prefix
-            sf = list(Path("./").glob("*.merged.fasta"))
-            prefix = sf[0].parts[0].split(".")[0]
-            # Change file name
-            src = Path("./empty.motus.tsv")
-            dest = src.with_name(f"{prefix}.merged.motus.tsv")
-            src.rename(dest)
-
-        for fp in FILE_PATTERNS:
-            sf = Path("./").glob(fp)
-            for f in sf:
-                log.debug(f"Compressing {f}")
-                # Can't use f{} style formatting in subprocess call
-                # of the program name
-                if bzip2_program == "lbzip2":
-                    threads = psutil.cpu_count() - 4
-                    log.debug(f"Using lbzip2 with {threads} threads")
-                    subprocess.check_call(
-                        [
-                            "lbzip2",
-                            "-9",
-                            f"-n {threads}",
-                            f"./{f}",
-                        ]
-                    )
-                elif bzip2_program == "bzip2":
-                    log.debug(f"bzip2 -9 {f}")
-                    subprocess.check_call(
-                        [
-                            "bzip2",
-                            "-9",
-                            f"./{f}",
-                        ]
-                    )
-        os.chdir(working_dir)
-        log.info(f"Finished writing {rocrate_name}")
+    budget = CpuBudget(cores)
+    log.info(
+        f"Preparing {len(selected)} archives, {jobs} at a time,"
+        f" with {budget.total} cores, compressing with {codec.name}"
+    )
+    policy = None if keep_all else ExtractionPolicy()
+    failed = []
+    reports = []
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="archive") as pool:
+        futures = {
+            pool.submit(
+                prepare_archive,
+                tarball_file,
+                run_id,
+                rocrate_name,
+                outpath,
+                bzip2_program,
+                budget,
+                stream,
+                policy,
+                codec,
+            ): tarball_file
+            for tarball_file, run_id, rocrate_name in selected
+        }
+        for future, tarball_file in futures.items():
+            try:
+                report = future.result()
+                if report is None:
+                    failed.append(tarball_file)
+                else:
+                    reports.append(report)
+            except SystemExit:
+                # Already logged, e.g. a temp-<run_id> directory left behind
+                log.error(f"Failed to prepare {tarball_file}")
+                failed.append(tarball_file)
+            except subprocess.CalledProcessError as e:
+                log.error(f"Failed to prepare {tarball_file}: {e}")
+                failed.append(tarball_file)
+            except Exception:
+                log.exception(f"Unexpected error preparing {tarball_file}")
+                failed.append(tarball_file)
 
-    # CD back to home directory
-    log.debug(f"Changing directory to {home_dir}")
-    os.chdir(home_dir)
+    if policy is not None:
+        saved = sum(report.bytes_saved for report in reports)
+        log.info(
+            f"{saved / (1024 * 1024):.1f} MiB of discarded files not extracted"
+            f" from {len(reports)} archives"
+        )
+    if failed:
+        log.error(f"{len(failed)} of {len(selected)} archives failed:")
+        for tarball_file in failed:
+            log.error(f"  {tarball_file}")
+        sys.exit(1)
     log.info("Done")
 
 
@@ -207,10 +351,59 @@ if __name__ == "__main__":
         default=10,
         type=int,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help=f"Number of archives prepared at the same time (default: {DEFAULT_JOBS})",
+        default=DEFAULT_JOBS,
+        type=int,
+    )
+    parser.add_argument(
+        "-c",
+        "--cores",
+        help=(
+            "Cores shared by the extractions and recompressions"
+            f" (default: the {available_cpus()} available)"
+        ),
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        help=(
+            "Read each archive once, compressing the sequence files as they are"
+            " read rather than writing them uncompressed first"
+        ),
+    )
+    parser.add_argument(
+        "-k",
+        "--keep_all",
+        action="store_true",
+        help="Extract every file, including those the extraction policy discards",
+    )
+    parser.add_argument(
+        "--codec",
+        choices=list(CODECS),
+        default=DEFAULT_CODEC,
+        help=f"Codec the sequence files are compressed with (default: {DEFAULT_CODEC})",
+    )
     parser.add_argument("-d", "--debug", action="store_true", help="DEBUG logging")
+    parser.add_argument(
+        "--metadata-snapshot",
+        default=None,
+        help="Resolve all remote metadata from this snapshot bundle",
+    )
     args = parser.parse_args()
     main(
         args.target_directory,
         args.max_num,
         args.debug,
+        args.metadata_snapshot,
+        args.jobs,
+        args.cores,
+        args.stream,
+        args.keep_all,
+        args.codec,
     )
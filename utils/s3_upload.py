@@ -0,0 +1,622 @@
+#! /usr/bin/env python3
+
+"""
+Upload engine for the payload of the ro-crates, straight to the DVC remote
+
+The payload files are content addressed on the DVC remote as DVC 3 lays them
+out, {bucket}/{prefix}/files/md5/xx/yyyy, so once a file has been added to DVC
+(see dvc_hash.py) it can be uploaded without DVC. Files above the part size go
+up as multipart uploads, and the parts of all the files (of all the crates
+uploaded at the same time) share one pool of concurrent requests. The
+throughput is logged at the end.
+
+Before anything is sent, the files/md5/xx/ prefixes of the files are listed
+(one listing per prefix rather than a HEAD request per file), and the objects
+already on the remote with the same size are skipped. Each crate has an upload
+journal, .dvc/tmp/s3-uploads/<crate>.jsonl in the repository, recording the
+md5, size, multipart upload id and completed parts of each object. When an
+upload is restarted, an unfinished multipart upload is resumed and only its
+missing parts are sent.
+
+The remote (bucket, prefix, endpointurl, profile, region and keys) is read
+from the repository's .dvc/config and .dvc/config.local, as create-ro-crate.py
+does. The endpoint can be overridden (MGF_S3_ENDPOINT), e.g. to test against
+MinIO or moto in server mode.
+
+boto3 is only needed for this module.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import textwrap
+import threading
+import configparser
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    from dvc_hash import stub_index
+except ModuleNotFoundError:
+    # Imported from the top directory as part of the utils package
+    from utils.dvc_hash import stub_index
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ModuleNotFoundError:
+    boto3 = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_REMOTE = "myremote"
+MiB = 1024 * 1024
+DEFAULT_PART_SIZE = 64 * MiB
+DEFAULT_CONCURRENCY = 10
+JOURNAL_DIR = Path(".dvc", "tmp", "s3-uploads")
+
+S3Remote = namedtuple(
+    "S3Remote",
+    [
+        "name",
+        "bucket",
+        "prefix",
+        "endpoint_url",
+        "profile",
+        "region",
+        "access_key_id",
+        "secret_access_key",
+    ],
+)
+
+UploadRecord = namedtuple("UploadRecord", ["path", "key", "bytes", "seconds", "skipped"])
+
+
+def read_dvc_remote(repo_root, name=None):
+    """The S3 remote of a DVC repository, the default one unless name is given
+
+    Raises ValueError if the repository has no such S3 remote.
+    """
+    dvc_dir = Path(repo_root, ".dvc")
+    config = configparser.ConfigParser()
+    config.read([dvc_dir / "config", dvc_dir / "config.local"])
+    if name is None:
+        name = config.get("core", "remote", fallback=DEFAULT_REMOTE)
+    section = f"'remote \"{name}\"'"
+    if not config.has_section(section):
+        raise ValueError(f"No DVC remote {name} in {dvc_dir / 'config'}")
+    remote = config[section]
+    url = remote.get("url", "")
+    if not url.startswith("s3://"):
+        raise ValueError(f"DVC remote {name} is not an S3 remote: {url}")
+    bucket, _, prefix = url[len("s3://") :].partition("/")
+    return S3Remote(
+        name,
+        bucket,
+        prefix.strip("/"),
+        os.environ.get("MGF_S3_ENDPOINT") or remote.get("endpointurl"),
+        remote.get("profile"),
+        remote.get("region"),
+        remote.get("access_key_id"),
+        remote.get("secret_access_key"),
+    )
+
+
+def object_key(remote, md5):
+    """The key of the object with this md5 in the DVC 3 layout"""
+    key = f"files/md5/{md5[:2]}/{md5[2:]}"
+    return f"{remote.prefix}/{key}" if remote.prefix else key
+
+
+def _not_found(e):
+    return e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound")
+
+
+def journal_path(repo_root, crate_path):
+    """The upload journal of the crate at crate_path"""
+    return Path(repo_root, JOURNAL_DIR, f"{Path(crate_path).name}.jsonl")
+
+
+class UploadJournal:
+    """Append-only record of the uploads of a crate
+
+    Each line is an event: an object started (its key, md5, size, part size
+    and multipart upload id), a part completed (its number and ETag) or an
+    object done. Replaying the events gives the state of each object.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # key -> {md5, size, part_size, upload_id, parts: {number: etag}, done}
+        self.objects = {}
+        self._lock = threading.Lock()
+        if self.path.exists():
+            self._replay()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a")
+
+    def _replay(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line, cut short when the upload was killed
+                    continue
+                self._apply(event)
+
+    def _apply(self, event):
+        key = event["key"]
+        if event["event"] == "start":
+            self.objects[key] = {
+                "md5": event["md5"],
+                "size": event["size"],
+                "part_size": event["part_size"],
+                "upload_id": event["upload_id"],
+                "parts": {},
+                "done": False,
+            }
+        elif event["event"] == "part":
+            entry = self.objects.get(key)
+            if entry and entry["upload_id"] == event["upload_id"]:
+                entry["parts"][event["part"]] = event["etag"]
+        elif event["event"] == "done":
+            entry = self.objects.setdefault(key, {"parts": {}, "upload_id": None})
+            entry.update(
+                md5=event["md5"], size=event["size"], part_size=None, done=True
+            )
+
+    def _record(self, event):
+        with self._lock:
+            self._apply(event)
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+
+    def start(self, key, md5, size, part_size, upload_id):
+        self._record(
+            {
+                "event": "start",
+                "key": key,
+                "md5": md5,
+                "size": size,
+                "part_size": part_size,
+                "upload_id": upload_id,
+            }
+        )
+
+    def part(self, key, upload_id, number, etag):
+        self._record(
+            {
+                "event": "part",
+                "key": key,
+                "upload_id": upload_id,
+                "part": number,
+                "etag": etag,
+            }
+        )
+
+    def done(self, key, md5, size):
+        self._record({"event": "done", "key": key, "md5": md5, "size": size})
+
+    def unfinished(self, key, size, part_size):
+        """The upload id and parts of an unfinished multipart upload of key
+        with this size and part size, or None
+        """
+        entry = self.objects.get(key)
+        if (
+            entry
+            and not entry["done"]
+            and entry["upload_id"]
+            and entry["size"] == size
+            and entry["part_size"] == part_size
+        ):
+            return entry["upload_id"], dict(entry["parts"])
+        return None
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class S3Uploader:
+    """Upload files to the content addressed layout of a DVC S3 remote
+
+    The uploader can be shared by builds running at the same time.
+    """
+
+    def __init__(
+        self,
+        remote,
+        part_size=DEFAULT_PART_SIZE,
+        concurrency=DEFAULT_CONCURRENCY,
+        endpoint_url=None,
+    ):
+        if boto3 is None:
+            raise RuntimeError("Uploading to S3 needs boto3: pip install boto3")
+        self.remote = remote
+        self.part_size = part_size
+        self.concurrency = concurrency
+        session = boto3.session.Session(
+            profile_name=remote.profile,
+            aws_access_key_id=remote.access_key_id,
+            aws_secret_access_key=remote.secret_access_key,
+            region_name=remote.region,
+        )
+        try:
+            # S3-compatible endpoints may reject the CRC checksums botocore
+            # adds to every request by default
+            config = Config(
+                max_pool_connections=concurrency,
+                request_checksum_calculation="when_required",
+                response_checksum_validation="when_required",
+            )
+        except TypeError:
+            # botocore < 1.36 only sends checksums when required
+            config = Config(max_pool_connections=concurrency)
+        self.client = session.client(
+            "s3",
+            endpoint_url=endpoint_url or remote.endpoint_url,
+            config=config,
+        )
+        self._pool = None
+        self._lock = threading.Lock()
+        self.records = []
+        self.seconds = 0.0
+        self.uploaded_bytes = 0
+        self._last_report = 0
+
+    @property
+    def pool(self):
+        """The requests in flight, shared by all the uploads"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.concurrency, thread_name_prefix="s3"
+                )
+            return self._pool
+
+    def _progress(self, n):
+        with self._lock:
+            self.uploaded_bytes += n
+            report = self.uploaded_bytes // (1024 * MiB)
+            if report > self._last_report:
+                self._last_report = report
+                log.info(f"Uploaded {report} GiB...")
+
+    def remote_size(self, key):
+        """The size of the object at key, or None if there is none"""
+        try:
+            return self.client.head_object(Bucket=self.remote.bucket, Key=key)[
+                "ContentLength"
+            ]
+        except ClientError as e:
+            if _not_found(e):
+                return None
+            raise
+
+    def _list_prefix(self, prefix, keys):
+        sizes = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.remote.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if obj["Key"] in keys:
+                    sizes[obj["Key"]] = obj["Size"]
+        return sizes
+
+    def remote_sizes(self, keys):
+        """The size of each of the objects at keys already on the remote
+
+        The files/md5/xx/ prefix of the keys are listed, one listing per
+        prefix. Without the permission to list the bucket, each key is looked
+        up with a HEAD request.
+        """
+        keys = list(set(keys))
+        prefixes = sorted({key.rpartition("/")[0] + "/" for key in keys})
+        sizes = {}
+        wanted = set(keys)
+        try:
+            for found in self.pool.map(
+                lambda prefix: self._list_prefix(prefix, wanted), prefixes
+            ):
+                sizes.update(found)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "AccessDenied":
+                raise
+            log.debug("Cannot list the remote, looking up each object")
+            for key, size in zip(keys, self.pool.map(self.remote_size, keys)):
+                if size is not None:
+                    sizes[key] = size
+        log.debug(
+            f"{len(sizes)} of {len(keys)} objects already on the remote"
+            f" ({len(prefixes)} prefixes listed)"
+        )
+        return sizes
+
+    def _put(self, path, key, size):
+        with open(path, "rb") as f:
+            self.client.put_object(Bucket=self.remote.bucket, Key=key, Body=f)
+        self._progress(size)
+
+    def _upload_part(self, path, key, upload_id, number, journal):
+        offset = (number - 1) * self.part_size
+        with open(path, "rb") as f:
+            f.seek(offset)
+            body = f.read(self.part_size)
+        etag = self.client.upload_part(
+            Bucket=self.remote.bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=body,
+        )["ETag"]
+        self._progress(len(body))
+        if journal:
+            journal.part(key, upload_id, number, etag)
+        return number, etag
+
+    def _remote_parts(self, key, upload_id, size):
+        """The parts of an unfinished multipart upload on the remote, or None
+        if the upload is gone (completed, aborted or expired)
+        """
+        parts = {}
+        paginator = self.client.get_paginator("list_parts")
+        try:
+            for page in paginator.paginate(
+                Bucket=self.remote.bucket, Key=key, UploadId=upload_id
+            ):
+                for part in page.get("Parts", []):
+                    number = part["PartNumber"]
+                    expected = min(self.part_size, size - (number - 1) * self.part_size)
+                    if part["Size"] == expected:
+                        parts[number] = part["ETag"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchUpload", "404"):
+                return None
+            raise
+        return parts
+
+    def _start_multipart(self, path, key, md5, size, journal):
+        """Start or resume the multipart upload of path
+
+        Returns the upload id, the parts already uploaded and the futures of
+        the others.
+        """
+        resumed = journal.unfinished(key, size, self.part_size) if journal else None
+        done = None
+        if resumed:
+            upload_id, journal_parts = resumed
+            # The remote has the final word on which parts are there
+            done = self._remote_parts(key, upload_id, size)
+            if done is not None:
+                log.info(
+                    f"Resuming the upload of {path}: {len(done)} parts already"
+                    f" uploaded ({len(journal_parts)} in the journal)"
+                )
+        if done is None:
+            upload_id = self.client.create_multipart_upload(
+                Bucket=self.remote.bucket, Key=key
+            )["UploadId"]
+            done = {}
+            if journal:
+                journal.start(key, md5, size, self.part_size, upload_id)
+        n_parts = -(-size // self.part_size)
+        futures = [
+            self.pool.submit(self._upload_part, path, key, upload_id, number, journal)
+            for number in range(1, n_parts + 1)
+            if number not in done
+        ]
+        return upload_id, done, futures
+
+    def _complete(self, key, upload_id, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.remote.bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": number, "ETag": parts[number]}
+                    for number in sorted(parts)
+                ]
+            },
+        )
+
+    def upload_all(self, files, journal=None):
+        """Upload (path, md5) pairs, skipping the objects already there
+
+        With an UploadJournal, unfinished multipart uploads recorded in it are
+        resumed. Returns an UploadRecord per file. Raises what boto3 raises on
+        the first failed upload, once the others are done. The multipart
+        uploads that failed are left on the remote, to be resumed.
+        """
+        started = time.monotonic()
+        files = [
+            (Path(path), md5, object_key(self.remote, md5), os.path.getsize(path))
+            for path, md5 in files
+        ]
+        on_remote = self.remote_sizes(key for _, _, key, _ in files)
+        pending = []
+        records = []
+        error = None
+        for path, md5, key, size in files:
+            if on_remote.get(key) == size:
+                log.debug(f"Already on the remote: {path} ({key})")
+                records.append(UploadRecord(str(path), key, size, 0.0, True))
+                if journal and not journal.objects.get(key, {}).get("done"):
+                    journal.done(key, md5, size)
+                continue
+            # Files with the same content are one object
+            on_remote[key] = size
+            log.debug(f"Uploading {path} to s3://{self.remote.bucket}/{key}")
+            start = time.monotonic()
+            try:
+                if size > self.part_size:
+                    upload_id, parts, futures = self._start_multipart(
+                        path, key, md5, size, journal
+                    )
+                else:
+                    upload_id, parts = None, {}
+                    futures = [self.pool.submit(self._put, path, key, size)]
+            except ClientError as e:
+                log.error(f"Failed to upload {path}: {e}")
+                error = error or e
+                continue
+            # Only the bytes of the parts not already uploaded are sent
+            sent = size - sum(
+                min(self.part_size, size - (number - 1) * self.part_size)
+                for number in parts
+            )
+            pending.append((path, md5, key, sent, start, upload_id, parts, futures))
+
+        for path, md5, key, sent, start, upload_id, parts, futures in pending:
+            try:
+                for future in futures:
+                    result = future.result()
+                    if upload_id:
+                        number, etag = result
+                        parts[number] = etag
+                if upload_id:
+                    self._complete(key, upload_id, parts)
+            except Exception as e:
+                log.error(f"Failed to upload {path}: {e}")
+                error = error or e
+                continue
+            if journal:
+                journal.done(key, md5, os.path.getsize(path))
+            # Finishing times overlap, this is the time until this one is done
+            records.append(
+                UploadRecord(str(path), key, sent, time.monotonic() - start, False)
+            )
+        seconds = time.monotonic() - started
+        with self._lock:
+            self.records.extend(records)
+            self.seconds += seconds
+        self.log_stats(records, seconds)
+        if error:
+            raise error
+        return records
+
+    def log_stats(self, records=None, seconds=None):
+        """Log the bytes uploaded and the throughput"""
+        if records is None:
+            records, seconds = self.records, self.seconds
+        uploaded = [r for r in records if not r.skipped]
+        total = sum(r.bytes for r in uploaded)
+        rate = total / MiB / seconds if seconds else 0.0
+        log.info(
+            f"S3 upload: {len(uploaded)} files, {total / MiB:.1f} MiB in"
+            f" {seconds:.1f}s ({rate:.1f} MiB/s),"
+            f" {len(records) - len(uploaded)} already on the remote"
+        )
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def dvc_tracked_files(crate_path):
+    """(path, md5) of every file with a .dvc stub under crate_path"""
+    return [
+        (Path(crate_path, path), md5)
+        for path, (md5, _) in sorted(stub_index(crate_path).items())
+    ]
+
+
+desc = """
+Upload the DVC tracked payload files of ro-crates to the DVC S3 remote of
+their repository, without `dvc push`. Run it again after a failure to upload
+only what is missing.
+
+$ ./utils/s3_upload.py <ro_crate_repository> <crate_directory> [...]
+"""
+
+
+def main(
+    repo_root,
+    crate_paths,
+    part_size,
+    concurrency,
+    endpoint_url=None,
+    remote_name=None,
+    debug=False,
+):
+    logging.basicConfig(
+        format="\t%(levelname)s: %(message)s",
+        level=logging.DEBUG if debug else logging.INFO,
+    )
+    try:
+        remote = read_dvc_remote(repo_root, remote_name)
+        uploader = S3Uploader(remote, part_size, concurrency, endpoint_url)
+    except (ValueError, RuntimeError) as e:
+        log.error(e)
+        sys.exit(1)
+    try:
+        for crate_path in crate_paths:
+            files = dvc_tracked_files(crate_path)
+            log.info(
+                f"Uploading {len(files)} files of {crate_path} to"
+                f" s3://{remote.bucket}/{remote.prefix}"
+            )
+            journal = UploadJournal(journal_path(repo_root, crate_path))
+            try:
+                uploader.upload_all(files, journal)
+            finally:
+                journal.close()
+    except Exception as e:
+        log.error(f"Upload failed: {e}")
+        sys.exit(1)
+    finally:
+        uploader.close()
+    if len(crate_paths) > 1:
+        uploader.log_stats()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent(desc),
+    )
+    parser.add_argument("ro_crate_repository", help="The DVC repository")
+    parser.add_argument(
+        "crate_paths", nargs="+", help="Crate directories with .dvc stubs"
+    )
+    parser.add_argument(
+        "-p",
+        "--part_size",
+        type=int,
+        default=DEFAULT_PART_SIZE // MiB,
+        help=f"Multipart part size in MiB (default: {DEFAULT_PART_SIZE // MiB})",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Requests in flight (default: {DEFAULT_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "-e",
+        "--endpoint",
+        default=None,
+        help="S3 endpoint, instead of the endpointurl of the DVC remote",
+    )
+    parser.add_argument(
+        "-r", "--remote", default=None, help="DVC remote (default: the core remote)"
+    )
+    parser.add_argument("-d", "--debug", action="store_true", help="DEBUG logging")
+    args = parser.parse_args()
+    main(
+        args.ro_crate_repository,
+        args.crate_paths,
+        args.part_size * MiB,
+        args.concurrency,
+        args.endpoint,
+        args.remote,
+        args.debug,
+    )
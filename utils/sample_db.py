@@ -0,0 +1,515 @@
+#! /usr/bin/env python3
+
+"""
+Local SQLite registry of the EMO BON samples
+
+The run-information sheets, ENA accession sheets, MGF run-track sheets and the
+observatory logsheets are joined into one indexed SQLite database, shared by
+create-ro-crate.py and the utils scripts:
+
+    batches             batch_number -> run-information and ENA accession sheets
+    samples             every sample sent for sequencing (ref_code, source_mat_id)
+    runs                the sequenced samples (run_id, reads_name, run, prefix)
+    observatories       EMO BON observatories (governance crate)
+    observatory_sites   observatory location and country (validated logsheets)
+    sampling_events     sampling dates of the samples (combined logsheets)
+    ena_accessions      ref_code -> ENA sample accession
+    mgf_runs            ref_code -> who ran MetaGOflow, and which version
+
+refresh() is incremental: each sheet is fetched through the sheet cache and
+only reloaded when its content has changed since the last refresh. Each row
+records the sheet it came from, so a changed sheet replaces only its own rows.
+Sheets that cannot be fetched keep their previous rows.
+
+The database lives in ~/.cache/metagoflow-ro-crate/samples.sqlite unless
+MGF_SAMPLE_DB is set. Run this script to refresh it and print a summary.
+"""
+
+import io
+import os
+import time
+import hashlib
+import logging
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+import requests
+import pandas as pd
+
+try:
+    import sheet_cache
+    from metadata_sources import (
+        RUN_INFO_PATHS,
+        ENA_ACCESSION_INFO_PATHS,
+        FILTERS_MGF_PATH,
+        SEDIMENTS_MGF_PATH,
+        OBSERVATORIES_LOGSHEET,
+        OBSERVATORY_LOGSHEETS_PATH,
+        COMBINED_LOGSHEETS_PATH,
+    )
+except ModuleNotFoundError:
+    # Imported from the top directory as part of the utils package
+    from utils import sheet_cache
+    from utils.metadata_sources import (
+        RUN_INFO_PATHS,
+        ENA_ACCESSION_INFO_PATHS,
+        FILTERS_MGF_PATH,
+        SEDIMENTS_MGF_PATH,
+        OBSERVATORIES_LOGSHEET,
+        OBSERVATORY_LOGSHEETS_PATH,
+        COMBINED_LOGSHEETS_PATH,
+    )
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = Path.home() / ".cache" / "metagoflow-ro-crate" / "samples.sqlite"
+
+# Increment when the schema changes, the database is then rebuilt
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE sources (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    loaded_at REAL NOT NULL
+);
+CREATE TABLE batches (
+    batch_number INTEGER PRIMARY KEY,
+    run_info_url TEXT,
+    ena_accession_url TEXT
+);
+CREATE TABLE samples (
+    source TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    batch_number INTEGER NOT NULL,
+    ref_code TEXT,
+    source_mat_id TEXT,
+    obs_id TEXT,
+    env_package TEXT
+);
+CREATE INDEX samples_ref_code ON samples (ref_code);
+CREATE INDEX samples_source_mat_id ON samples (source_mat_id);
+CREATE INDEX samples_obs_id ON samples (obs_id);
+CREATE TABLE runs (
+    source TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    batch_number INTEGER NOT NULL,
+    run_id TEXT NOT NULL,
+    reads_name TEXT NOT NULL,
+    ref_code TEXT,
+    source_mat_id TEXT,
+    run TEXT,
+    prefix TEXT
+);
+CREATE INDEX runs_run_id ON runs (run_id);
+CREATE INDEX runs_ref_code ON runs (ref_code);
+CREATE INDEX runs_source_mat_id ON runs (source_mat_id);
+CREATE TABLE observatories (
+    source TEXT NOT NULL,
+    obs_id TEXT NOT NULL
+);
+CREATE INDEX observatories_obs_id ON observatories (obs_id);
+CREATE TABLE observatory_sites (
+    source TEXT NOT NULL,
+    obs_id TEXT NOT NULL,
+    env_package TEXT,
+    name TEXT,
+    country TEXT,
+    latitude REAL,
+    longitude REAL
+);
+CREATE INDEX observatory_sites_obs_id ON observatory_sites (obs_id);
+CREATE TABLE sampling_events (
+    source TEXT NOT NULL,
+    source_mat_id TEXT NOT NULL,
+    samp_store_date TEXT
+);
+CREATE INDEX sampling_events_source_mat_id ON sampling_events (source_mat_id);
+CREATE TABLE ena_accessions (
+    source TEXT NOT NULL,
+    batch_number INTEGER NOT NULL,
+    ref_code TEXT NOT NULL,
+    accession TEXT
+);
+CREATE INDEX ena_accessions_ref_code ON ena_accessions (ref_code);
+CREATE TABLE mgf_runs (
+    source TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    sheet TEXT NOT NULL,
+    batch_number TEXT,
+    ref_code TEXT,
+    forward_read_filename TEXT,
+    who TEXT,
+    version TEXT
+);
+CREATE INDEX mgf_runs_ref_code ON mgf_runs (ref_code);
+"""
+
+# The tables filled from each kind of sheet
+RUN_INFO_TABLES = ["samples", "runs"]
+MGF_SHEETS = {"filters": FILTERS_MGF_PATH, "sediments": SEDIMENTS_MGF_PATH}
+
+RUN_COLUMNS = "run_id, reads_name, ref_code, source_mat_id, run, prefix, batch_number"
+
+
+def _records(df, columns):
+    """Rows of df as tuples of columns, with None for missing values or columns"""
+    df = df.reindex(columns=columns).astype(object)
+    return list(df.where(df.notna(), None).itertuples(index=False, name=None))
+
+
+def _split_source_mat_id(source_mat_id):
+    # EMOBON_BPNS_Wa_1 -> (BPNS, water)
+    parts = source_mat_id.split("_") if isinstance(source_mat_id, str) else []
+    if len(parts) < 3:
+        return None, None
+    return parts[1], {"Wa": "water", "So": "sediment"}.get(parts[2])
+
+
+class SampleDB:
+    """Query API over the sample registry database"""
+
+    def __init__(self, path=None):
+        self.path = Path(path or os.environ.get("MGF_SAMPLE_DB") or DEFAULT_DB_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Shared by the prefetch threads, serialised by the lock
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._create()
+
+    def _create(self):
+        log.info(f"Creating the sample registry {self.path}")
+        with self._lock, self._conn:
+            tables = [
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'"
+                )
+            ]
+            for table in tables:
+                self._conn.execute(f"DROP TABLE {table}")
+            self._conn.executescript(SCHEMA)
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self):
+        self._conn.close()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # Refresh
+
+    def _load(self, url, tables, parse, **read_csv_kwargs):
+        """Replace the rows from url in tables, if the sheet has changed"""
+        try:
+            body = sheet_cache.fetch(url)
+        except requests.RequestException as e:
+            log.warning(f"Cannot refresh the sample registry from {url}: {e}")
+            return False
+        digest = hashlib.sha256(body).hexdigest()
+        known = self._query("SELECT digest FROM sources WHERE url = ?", (url,))
+        if known and known[0][0] == digest:
+            return False
+        log.debug(f"Loading {url} into {', '.join(tables)}")
+        df = pd.read_csv(io.BytesIO(body), **read_csv_kwargs)
+        rows = parse(df)
+        with self._lock, self._conn:
+            for table in tables:
+                self._conn.execute(f"DELETE FROM {table} WHERE source = ?", (url,))
+            for table, table_rows in rows.items():
+                if not table_rows:
+                    continue
+                marks = ", ".join(["?"] * (len(table_rows[0]) + 1))
+                self._conn.executemany(
+                    f"INSERT INTO {table} VALUES ({marks})",
+                    [(url,) + row for row in table_rows],
+                )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                (url, digest, time.time()),
+            )
+        return True
+
+    def refresh(self):
+        """Reload every sheet that has changed, return the number reloaded"""
+        loaded = 0
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM batches")
+            self._conn.executemany(
+                "INSERT INTO batches VALUES (?, ?, ?)",
+                [
+                    (n, url, ENA_ACCESSION_INFO_PATHS.get(n))
+                    for n, url in enumerate(RUN_INFO_PATHS, start=1)
+                ],
+            )
+
+        for batch_number, url in enumerate(RUN_INFO_PATHS, start=1):
+
+            def parse(df, batch_number=batch_number):
+                samples = []
+                for position, (ref_code, source_mat_id) in enumerate(
+                    _records(df, ["ref_code", "source_mat_id"])
+                ):
+                    samples.append(
+                        (position, batch_number, ref_code, source_mat_id)
+                        + _split_source_mat_id(source_mat_id)
+                    )
+                # Not all samples with an EMO BON code were sent to sequencing
+                runs = []
+                for position, (reads_name, ref_code, source_mat_id, run) in enumerate(
+                    _records(df, ["reads_name", "ref_code", "source_mat_id", "run"])
+                ):
+                    if not isinstance(reads_name, str):
+                        continue
+                    parts = reads_name.split("_")
+                    runs.append(
+                        (position, batch_number, parts[-1], reads_name)
+                        + (ref_code, source_mat_id, run, parts[0])
+                    )
+                return {"samples": samples, "runs": runs}
+
+            loaded += self._load(url, RUN_INFO_TABLES, parse, encoding="iso-8859-1")
+
+        for batch_number, url in ENA_ACCESSION_INFO_PATHS.items():
+
+            def parse(df, batch_number=batch_number):
+                rows = _records(df, ["ref_code", "ena_accession_number_sample"])
+                return {
+                    "ena_accessions": [
+                        (batch_number,) + row for row in rows if row[0] is not None
+                    ]
+                }
+
+            loaded += self._load(
+                url, ["ena_accessions"], parse, encoding="iso-8859-1"
+            )
+
+        for sheet, url in MGF_SHEETS.items():
+
+            def parse(df, sheet=sheet):
+                rows = _records(
+                    df,
+                    ["Batch Number", "ref_code", "Forward Read Filename", "who", "version"],
+                )
+                # Batch numbers are kept as written, e.g. "3.0"
+                return {
+                    "mgf_runs": [
+                        (position, sheet, None if row[0] is None else str(row[0]))
+                        + row[1:]
+                        for position, row in enumerate(rows)
+                    ]
+                }
+
+            loaded += self._load(url, ["mgf_runs"], parse, encoding="iso-8859-1")
+
+        loaded += self._load(
+            OBSERVATORIES_LOGSHEET,
+            ["observatories"],
+            lambda df: {
+                "observatories": [
+                    row
+                    for row in _records(df, ["EMOBON_observatory_id"])
+                    if row[0] is not None
+                ]
+            },
+            encoding="iso-8859-1",
+        )
+        loaded += self._load(
+            OBSERVATORY_LOGSHEETS_PATH,
+            ["observatory_sites"],
+            lambda df: {
+                "observatory_sites": _records(
+                    df,
+                    [
+                        "obs_id",
+                        "env_package",
+                        "loc_loc",
+                        "geo_loc_name",
+                        "latitude",
+                        "longitude",
+                    ],
+                )
+            },
+            encoding="utf-8",
+            on_bad_lines="warn",
+        )
+        loaded += self._load(
+            COMBINED_LOGSHEETS_PATH,
+            ["sampling_events"],
+            lambda df: {
+                "sampling_events": _records(df, ["source_mat_id", "samp_store_date"])
+            },
+            encoding="utf-8",
+            on_bad_lines="warn",
+        )
+        log.debug(f"Sample registry: {loaded} sheets reloaded")
+        return loaded
+
+    # Queries
+
+    def runs(self, batch_number=None):
+        """The sequenced samples as (run_id, reads_name, ref_code,
+        source_mat_id, run, prefix, batch_number) tuples, in sheet order"""
+        sql = f"SELECT {RUN_COLUMNS} FROM runs"
+        params = ()
+        if batch_number is not None:
+            sql += " WHERE batch_number = ?"
+            params = (batch_number,)
+        return self._query(sql + " ORDER BY batch_number, position", params)
+
+    def _first_run(self, column, value):
+        rows = self._query(
+            f"SELECT {RUN_COLUMNS} FROM runs WHERE {column} = ? "
+            "ORDER BY batch_number, position LIMIT 1",
+            (value,),
+        )
+        return rows[0] if rows else None
+
+    def run_by_run_id(self, run_id):
+        return self._first_run("run_id", run_id)
+
+    def run_by_source_mat_id(self, source_mat_id):
+        return self._first_run("source_mat_id", source_mat_id)
+
+    def run_by_ref_code(self, ref_code):
+        return self._first_run("ref_code", ref_code)
+
+    def samples(self, obs_id=None):
+        """(ref_code, source_mat_id, obs_id, env_package, batch_number) tuples"""
+        sql = "SELECT ref_code, source_mat_id, obs_id, env_package, batch_number FROM samples"
+        params = ()
+        if obs_id is not None:
+            sql += " WHERE obs_id = ?"
+            params = (obs_id,)
+        return self._query(sql + " ORDER BY batch_number, position", params)
+
+    def ena_accession(self, ref_code, batch_number=None):
+        """The ENA sample accession of ref_code, or None"""
+        sql = "SELECT accession FROM ena_accessions WHERE ref_code = ?"
+        params = (ref_code,)
+        if batch_number is not None:
+            sql += " AND batch_number = ?"
+            params += (batch_number,)
+        rows = self._query(sql + " ORDER BY batch_number, rowid LIMIT 1", params)
+        return rows[0][0] if rows else None
+
+    def ena_accessions(self, keys):
+        """{(ref_code, batch_number): accession} for the (ref_code,
+        batch_number) keys that have one, as ena_accession() reads them
+        """
+        keys = set(keys)
+        ref_codes = sorted({ref_code for ref_code, _ in keys})
+        found = {}
+        # Keep below the SQLite host parameter limit
+        for i in range(0, len(ref_codes), 500):
+            chunk = ref_codes[i : i + 500]
+            marks = ", ".join(["?"] * len(chunk))
+            for ref_code, batch_number, accession in self._query(
+                "SELECT ref_code, batch_number, accession FROM ena_accessions "
+                f"WHERE ref_code IN ({marks}) ORDER BY batch_number, rowid",
+                chunk,
+            ):
+                if (ref_code, batch_number) in keys:
+                    # The first row wins, as with LIMIT 1
+                    found.setdefault((ref_code, batch_number), accession)
+        return {key: accession for key, accession in found.items() if accession}
+
+    def mgf_run(self, ref_code, sheet=None):
+        """(who, version) of the MGF analysis of ref_code, or None
+
+        sheet is "filters" or "sediments", by default either.
+        """
+        sql = "SELECT who, version FROM mgf_runs WHERE ref_code = ?"
+        params = (ref_code,)
+        if sheet is not None:
+            sql += " AND sheet = ?"
+            params += (sheet,)
+        rows = self._query(sql + " ORDER BY sheet, position LIMIT 1", params)
+        return rows[0] if rows else None
+
+    def mgf_runs(self, sheet):
+        """(batch_number, ref_code, forward_read_filename) of a run-track sheet"""
+        return self._query(
+            "SELECT batch_number, ref_code, forward_read_filename FROM mgf_runs "
+            "WHERE sheet = ? ORDER BY position",
+            (sheet,),
+        )
+
+    def observatory_ids(self):
+        return [row[0] for row in self._query("SELECT obs_id FROM observatories")]
+
+    def observatory_site(self, obs_id):
+        """(name, country, latitude, longitude) of the observatory, or None"""
+        rows = self._query(
+            "SELECT name, country, latitude, longitude FROM observatory_sites "
+            "WHERE obs_id = ? ORDER BY rowid LIMIT 1",
+            (obs_id,),
+        )
+        return rows[0] if rows else None
+
+    def sampling_date(self, source_mat_id):
+        rows = self._query(
+            "SELECT samp_store_date FROM sampling_events "
+            "WHERE source_mat_id = ? ORDER BY rowid LIMIT 1",
+            (source_mat_id,),
+        )
+        return rows[0][0] if rows else None
+
+    def counts(self):
+        return {
+            table: self._query(f"SELECT COUNT(*) FROM {table}")[0][0]
+            for table in [
+                "batches",
+                "samples",
+                "runs",
+                "observatories",
+                "observatory_sites",
+                "sampling_events",
+                "ena_accessions",
+                "mgf_runs",
+            ]
+        }
+
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def get_db():
+    """Return the process-wide registry database, refreshed on first use"""
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = SampleDB()
+            _db.refresh()
+    return _db
+
+
+def main(debug=False, metadata_snapshot=None):
+    logging.basicConfig(
+        format="\t%(levelname)s: %(message)s",
+        level=logging.DEBUG if debug else logging.INFO,
+    )
+    sheet_cache.use_snapshot(metadata_snapshot)
+    db = get_db()
+    log.info(f"Sample registry {db.path}")
+    for table, count in db.counts().items():
+        log.info(f"  {table}: {count} rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Refresh the local sample registry database"
+    )
+    parser.add_argument("-d", "--debug", action="store_true", help="DEBUG logging")
+    parser.add_argument(
+        "--metadata-snapshot",
+        default=None,
+        help="Resolve all remote metadata from this snapshot bundle",
+    )
+    args = parser.parse_args()
+    main(args.debug, args.metadata_snapshot)
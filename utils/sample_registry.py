@@ -0,0 +1,73 @@
+"""
+Indexed lookup of the EMO BON samples sent for sequencing
+
+The sequenced samples of every batch are read once per process from the
+sample registry database (utils/sample_db.py), which holds the run-information
+sheets, and indexed by run_id, source_mat_id and ref_code so that each lookup
+is a single dictionary access.
+
+run_id is the last part of the reads_name in the run information file
+e.g. 'DBH_AAAAOSDA_1_HWLTKDRXY.UDI235' -> 'HWLTKDRXY.UDI235'
+and prefix is the first part, e.g. 'DBH'
+"""
+
+import logging
+import threading
+from collections import namedtuple
+
+try:
+    from sample_db import get_db
+except ModuleNotFoundError:
+    # Imported from the top directory as part of the utils package
+    from utils.sample_db import get_db
+
+log = logging.getLogger(__name__)
+
+Sample = namedtuple(
+    "Sample",
+    ["run_id", "reads_name", "ref_code", "source_mat_id", "run", "prefix", "batch_number"],
+)
+
+
+class SampleRegistry:
+    """Hash indexes over the run-information sheets of all batches"""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self._by_run_id = {}
+        self._by_source_mat_id = {}
+        self._by_ref_code = {}
+        # The first occurrence wins, as in the original batch-ordered scans
+        for sample in samples:
+            self._by_run_id.setdefault(sample.run_id, sample)
+            self._by_source_mat_id.setdefault(sample.source_mat_id, sample)
+            self._by_ref_code.setdefault(sample.ref_code, sample)
+        log.debug(f"Sample registry holds {len(samples)} sequenced samples")
+
+    @classmethod
+    def load(cls, db=None):
+        """Index the sequenced samples of the sample registry database"""
+        db = db or get_db()
+        return cls([Sample(*row) for row in db.runs()])
+
+    def by_run_id(self, run_id):
+        return self._by_run_id.get(run_id)
+
+    def by_source_mat_id(self, source_mat_id):
+        return self._by_source_mat_id.get(source_mat_id)
+
+    def by_ref_code(self, ref_code):
+        return self._by_ref_code.get(ref_code)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Return the process-wide registry, loading it on first use"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = SampleRegistry.load()
+    return _registry
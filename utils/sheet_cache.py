@@ -0,0 +1,275 @@
+"""
+Persistent on-disk cache for the remote metadata sheets
+
+Every crate build reads the same run-information, logsheet, MGF run-track and
+ENA accession sheets from Github and Google. The sheets change rarely, so each
+one is stored on disk with its ETag/Last-Modified headers and served from there
+while it is younger than the TTL. After that it is revalidated with a
+conditional request, which costs a round trip but no download if unchanged.
+
+The cache directory and TTL can be set with configure() or with the
+MGF_SHEET_CACHE_DIR and MGF_SHEET_CACHE_TTL (seconds) environment variables.
+
+With use_snapshot() (or MGF_METADATA_SNAPSHOT) every fetch is resolved from a
+metadata snapshot bundle written by utils/metadata_snapshot.py instead, with
+no network I/O at all.
+"""
+
+import io
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from contextlib import closing
+from pathlib import Path
+import requests
+import pandas as pd
+
+try:
+    import http_client
+except ModuleNotFoundError:
+    # Imported from the top directory as part of the utils package
+    from utils import http_client
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "metagoflow-ro-crate" / "sheets"
+# One day
+DEFAULT_TTL = 86400
+
+# Version of the metadata snapshot bundle schema, increment when it changes
+SNAPSHOT_FORMAT_VERSION = 1
+
+_settings = {
+    "cache_dir": Path(os.environ.get("MGF_SHEET_CACHE_DIR", DEFAULT_CACHE_DIR)),
+    "ttl": float(os.environ.get("MGF_SHEET_CACHE_TTL", DEFAULT_TTL)),
+    "snapshot": os.environ.get("MGF_METADATA_SNAPSHOT") or None,
+}
+# hits: served from disk without a request
+# revalidated: conditional request answered with 304 Not Modified
+# misses: full download, either not cached or changed upstream
+# stale: network failed and an expired copy was served instead
+# snapshot: served from the metadata snapshot bundle
+_stats = {"hits": 0, "revalidated": 0, "misses": 0, "stale": 0, "snapshot": 0}
+_lock = threading.Lock()
+
+
+def configure(cache_dir=None, ttl=None):
+    """Set the cache directory and/or the TTL in seconds"""
+    if cache_dir is not None:
+        _settings["cache_dir"] = Path(cache_dir)
+    if ttl is not None:
+        _settings["ttl"] = float(ttl)
+    log.debug(f"Sheet cache settings: {_settings}")
+
+
+class SnapshotMissingError(requests.ConnectionError):
+    """The URL is not in the metadata snapshot, and the network is not used"""
+
+
+def use_snapshot(path):
+    """Resolve every fetch from the metadata snapshot bundle at path"""
+    if path is None:
+        return
+    if not Path(path).exists():
+        raise FileNotFoundError(f"Metadata snapshot does not exist: {path}")
+    try:
+        with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+            row = conn.execute(
+                "SELECT value FROM snapshot_info WHERE key = 'format_version'"
+            ).fetchone()
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f"Not a metadata snapshot: {path} ({e})")
+    version = row[0] if row else None
+    if version != str(SNAPSHOT_FORMAT_VERSION):
+        raise ValueError(
+            f"Metadata snapshot {path} has format version {version}, expected "
+            f"{SNAPSHOT_FORMAT_VERSION}: write it again with utils/metadata_snapshot.py"
+        )
+    # Absolute, the scripts change directory
+    _settings["snapshot"] = str(Path(path).resolve())
+    log.info(f"Using metadata snapshot {path}: no network access")
+
+
+def _from_snapshot(url):
+    path = _settings["snapshot"]
+    with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+        row = conn.execute(
+            "SELECT status, content FROM resources WHERE url = ?", (url,)
+        ).fetchone()
+    if row is None:
+        raise SnapshotMissingError(f"{url} is not in the metadata snapshot {path}")
+    status, content = row
+    _count("snapshot")
+    if status != requests.codes.ok:
+        raise requests.HTTPError(f"{status} Error for url: {url} (metadata snapshot)")
+    return content
+
+
+def stats():
+    """Return a copy of the hit/miss counters"""
+    with _lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _lock:
+        for k in _stats:
+            _stats[k] = 0
+
+
+def _count(counter):
+    with _lock:
+        _stats[counter] += 1
+
+
+def _cache_paths(url):
+    """Return the (body, meta) paths for a URL"""
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    cache_dir = _settings["cache_dir"]
+    return cache_dir / f"{key}.body", cache_dir / f"{key}.json"
+
+
+def _atomic_write(path, data):
+    # Write to a temporary file in the same directory so that concurrent
+    # readers never see a partially written sheet
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_meta(meta_path, meta):
+    _atomic_write(meta_path, json.dumps(meta).encode("utf-8"))
+
+
+def fetch(url, timeout=60, retries=3, backoff=1.0):
+    """Return the body of url as bytes, using the on-disk cache
+
+    timeout applies to each attempt, and transient failures are retried
+    retries times with jittered exponential backoff by http_client.
+    Raises requests.HTTPError if the server answers with an error status.
+    """
+    if _settings["snapshot"]:
+        return _from_snapshot(url)
+
+    body_path, meta_path = _cache_paths(url)
+    meta = _read_meta(meta_path)
+    if meta and not body_path.exists():
+        meta = None
+
+    if meta and time.time() - meta["fetched_at"] < _settings["ttl"]:
+        log.debug(f"Sheet cache hit: {url}")
+        _count("hits")
+        return body_path.read_bytes()
+
+    headers = {}
+    if meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        response = http_client.request(
+            "GET", url, headers, timeout=timeout, retries=retries, backoff=backoff
+        )
+    except requests.RequestException as e:
+        if meta:
+            log.warning(f"Cannot revalidate {url} ({e}): using cached copy")
+            _count("stale")
+            return body_path.read_bytes()
+        raise
+
+    if meta and response.status_code == requests.codes.not_modified:
+        log.debug(f"Sheet cache revalidated: {url}")
+        _count("revalidated")
+        meta["fetched_at"] = time.time()
+        _write_meta(meta_path, meta)
+        return body_path.read_bytes()
+
+    response.raise_for_status()
+    log.debug(f"Sheet cache miss: {url}")
+    _count("misses")
+    _settings["cache_dir"].mkdir(parents=True, exist_ok=True)
+    _atomic_write(body_path, response.content)
+    _write_meta(
+        meta_path,
+        {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        },
+    )
+    return response.content
+
+
+def is_fresh(url):
+    """True if url would be served from the cache without a request"""
+    if _settings["snapshot"]:
+        return True
+    body_path, meta_path = _cache_paths(url)
+    meta = _read_meta(meta_path)
+    return bool(
+        meta
+        and body_path.exists()
+        and time.time() - meta["fetched_at"] < _settings["ttl"]
+    )
+
+
+def store(url, content):
+    """Cache content as the body of url, e.g. when resolved by a bulk query"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    body_path, meta_path = _cache_paths(url)
+    _settings["cache_dir"].mkdir(parents=True, exist_ok=True)
+    _atomic_write(body_path, content)
+    _write_meta(
+        meta_path,
+        {"url": url, "etag": None, "last_modified": None, "fetched_at": time.time()},
+    )
+
+
+def post(url, data, timeout=60, retries=3, backoff=1.0):
+    """POST data to url and return the body as bytes, bypassing the cache
+
+    Used for bulk queries, whose results are cached per item with store().
+    Raises requests.HTTPError if the server answers with an error status.
+    """
+    if _settings["snapshot"]:
+        raise SnapshotMissingError(f"Cannot POST to {url} with a metadata snapshot")
+    response = http_client.request(
+        "POST", url, data=data, timeout=timeout, retries=retries, backoff=backoff
+    )
+    response.raise_for_status()
+    return response.content
+
+
+def read_csv(url, timeout=60, retries=3, **kwargs):
+    """Drop-in for pd.read_csv(url, ...) served through the cache"""
+    return pd.read_csv(io.BytesIO(fetch(url, timeout, retries)), **kwargs)
+
+
+def read_json(url, timeout=60, retries=3):
+    """Return the parsed JSON document at url served through the cache"""
+    return json.loads(fetch(url, timeout, retries))
+
+
+def log_stats():
+    s = stats()
+    log.info(
+        f"Sheet cache: {s['hits']} hits, {s['revalidated']} revalidated, "
+        f"{s['misses']} misses, {s['stale']} stale, {s['snapshot']} from snapshot"
+    )
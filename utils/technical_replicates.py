@@ -21,12 +21,15 @@ ROSKOGO_So_16 and ROSKOGO_So_17
 """
 
 import sys
-import math
-import urllib
+import argparse
 import subprocess
 import logging as log
-import pandas as pd
+import requests
 from pathlib import Path
+import sheet_cache
+from sample_registry import get_registry
+from sample_db import get_db
+from metadata_sources import sampling_sheet_url
 
 # The combined sampling event logsheets for batch 1 and 2
 #COMBINED_LOGSHEETS_PATH = (
@@ -34,24 +37,6 @@ from pathlib import Path
 #    "refs/heads/main/validated-data/Batch1and2_combined_logsheets_2024-11-12.csv"
 #)
 
-# 
-OBSERVATORIES_LOGSHEET = (
-    "https://raw.githubusercontent.com/emo-bon/governance-crate/"
-    "refs/heads/main/observatories.csv"
-)
-# The run-information files for each batch set to sequencing facility
-BATCH1_RUN_INFO_PATH = (
-    "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/main/"
-    "shipment/batch-001/run-information-batch-001.csv"
-)
-BATCH2_RUN_INFO_PATH = (
-    "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/main/"
-    "shipment/batch-002/run-information-batch-002.csv"
-)
-BATCH3_RUN_INFO_PATH = (
-    "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/main/"
-    "shipment/batch-003-0/run-information-batch-003.csv"
-)
 # Path to sequence data archive
 DATA_ARCHIVE = "ceta-storage:/mnt/storage-data-pools/emo-bon-sequencing-data"
 
@@ -65,9 +50,7 @@ BROKEN_REPLICATE_PAIRS = [
 def _read_observatory_names():
     """
     """
-    df = pd.read_csv(OBSERVATORIES_LOGSHEET, encoding='iso-8859-1')
-    all_stations = df[["EMOBON_observatory_id"]].values.tolist()
-    stations = [station for sublist in all_stations for station in sublist]
+    stations = get_db().observatory_ids()
     log.debug(f"Stations: {stations}")
     return stations
 
@@ -112,19 +95,15 @@ def get_technical_replicates(observatory_name, env_package):
         log.error(f"env_package must be either 'filters' or 'sediments'")
         sys.exit()
     sheet_type = "sediment" if env_package == "sediments" else "water"
-    observatory_sheet = (
-        f"https://raw.githubusercontent.com/emo-bon/"
-        f"observatory-{observatory_name.lower()}-crate/"
-        f"refs/heads/main/logsheets/transformed/{sheet_type}_sampling.csv"
-    )
+    observatory_sheet = sampling_sheet_url(observatory_name, sheet_type)
     log.debug(f"obs_sheet = {observatory_sheet}")
     if env_package == "sediments":
         sheet_env_name = "soft_sediment"
     else:
         sheet_env_name = "water_column"
     try:
-        samples = pd.read_csv(observatory_sheet)
-    except urllib.error.HTTPError:
+        samples = sheet_cache.read_csv(observatory_sheet)
+    except requests.HTTPError:
         log.info(f"{observatory_name} {env_package} : missing - {observatory_sheet}")
         return None
     #samples = df.dropna(how='all')
@@ -169,27 +148,15 @@ def _get_raw_sequence_file_names(source_mat_id):
         log.error("Cannot identify env_package {env_package}")
         sys.exit()
 
-    found = False
-    for batch in [BATCH1_RUN_INFO_PATH, BATCH2_RUN_INFO_PATH, BATCH3_RUN_INFO_PATH]:
-        df = pd.read_csv(batch, encoding='iso-8859-1')
-        for row in df[["source_mat_id", "run", "reads_name"]].values.tolist():
-            if isinstance(row[0], str):
-                # print(row)
-                if row[0] == source_mat_id:
-                    run = row[1]
-                    reads_name = row[2]
-                    log.info(f"Found run: {run}")
-                    log.info(f"Found reads_name: {reads_name}")
-                    found = True
-                    break
-            elif math.isnan(row[0]):
-                # Not all samples with an EMO BON code were sent to sequencing
-                continue
-        if found:
-            break
-    else:
+    # The run-information sheets are indexed in utils/sample_registry.py
+    sample = get_registry().by_source_mat_id(source_mat_id)
+    if sample is None:
         log.error(f"Cannot find {source_mat_id}")
         sys.exit()
+    run = sample.run
+    reads_name = sample.reads_name
+    log.info(f"Found run: {run}")
+    log.info(f"Found reads_name: {reads_name}")
 
     filenames = []
     for n in ["1", "2"]:
@@ -250,7 +217,7 @@ def download_raw_sequences_of_replicate_pair(pair, outpath):
         pp.append(lps)
     return pp
 
-def main(test_download=False, debug=False):
+def main(test_download=False, debug=False, metadata_snapshot=None):
     """ Run test using first technical pair in SEDIMENTS
     """    
 
@@ -260,6 +227,7 @@ def main(test_download=False, debug=False):
     else:
         log_level = log.INFO
     log.basicConfig(format="\t%(levelname)s: %(message)s", level=log_level)
+    sheet_cache.use_snapshot(metadata_snapshot)
 
     observatory_abbreviated_names = _read_observatory_names()
     for obs_name in observatory_abbreviated_names:
@@ -276,5 +244,13 @@ def main(test_download=False, debug=False):
                 count += 1
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-d", "--debug", action="store_true", help="DEBUG logging")
+    parser.add_argument(
+        "--metadata-snapshot",
+        default=None,
+        help="Resolve all remote metadata from this snapshot bundle",
+    )
+    args = parser.parse_args()
+    main(debug=args.debug, metadata_snapshot=args.metadata_snapshot)
 
@@ -1,11 +1,13 @@
-import math
 import os
 import sys
+import tarfile
 import subprocess
+import tempfile
 import logging
 from pathlib import Path
 import shutil
-import pandas as pd
+from sample_registry import get_registry
+from payload_codecs import Bzip2
 
 log = logging.getLogger(__name__)
 
@@ -31,56 +33,253 @@ def find_bzip2():
     return bzip2_program
 
 
-def open_archive(tarball_file, bzip2_program):
+# Buffer between the decompressor, tarfile and the compressors
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+
+def decompress_program(bzip2_program, threads=None):
+    """The tar --use-compress-program of bzip2_program, with its threads"""
+    if bzip2_program == "lbzip2" and threads:
+        return f"lbzip2 -n {threads}"
+    return bzip2_program
+
+
+def _stream_extract(
+    tarball_file,
+    bzip2_program,
+    temp,
+    recompress,
+    threads,
+    policy=None,
+    report=None,
+    codec=None,
+):
+    """Extract the archive into temp, reading it once, and compress the
+    members for which recompress(name) is true straight into name + the
+    suffix of the codec (bzip2 by default)
+
+    The members the extraction policy discards are skipped, and added to the
+    report.
+    """
+    # Compressing takes several times longer than decompressing
+    threads = threads or 1
+    if recompress is None:
+        # Nothing to compress
+        decompress_threads = compress_threads = threads
+    else:
+        decompress_threads = max(1, threads // 4)
+        compress_threads = max(1, threads - decompress_threads)
+    decompress = decompress_program(bzip2_program, decompress_threads).split()
+    codec = codec or Bzip2(bzip2_program)
+    with open(tarball_file, "rb") as f:
+        reader = subprocess.Popen(
+            decompress + ["-d", "-c"],
+            stdin=f,
+            stdout=subprocess.PIPE,
+            bufsize=STREAM_BUFFER_SIZE,
+        )
+    try:
+        with tarfile.open(fileobj=reader.stdout, mode="r|") as tar:
+            for member in tar:
+                glob = policy.discards_member(member.name) if policy else None
+                if glob is not None:
+                    log.debug(f"Discarding {member.name}")
+                    if report is not None and member.isfile():
+                        report.add(glob, member.size)
+                    continue
+                if not (member.isfile() and recompress and recompress(member.name)):
+                    tar.extract(member, temp, filter="data")
+                    continue
+                # As tar.extract() does, refuse paths outside of temp
+                member = tarfile.data_filter(member, f"{temp}")
+                dest = Path(temp, f"{member.name}{codec.suffix}")
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                log.debug(f"Compressing {member.name} to {dest}")
+                with open(dest, "wb") as out:
+                    codec.compress_stream(
+                        tar.extractfile(member), out, compress_threads
+                    )
+        # Read the padding after the end of the archive, so the decompressor
+        # is not stopped by a closed pipe
+        while reader.stdout.read(STREAM_BUFFER_SIZE):
+            pass
+    except BaseException:
+        reader.kill()
+        raise
+    finally:
+        reader.stdout.close()
+        reader.wait()
+    if reader.returncode:
+        raise subprocess.CalledProcessError(reader.returncode, reader.args)
+
+
+def _tar_extract(
+    tarball_file, bzip2_program, temp, threads, policy=None, report=None
+):
+    """Extract the archive into temp with tar
+
+    With an extraction policy its exclude globs are passed to tar, and the one
+    decompressor also feeds tar -tv, whose listing gives the members that were
+    skipped for the report.
     """
-    You are expected to be in the dir with the tarball when calling this function
+    program = decompress_program(bzip2_program, threads)
+    log.debug(f"Opening archive {tarball_file} with {program}")
+    if policy is None:
+        # tar --use-compress-program lbunzip2 -xvf ../HMNJKDSX3.UDI200.tar.bz2
+        subprocess.check_call(
+            [
+                "tar",
+                "--use-compress-program",
+                program,
+                "-xf",
+                f"{tarball_file}",
+                "-C",
+                f"{temp}",
+            ]
+        )
+        return
+    with open(tarball_file, "rb") as f, tempfile.TemporaryFile("w+") as listing:
+        reader = subprocess.Popen(
+            program.split() + ["-d", "-c"],
+            stdin=f,
+            stdout=subprocess.PIPE,
+            bufsize=STREAM_BUFFER_SIZE,
+        )
+        extract = subprocess.Popen(
+            ["tar", "-x", "-f", "-", "-C", f"{temp}"] + policy.tar_options(),
+            stdin=subprocess.PIPE,
+        )
+        lister = subprocess.Popen(
+            ["tar", "-t", "-v", "-f", "-", "--quoting-style=literal"],
+            stdin=subprocess.PIPE,
+            stdout=listing,
+        )
+        processes = (extract, lister, reader)
+        try:
+            while block := reader.stdout.read(STREAM_BUFFER_SIZE):
+                extract.stdin.write(block)
+                lister.stdin.write(block)
+        except BrokenPipeError:
+            # A tar stopped early, its exit status says why
+            reader.kill()
+        except BaseException:
+            for process in processes:
+                process.kill()
+            raise
+        finally:
+            for pipe in (reader.stdout, extract.stdin, lister.stdin):
+                try:
+                    pipe.close()
+                except BrokenPipeError:
+                    pass
+            for process in processes:
+                process.wait()
+        for process in processes:
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+        listing.seek(0)
+        for line in listing:
+            # -rw-r--r-- user/group SIZE YYYY-MM-DD HH:MM name
+            fields = line.rstrip("\n").split(None, 5)
+            if len(fields) < 6 or not fields[0].startswith("-"):
+                continue
+            name, size = fields[5], int(fields[2])
+            glob = policy.discards_member(name)
+            if glob is not None:
+                if report is not None:
+                    report.add(glob, size)
+            elif policy.discards_member(name, includes=False) is not None:
+                log.warning(f"{name} is included but tar did not extract it")
+
+
+def open_archive(
+    tarball_file,
+    bzip2_program,
+    out_dir=".",
+    threads=None,
+    recompress=None,
+    policy=None,
+    report=None,
+    codec=None,
+):
     """
+    Open the MGF results archive into out_dir/<run_id>
+
+    The archive is extracted into a temporary directory of out_dir, named
+    after the archive so several archives can be opened at the same time.
+    With lbzip2, threads is the number of threads it decompresses with.
+
+    With recompress, a function of the member names, the archive is read once
+    and the members it selects are compressed as they are read with the
+    payload codec (see payload_codecs.py, bzip2 by default), into <name>.bz2
+    (or .zst, .gz), rather than written to disk first and compressed
+    afterwards.
+    With an ExtractionPolicy (see extraction_policy.py) the members it
+    discards are never written, but added to the ExtractionReport report:
+    they are skipped by tar (its --exclude options), or while streaming.
+
+    Returns the path of the opened archive, or None if it is broken.
+    """
+    tarball_file = Path(tarball_file).resolve()
+    out_dir = Path(out_dir)
+    run_id = Path(str(tarball_file.name).rsplit(".", 2)[0])
+    log.debug(f"run_id = {run_id}")
     # Create temp dir in which to untar archives
+    temp = Path(out_dir, f"temp-{run_id}")
     try:
-        Path("temp").mkdir(exist_ok=False)
+        temp.mkdir(exist_ok=False)
     except FileExistsError as e:
-        log.error(
-            f"A directory called 'temp' in the target directory already exists: {e}"
-        )
+        log.error(f"A directory called {temp} already exists: {e}")
         log.error("Exiting...")
         sys.exit()
-    os.chdir("temp")
-    log.debug(f"Opening archive {tarball_file} with {bzip2_program}")
-    # tar --use-compress-program lbunzip2 -xvf ../HMNJKDSX3.UDI200.tar.bz2
-    subprocess.check_call(
-        [
-            "tar",
-            "--use-compress-program",
-            f"{bzip2_program}",
-            "-xf",
-            f"{tarball_file}",
-        ]
-    )
+    try:
+        if recompress is not None:
+            log.debug(f"Streaming archive {tarball_file} with {bzip2_program}")
+            try:
+                _stream_extract(
+                    tarball_file,
+                    bzip2_program,
+                    temp,
+                    recompress,
+                    threads,
+                    policy,
+                    report,
+                    codec,
+                )
+            except tarfile.TarError as e:
+                # Checked as a broken archive below
+                log.error(f"Cannot read {tarball_file}: {e}")
+                shutil.rmtree(temp)
+                temp.mkdir()
+        else:
+            _tar_extract(tarball_file, bzip2_program, temp, threads, policy, report)
+    except BaseException:
+        # A partial extraction would stop the next run
+        log.error(f"Failed to open {tarball_file}, removing {temp}")
+        shutil.rmtree(temp, ignore_errors=True)
+        raise
     # Check archive has a top-level directory called run_id
-    run_id = Path(str(tarball_file.name).rsplit(".", 2)[0])
-    log.debug(f"run_id = {run_id}")
-    if run_id.exists():
-        os.chdir("..")
+    if Path(temp, run_id).exists():
         # Move archive up to target directory
-        Path("temp", run_id).rename(run_id)
-        shutil.rmtree("temp")
+        Path(temp, run_id).rename(out_dir / run_id)
+        shutil.rmtree(temp)
     else:
         # Archive with top level directory
-        log.debug("Checking archive in ./temp")
-        yml_files = list(Path.cwd().glob("*.yml"))
+        log.debug(f"Checking archive in {temp}")
+        yml_files = list(temp.glob("*.yml"))
         log.debug(f"Found {yml_files} yml files")
-        if Path("results").exists() and len(yml_files) == 2:
+        if Path(temp, "results").exists() and len(yml_files) == 2:
             log.debug("Found archive without top level directory")
-            os.chdir("..")
-            log.debug(f"Renaming ./temp to {run_id}")
-            Path("temp").rename(run_id)
+            log.debug(f"Renaming {temp} to {run_id}")
+            temp.rename(out_dir / run_id)
         else:
             # Deal with broken archive
             log.error(f"Archive looks completely broken at {tarball_file}")
-            os.chdir("..")
-            shutil.rmtree("temp")
+            shutil.rmtree(temp)
             log.debug("Renaming broken archive")
-            Path(tarball_file).rename(f"{tarball_file}-broken")
+            tarball_file.rename(f"{tarball_file}-broken")
+            return None
+    return out_dir / run_id
 
 
 # Legacy code dont use; just open_archive
@@ -146,38 +345,11 @@ def get_refcode_and_source_mat_id_from_run_id(run_id):
 
     assert isinstance(run_id, str), "run_id must be a string"
 
-    # "https://raw.githubusercontent.com/emo-bon/sequencing-data/main/shipment/"
-    # "batch-001/run-information-batch-001.csv"
-    BATCH1_RUN_INFO_PATH = (
-        "https://raw.githubusercontent.com/emo-bon/sequencing-crate/refs/heads/main/shipment/"
-        "batch-001/run-information-batch-001.csv"
-    )
-    # "https://raw.githubusercontent.com/emo-bon/sequencing-data/main/shipment/"
-    # "batch-002/run-information-batch-002.csv"
-    BATCH2_RUN_INFO_PATH = (
-        "https://raw.githubusercontent.com/emo-bon/sequencing-crate/refs/heads/main/shipment/"
-        "batch-002/run-information-batch-002.csv"
-    )
-    BATCH3_RUN_INFO_PATH = (
-        "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/refs/heads/main/"
-        "shipment/batch-003-0/run-information-batch-003.csv"
-    )
-
-    # for i, batch in enumerate([BATCH1_RUN_INFO_PATH, BATCH2_RUN_INFO_PATH, BATCH3_RUN_INFO_PATH]):
-    for batch in [BATCH1_RUN_INFO_PATH, BATCH2_RUN_INFO_PATH, BATCH3_RUN_INFO_PATH]:
-        log.debug(f"Reading {batch}")
-        df = pd.read_csv(batch, encoding='iso-8859-1')
-        for row in df[["reads_name", "ref_code", "source_mat_id"]].values.tolist():
-            if isinstance(row[0], str):
-                id_in_row = str(row[0].split("_")[-1])
-                if id_in_row == run_id:
-                    return (row[1], row[2])
-            elif math.isnan(row[0]):
-                # Not all samples with an EMO BON code were sent to sequencing
-                continue
-    else:
+    sample = get_registry().by_run_id(run_id)
+    if sample is None:
         log.info(f"Cannot find run_id {run_id} in any of the run information files")
         return (None, None)
+    return (sample.ref_code, sample.source_mat_id)
 
 
 def get_run_id_and_ref_code_from_source_mat_id(source_mat_id):
@@ -195,35 +367,8 @@ def get_run_id_and_ref_code_from_source_mat_id(source_mat_id):
 
     """
 
-    # "https://raw.githubusercontent.com/emo-bon/sequencing-data/main/shipment/"
-    # "batch-001/run-information-batch-001.csv"
-    BATCH1_RUN_INFO_PATH = (
-        "https://raw.githubusercontent.com/emo-bon/sequencing-crate/refs/heads/main/shipment/"
-        "batch-001/run-information-batch-001.csv"
-    )
-    # "https://raw.githubusercontent.com/emo-bon/sequencing-data/main/shipment/"
-    # "batch-002/run-information-batch-002.csv"
-    BATCH2_RUN_INFO_PATH = (
-        "https://raw.githubusercontent.com/emo-bon/sequencing-crate/refs/heads/main/shipment/"
-        "batch-002/run-information-batch-002.csv"
-    )
-    BATCH3_RUN_INFO_PATH = (
-        "https://raw.githubusercontent.com/emo-bon/sequencing-logistics-crate/refs/heads/main/"
-        "shipment/batch-003-0/run-information-batch-003.csv"
-    )
-
-    # for i, batch in enumerate([BATCH1_RUN_INFO_PATH, BATCH2_RUN_INFO_PATH, BATCH3_RUN_INFO_PATH]):
-    for batch in [BATCH1_RUN_INFO_PATH, BATCH2_RUN_INFO_PATH, BATCH3_RUN_INFO_PATH]:
-        log.debug(f"Reading {batch}")
-        df = pd.read_csv(batch, encoding='iso-8859-1')
-        for row in df[["reads_name", "ref_code", "source_mat_id"]].values.tolist():
-            if isinstance(row[0], str):
-                # print(row)
-                if row[2] == source_mat_id:
-                    return (row[0].split("_")[-1], row[1])
-            elif math.isnan(row[0]):
-                # Not all samples with an EMO BON code were sent to sequencing
-                continue
-    else:
+    sample = get_registry().by_source_mat_id(source_mat_id)
+    if sample is None:
         log.info(f"Cannot find run_id {source_mat_id} in any of the run information files")
         return (None, None)
+    return (sample.run_id, sample.ref_code)